@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 The Litecoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Micro-benchmarks for the hot paths of the functional test framework.
+
+Usage: test_framework_bench.py <benchmark> [options]
+
+Run with --help to list the available benchmarks.
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import types
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'test', 'functional'))
+
+from test_framework.messages import (  # noqa: E402
+    CBlock,
+    CBlockHeader,
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    MSG_TX,
+    msg_block,
+    msg_headers,
+    msg_inv,
+    msg_ping,
+    msg_pong,
+    msg_tx,
+    ser_compact_size,
+    sha256,
+)
+from test_framework.key import (  # noqa: E402
+    ECKey,
+    SECP256K1,
+    compute_xonly_pubkey,
+    generate_privkey,
+    sign_schnorr,
+    verify_schnorr,
+    verify_schnorr_batch,
+)
+from test_framework.p2p import MAGIC_BYTES, MESSAGEMAP, NetworkThread, P2PConnection, P2PInterface  # noqa: E402
+from test_framework.util import wait_until_helper  # noqa: E402
+
+
+def report(name, seconds, nbytes=None, count=None):
+    line = "{:<32} {:8.3f}s".format(name, seconds)
+    if nbytes is not None:
+        line += " {:10.2f} MB/s".format(nbytes / seconds / 1e6)
+    if count is not None:
+        line += " {:12.1f} /s".format(count / seconds)
+    print(line)
+
+
+def random_tx(rng):
+    tx = CTransaction()
+    for _ in range(rng.randint(1, 3)):
+        tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), rng.randint(0, 10)), rng.randbytes(rng.randint(70, 110))))
+    for _ in range(rng.randint(1, 3)):
+        tx.vout.append(CTxOut(rng.randint(1, 10**8), rng.randbytes(rng.choice([22, 25, 34]))))
+    return tx
+
+
+def build_stream(conn, count, rng):
+    """Build a recv stream with a mix of small and large messages."""
+    frames = []
+    for i in range(count):
+        kind = i % 100
+        if kind == 0:
+            block = CBlock()
+            block.vtx = [random_tx(rng) for _ in range(200)]
+            msg = msg_block(block)
+        elif kind == 1:
+            msg = msg_headers([CBlockHeader() for _ in range(2000)])
+        elif kind < 40:
+            msg = msg_inv([CInv(MSG_TX, rng.getrandbits(256)) for _ in range(rng.randint(1, 35))])
+        elif kind < 80:
+            msg = msg_tx(random_tx(rng))
+        else:
+            msg = msg_ping(nonce=i)
+        frames.append(conn.build_message(msg))
+    return b"".join(frames)
+
+
+class LegacyDecoder:
+    """The previous bytes-concatenating decoder, kept as a baseline."""
+
+    def __init__(self, magic_bytes):
+        self.magic_bytes = magic_bytes
+        self.recvbuf = b""
+        self.received = 0
+
+    def data_received(self, t):
+        self.recvbuf += t
+        while True:
+            if len(self.recvbuf) < 4:
+                return
+            if self.recvbuf[:4] != self.magic_bytes:
+                raise ValueError("magic bytes mismatch")
+            if len(self.recvbuf) < 4 + 12 + 4 + 4:
+                return
+            msgtype = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
+            msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
+            checksum = self.recvbuf[4+12+4:4+12+4+4]
+            if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                return
+            msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
+            if checksum != sha256(sha256(msg))[:4]:
+                raise ValueError("got bad checksum")
+            self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
+            t = MESSAGEMAP[msgtype]()
+            t.deserialize(BytesIO(msg))
+            self.received += 1
+
+
+class RawPayload:
+    """Stand-in message class used to measure framing cost on its own."""
+
+    def deserialize(self, f):
+        self.payload = f.read()
+
+
+class CountingConnection(P2PConnection):
+    def on_message(self, message):
+        self.received += 1
+
+    def _log_message(self, direction, msg):
+        pass
+
+
+def feed(decoder, stream, chunk_size):
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        decoder.data_received(stream[i:i + chunk_size])
+    return time.perf_counter() - start
+
+
+def bench_p2p_recv(args):
+    rng = random.Random(args.seed)
+    conn = CountingConnection(lazy_messages=args.lazy_messages)
+    conn.peer_connect_helper('0', 0, 'regtest', 1)
+    conn.received = 0
+    if args.input:
+        with open(args.input, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = build_stream(conn, args.messages, rng)
+    if args.record:
+        with open(args.record, 'wb') as f:
+            f.write(stream)
+    print("stream: {} bytes, chunk size {}".format(len(stream), args.chunk_size))
+    if args.framing_only:
+        for msgtype in MESSAGEMAP:
+            MESSAGEMAP[msgtype] = RawPayload
+
+    legacy = LegacyDecoder(conn.magic_bytes)
+    elapsed = feed(legacy, stream, args.chunk_size)
+    report("legacy decoder ({} msgs)".format(legacy.received), elapsed, len(stream))
+
+    elapsed = feed(conn, stream, args.chunk_size)
+    report("P2PConnection ({} msgs)".format(conn.received), elapsed, len(stream))
+
+
+class SendingConnection(P2PConnection):
+    def on_open(self):
+        pass
+
+    def on_close(self):
+        pass
+
+
+def drain(listener, total, done):
+    """Accept one connection and read total bytes from it."""
+    sock, _ = listener.accept()
+    with sock:
+        received = 0
+        while received < total:
+            received += len(sock.recv(1 << 20))
+    done.set()
+
+
+def time_send(name, conn, listener, messages, send):
+    connect = conn.peer_connect('127.0.0.1', listener.getsockname()[1], net='regtest', timeout_factor=1)
+    total = sum(len(conn.build_message(m)) for m in messages)
+    done = threading.Event()
+    threading.Thread(target=drain, args=(listener, total, done), daemon=True).start()
+    connect()
+    wait_until_helper(lambda: conn.is_connected, timeout=10)
+    conn.reset_send_stats()
+    start = time.perf_counter()
+    send(messages)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    report(name, elapsed, total, len(messages))
+    stats = conn.send_stats()
+    print("  {:<30} {:8.3f}s {:10.2f} MB/s {:12.1f} /s".format("send_stats()", stats["seconds"], stats["bytes_per_second"] / 1e6, stats["messages_per_second"]))
+    conn.peer_disconnect()
+    wait_until_helper(lambda: not conn.is_connected, timeout=10)
+
+
+def bench_p2p_send(args):
+    rng = random.Random(args.seed)
+    messages = [msg_inv([CInv(MSG_TX, rng.getrandbits(256))]) for _ in range(args.messages)]
+    network_thread = NetworkThread()
+    network_thread.start()
+    try:
+        with socket.create_server(('127.0.0.1', 0)) as listener:
+            conn = SendingConnection()
+
+            def send_each(msgs):
+                for m in msgs:
+                    conn.send_message(m)
+            time_send("send_message() each", conn, listener, messages, send_each)
+
+            def send_batches(msgs):
+                for i in range(0, len(msgs), args.batch):
+                    conn.send_messages(msgs[i:i + args.batch])
+            time_send("send_messages() x{}".format(args.batch), conn, listener, messages, send_batches)
+    finally:
+        network_thread.close()
+
+
+class PingServer(asyncio.Protocol):
+    """Sends a burst of pings on every accepted connection and counts the pong bytes coming back."""
+    def __init__(self, pings, expected, done):
+        self.pings = pings
+        self.expected = expected
+        self.done = done
+
+    def connection_made(self, transport):
+        transport.write(self.pings)
+
+    def data_received(self, data):
+        self.expected[0] -= len(data)
+        if self.expected[0] <= 0:
+            self.done.set()
+
+
+def bench_p2p_peers(args):
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    conn = P2PConnection()
+    conn.magic_bytes = MAGIC_BYTES['regtest']
+    pings = b"".join(conn.build_message(msg_ping(nonce=i)) for i in range(args.pings))
+    pong_size = len(conn.build_message(msg_pong(nonce=0)))
+    for num_loops in args.loops:
+        expected = [args.peers * args.pings * pong_size]
+        done = threading.Event()
+        server = asyncio.run_coroutine_threadsafe(loop.create_server(lambda: PingServer(pings, expected, done), '127.0.0.1', 0, backlog=args.peers), loop).result()
+        port = server.sockets[0].getsockname()[1]
+        network_thread = NetworkThread(num_loops=num_loops)
+        network_thread.start()
+        peers = [P2PInterface() for _ in range(args.peers)]
+        connects = [peer.peer_connect('127.0.0.1', port, net='regtest', timeout_factor=1, send_version=False) for peer in peers]
+        start = time.perf_counter()
+        for connect in connects:
+            connect()
+        done.wait()
+        report("{} peers, {} loop(s)".format(args.peers, num_loops), time.perf_counter() - start, count=args.peers * args.pings)
+        for peer in peers:
+            peer.peer_disconnect()
+        for peer in peers:
+            peer.wait_for_disconnect()
+        network_thread.close()
+        loop.call_soon_threadsafe(server.close)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def legacy_mul(self, ps):
+    """The previous double-and-add EllipticCurve.mul, kept as a baseline."""
+    r = (0, 1, 0)
+    for i in range(255, -1, -1):
+        r = self.double(r)
+        for (p, n) in ps:
+            if ((n >> i) & 1):
+                r = self.add(r, p)
+    return r
+
+
+def bench_key_ops(count):
+    rng = random.Random(0)
+    msgs = [rng.randbytes(32) for _ in range(count)]
+    ecdsa_key = ECKey()
+    ecdsa_key.generate()
+    ecdsa_pubkey = ecdsa_key.get_pubkey()
+    schnorr_key = generate_privkey()
+    schnorr_pubkey, _ = compute_xonly_pubkey(schnorr_key)
+
+    start = time.perf_counter()
+    ecdsa_sigs = [ecdsa_key.sign_ecdsa(msg) for msg in msgs]
+    report("  ECDSA sign", time.perf_counter() - start, count=count)
+    start = time.perf_counter()
+    assert all(ecdsa_pubkey.verify_ecdsa(sig, msg) for sig, msg in zip(ecdsa_sigs, msgs))
+    report("  ECDSA verify", time.perf_counter() - start, count=count)
+    start = time.perf_counter()
+    schnorr_sigs = [sign_schnorr(schnorr_key, msg) for msg in msgs]
+    report("  Schnorr sign", time.perf_counter() - start, count=count)
+    start = time.perf_counter()
+    assert all(verify_schnorr(schnorr_pubkey, sig, msg) for sig, msg in zip(schnorr_sigs, msgs))
+    report("  Schnorr verify", time.perf_counter() - start, count=count)
+    start = time.perf_counter()
+    assert all(verify_schnorr_batch((schnorr_pubkey, sig, msg) for sig, msg in zip(schnorr_sigs, msgs)))
+    report("  Schnorr batch verify", time.perf_counter() - start, count=count)
+
+
+def legacy_ser_uint256(u):
+    rs = b""
+    for _ in range(8):
+        rs += struct.pack("<I", u & 0xFFFFFFFF)
+        u >>= 32
+    return rs
+
+
+def legacy_ser_vector(l, ser_function):
+    r = ser_compact_size(len(l))
+    for i in l:
+        r += ser_function(i)
+    return r
+
+
+def legacy_ser_txin(txin):
+    r = b""
+    r += legacy_ser_uint256(txin.prevout.hash)
+    r += struct.pack("<I", txin.prevout.n)
+    r += ser_compact_size(len(txin.scriptSig)) + txin.scriptSig
+    r += struct.pack("<I", txin.nSequence)
+    return r
+
+
+def legacy_ser_txout(txout):
+    r = b""
+    r += struct.pack("<q", txout.nValue)
+    r += ser_compact_size(len(txout.scriptPubKey)) + txout.scriptPubKey
+    return r
+
+
+def legacy_ser_tx(tx):
+    r = b""
+    r += struct.pack("<i", tx.nVersion)
+    r += legacy_ser_vector(tx.vin, legacy_ser_txin)
+    r += legacy_ser_vector(tx.vout, legacy_ser_txout)
+    r += struct.pack("<I", tx.nLockTime)
+    return r
+
+
+def legacy_ser_block(block):
+    """The previous bytes-concatenating serializers, kept as a baseline."""
+    r = b""
+    r += struct.pack("<i", block.nVersion)
+    r += legacy_ser_uint256(block.hashPrevBlock)
+    r += legacy_ser_uint256(block.hashMerkleRoot)
+    r += struct.pack("<I", block.nTime)
+    r += struct.pack("<I", block.nBits)
+    r += struct.pack("<I", block.nNonce)
+    r += legacy_ser_vector(block.vtx, legacy_ser_tx)
+    return r
+
+
+def legacy_ser_headers(headers):
+    return legacy_ser_vector([CBlock(h) for h in headers], legacy_ser_block)
+
+
+def time_serialize(name, ser_function, obj, rounds, reset=lambda: None):
+    elapsed = 0
+    for _ in range(rounds):
+        reset()
+        start = time.perf_counter()
+        data = ser_function(obj)
+        elapsed += time.perf_counter() - start
+    report(name, elapsed / rounds, len(data))
+    return data
+
+
+def bench_serialize(args):
+    rng = random.Random(args.seed)
+    block = CBlock()
+    weight = 80 * 4
+    while weight < args.weight:
+        tx = random_tx(rng)
+        block.vtx.append(tx)
+        weight += len(tx.serialize_without_witness()) * 4
+    headers = []
+    for i in range(args.headers):
+        header = CBlockHeader()
+        header.hashPrevBlock = rng.getrandbits(256)
+        header.hashMerkleRoot = rng.getrandbits(256)
+        header.nNonce = i
+        headers.append(header)
+
+    def forget_txs():
+        # Transactions memoize their serialization; start every round cold.
+        for tx in block.vtx:
+            tx._memo = {}
+
+    def forget_headers():
+        for header in headers:
+            header._header_cache = None
+
+    print("block: {} transactions, weight {}".format(len(block.vtx), weight))
+    legacy = time_serialize("  legacy block", legacy_ser_block, block, args.rounds)
+    new = time_serialize("  msg_block", lambda b: msg_block(b).serialize(), block, args.rounds, forget_txs)
+    assert legacy == new
+    time_serialize("  msg_block (memoized txs)", lambda b: msg_block(b).serialize(), block, args.rounds)
+    print("headers: {} entries".format(len(headers)))
+    legacy = time_serialize("  legacy headers", legacy_ser_headers, headers, args.rounds)
+    new = time_serialize("  msg_headers", lambda h: msg_headers(h).serialize(), headers, args.rounds, forget_headers)
+    assert legacy == new
+
+
+def bench_key(args):
+    # Build the fixed-base tables outside of the measurements.
+    ECKey().generate()
+    mul = SECP256K1.mul
+    SECP256K1.mul = types.MethodType(legacy_mul, SECP256K1)
+    print("double-and-add:")
+    bench_key_ops(args.count)
+    SECP256K1.mul = mul
+    print("EllipticCurve.mul:")
+    bench_key_ops(args.count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    p2p_recv = subparsers.add_parser('p2p-recv', help='decode a stream of P2P messages')
+    p2p_recv.add_argument('--messages', type=int, default=10000, help='number of messages in the generated stream (default: %(default)s)')
+    p2p_recv.add_argument('--chunk-size', type=int, default=65536, help='size of each data_received() call (default: %(default)s)')
+    p2p_recv.add_argument('--input', help='read a recorded raw message stream from this file instead of generating one')
+    p2p_recv.add_argument('--record', help='write the message stream to this file')
+    p2p_recv.add_argument('--framing-only', action='store_true', help='skip payload deserialization')
+    p2p_recv.add_argument('--lazy-messages', action='store_true', help='leave blocks, headers and other large messages undecoded')
+    p2p_recv.add_argument('--seed', type=int, default=0)
+    p2p_recv.set_defaults(func=bench_p2p_recv)
+
+    p2p_send = subparsers.add_parser('p2p-send', help='send single-entry inv messages to a local socket')
+    p2p_send.add_argument('--messages', type=int, default=50000, help='number of messages to send (default: %(default)s)')
+    p2p_send.add_argument('--batch', type=int, default=1000, help='messages per send_messages() call (default: %(default)s)')
+    p2p_send.add_argument('--seed', type=int, default=0)
+    p2p_send.set_defaults(func=bench_p2p_send)
+
+    p2p_peers = subparsers.add_parser('p2p-peers', help='answer pings on many P2PInterface connections')
+    p2p_peers.add_argument('--peers', type=int, default=500, help='number of connections (default: %(default)s)')
+    p2p_peers.add_argument('--pings', type=int, default=20, help='pings sent to each connection (default: %(default)s)')
+    p2p_peers.add_argument('--loops', type=int, nargs='+', default=[1, 4], help='NetworkThread event loop counts to compare (default: %(default)s)')
+    p2p_peers.set_defaults(func=bench_p2p_peers)
+
+    serialize = subparsers.add_parser('serialize', help='serialize a full block and a full headers message')
+    serialize.add_argument('--weight', type=int, default=4000000, help='weight of the generated block (default: %(default)s)')
+    serialize.add_argument('--headers', type=int, default=2000, help='number of headers in the headers message (default: %(default)s)')
+    serialize.add_argument('--rounds', type=int, default=5, help='average over this many runs (default: %(default)s)')
+    serialize.add_argument('--seed', type=int, default=0)
+    serialize.set_defaults(func=bench_serialize)
+
+    key = subparsers.add_parser('key', help='sign and verify with test_framework.key')
+    key.add_argument('--count', type=int, default=200, help='number of signatures of each kind (default: %(default)s)')
+    key.set_defaults(func=bench_key)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,58 +16,27 @@ import hashlib
 import datetime
 import time
 import glob
-from collections import namedtuple
+import mmap
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from binascii import unhexlify
 
 settings = {}
 
+# Number of input files kept open while writing the output
+MAX_OPEN_INPUT_FILES = 64
+# Maximum size of a single copy when the kernel cannot copy for us
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
 def hex_switchEndian(s):
     """ Switches the endianness of a hex string (in pairs of hex chars) """
     pairList = [s[i:i+2].encode() for i in range(0, len(s), 2)]
     return b''.join(pairList[::-1]).decode()
 
-def uint32(x):
-    return x & 0xffffffff
-
-def bytereverse(x):
-    return uint32(( ((x) << 24) | (((x) << 8) & 0x00ff0000) |
-               (((x) >> 8) & 0x0000ff00) | ((x) >> 24) ))
-
-def bufreverse(in_buf):
-    out_words = []
-    for i in range(0, len(in_buf), 4):
-        word = struct.unpack('@I', in_buf[i:i+4])[0]
-        out_words.append(struct.pack('@I', bytereverse(word)))
-    return b''.join(out_words)
-
-def wordreverse(in_buf):
-    out_words = []
-    for i in range(0, len(in_buf), 4):
-        out_words.append(in_buf[i:i+4])
-    out_words.reverse()
-    return b''.join(out_words)
-
-def calc_hdr_hash(blk_hdr):
-    hash1 = hashlib.sha256()
-    hash1.update(blk_hdr)
-    hash1_o = hash1.digest()
-
-    hash2 = hashlib.sha256()
-    hash2.update(hash1_o)
-    hash2_o = hash2.digest()
-
-    return hash2_o
-
 def calc_hash_str(blk_hdr):
-    hash = calc_hdr_hash(blk_hdr)
-    hash = bufreverse(hash)
-    hash = wordreverse(hash)
-    hash_str = hash.hex()
-    return hash_str
-
-def get_blk_dt(blk_hdr):
-    members = struct.unpack("<I", blk_hdr[68:68+4])
-    nTime = members[0]
+    return hashlib.sha256(hashlib.sha256(blk_hdr).digest()).digest()[::-1].hex()
+
+def get_blk_dt(nTime):
     dt = datetime.datetime.fromtimestamp(nTime)
     dt_ym = datetime.datetime(dt.year, dt.month, 1)
     return (dt_ym, nTime)
@@ -117,8 +86,64 @@ def getFirstBlockFileId(block_dir_path):
     blkId = int(firstBlkFn[3:8])
     return blkId
 
-# Block header and extent on disk
-BlockExtent = namedtuple('BlockExtent', ['fn', 'offset', 'inhdr', 'blkhdr', 'size'])
+# Block extent on disk, including the 8 byte magic and length prefix
+BlockExtent = namedtuple('BlockExtent', ['fn', 'offset', 'size', 'nTime'])
+
+def scanBlockFile(job):
+    '''Find all blocks in one block file.
+
+    Returns the file id and a list of (hash, offset, size, nTime) tuples, in
+    file order. Runs in a worker process, so only takes and returns plain
+    data.'''
+    fn, fname, netmagic = job
+    blocks = []
+    with open(fname, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            return fn, blocks
+    with data:
+        end = len(data)
+        # Resynchronize on the next magic whenever the data following a block
+        # is not the start of another one (e.g. zero padding at the end).
+        pos = data.find(netmagic)
+        while pos != -1 and pos + 8 + 80 <= end:
+            size = 8 + struct.unpack_from("<I", data, pos + 4)[0]
+            if size < 8 + 80 or pos + size > end:
+                pos = data.find(netmagic, pos + 1)
+                continue
+            blk_hdr = data[pos + 8:pos + 8 + 80]
+            blocks.append((calc_hash_str(blk_hdr), pos, size, struct.unpack_from("<I", blk_hdr, 68)[0]))
+            pos = data.find(netmagic, pos + size)
+    return fn, blocks
+
+def _copy_file_range(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+# In-kernel copy methods, best first. A method is dropped as soon as it fails,
+# e.g. with EXDEV or EINVAL on older kernels or unusual file systems.
+kernelCopyMethods = [m for m, name in ((_copy_file_range, 'copy_file_range'), (_sendfile, 'sendfile')) if hasattr(os, name)]
+
+def copyRange(in_fd, out_fd, offset, count):
+    '''Append count bytes at offset of in_fd to out_fd.'''
+    while count > 0:
+        n = 0
+        while kernelCopyMethods and not n:
+            try:
+                n = kernelCopyMethods[0](in_fd, out_fd, offset, min(count, 1 << 30))
+                break
+            except OSError:
+                kernelCopyMethods.pop(0)
+        if not n:
+            buf = os.pread(in_fd, min(count, COPY_CHUNK_SIZE), offset)
+            if not buf:
+                raise IOError("Unexpected end of block data")
+            n = os.write(out_fd, buf)
+        offset += n
+        count -= n
 
 class BlockDataCopier:
     def __init__(self, settings, blkindex, blkmap):
@@ -129,7 +154,7 @@ class BlockDataCopier:
         # Get first occurring block file id - for pruned nodes this
         # will not necessarily be 0
         self.inFn = getFirstBlockFileId(self.settings['input'])
-        self.inF = None
+        self.inFiles = OrderedDict()
         self.outFn = 0
         self.outsz = 0
         self.outF = None
@@ -149,34 +174,83 @@ class BlockDataCopier:
             self.setFileTime = True
         if settings['split_timestamp'] != 0:
             self.timestampSplit = True
-        # Extents and cache for out-of-order blocks
-        self.blockExtents = {}
-        self.outOfOrderData = {}
-        self.outOfOrderSize = 0 # running total size for items in outOfOrderData
-
-    def writeBlock(self, inhdr, blk_hdr, rawblock):
-        blockSizeOnDisk = len(inhdr) + len(blk_hdr) + len(rawblock)
-        if not self.fileOutput and ((self.outsz + blockSizeOnDisk) > self.maxOutSz):
-            self.outF.close()
-            if self.setFileTime:
-                os.utime(self.outFname, (int(time.time()), self.highTS))
-            self.outF = None
-            self.outFname = None
-            self.outFn = self.outFn + 1
-            self.outsz = 0
-
-        (blkDate, blkTS) = get_blk_dt(blk_hdr)
+        # Extent of each block in the hash list, by height
+        self.blockExtents = [None] * len(blkindex)
+        # Extent not yet copied to the output: (fn, start, end)
+        self.pendingRun = None
+
+    def inFileName(self, fn):
+        return os.path.join(self.settings['input'], "blk%05d.dat" % fn)
+
+    def indexBlocks(self):
+        '''Find the extents of all blocks in the hash list, scanning the block
+        files in parallel.'''
+        jobs = []
+        fn = self.inFn
+        while os.path.exists(self.inFileName(fn)):
+            jobs.append((fn, self.inFileName(fn), self.settings['netmagic']))
+            fn += 1
+
+        workers = self.settings['workers']
+        if workers > 1 and len(jobs) > 1:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = executor.map(scanBlockFile, jobs, chunksize=1)
+        else:
+            executor = None
+            results = map(scanBlockFile, jobs)
+
+        for fn, blocks in results:
+            print("Input file " + self.inFileName(fn))
+            for (hash_str, offset, size, nTime) in blocks:
+                blkHeight = self.blkmap.get(hash_str)
+                if blkHeight is None:
+                    # Because blocks can be written to files out-of-order as of 0.10, the script
+                    # may encounter blocks it doesn't know about. Treat as debug output.
+                    if self.settings['debug_output'] == 'true':
+                        print("Skipping unknown block " + hash_str)
+                    continue
+                if self.blockExtents[blkHeight] is None:
+                    self.blockExtents[blkHeight] = BlockExtent(fn, offset, size, nTime)
+                    self.blkCountIn += 1
+        if executor:
+            executor.shutdown()
+
+    def inFileDescriptor(self, fn):
+        if fn in self.inFiles:
+            self.inFiles.move_to_end(fn)
+        else:
+            if len(self.inFiles) >= MAX_OPEN_INPUT_FILES:
+                os.close(self.inFiles.popitem(last=False)[1])
+            self.inFiles[fn] = os.open(self.inFileName(fn), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        return self.inFiles[fn]
+
+    def flushRun(self):
+        '''Copy the pending run of adjacent blocks to the output file.'''
+        if self.pendingRun:
+            fn, start, end = self.pendingRun
+            copyRange(self.inFileDescriptor(fn), self.outF.fileno(), start, end - start)
+            self.pendingRun = None
+
+    def closeOutput(self):
+        self.flushRun()
+        self.outF.close()
+        if self.setFileTime:
+            os.utime(self.outFname, (int(time.time()), self.highTS))
+        self.outF = None
+        self.outFname = None
+        self.outFn = self.outFn + 1
+        self.outsz = 0
+
+    def writeBlock(self, extent):
+        if not self.fileOutput and ((self.outsz + extent.size) > self.maxOutSz):
+            self.closeOutput()
+
+        (blkDate, blkTS) = get_blk_dt(extent.nTime)
         if self.timestampSplit and (blkDate > self.lastDate):
-            print("New month " + blkDate.strftime("%Y-%m") + " @ " + self.hash_str)
+            print("New month " + blkDate.strftime("%Y-%m") + " @ " + self.blkindex[self.blkCountOut])
             self.lastDate = blkDate
             if self.outF:
-                self.outF.close()
-                if self.setFileTime:
-                    os.utime(self.outFname, (int(time.time()), self.highTS))
-                self.outF = None
-                self.outFname = None
-                self.outFn = self.outFn + 1
-                self.outsz = 0
+                self.closeOutput()
 
         if not self.outF:
             if self.fileOutput:
@@ -184,12 +258,15 @@ class BlockDataCopier:
             else:
                 self.outFname = os.path.join(self.settings['output'], "blk%05d.dat" % self.outFn)
             print("Output file " + self.outFname)
-            self.outF = open(self.outFname, "wb")
+            self.outF = open(self.outFname, "wb", buffering=0)
 
-        self.outF.write(inhdr)
-        self.outF.write(blk_hdr)
-        self.outF.write(rawblock)
-        self.outsz = self.outsz + len(inhdr) + len(blk_hdr) + len(rawblock)
+        # Blocks that are adjacent in the input are copied in one go.
+        if self.pendingRun and self.pendingRun[0] == extent.fn and self.pendingRun[2] == extent.offset:
+            self.pendingRun = (extent.fn, self.pendingRun[1], extent.offset + extent.size)
+        else:
+            self.flushRun()
+            self.pendingRun = (extent.fn, extent.offset, extent.offset + extent.size)
+        self.outsz = self.outsz + extent.size
 
         self.blkCountOut = self.blkCountOut + 1
         if blkTS > self.highTS:
@@ -199,89 +276,21 @@ class BlockDataCopier:
             print('%i blocks scanned, %i blocks written (of %i, %.1f%% complete)' %
                     (self.blkCountIn, self.blkCountOut, len(self.blkindex), 100.0 * self.blkCountOut / len(self.blkindex)))
 
-    def inFileName(self, fn):
-        return os.path.join(self.settings['input'], "blk%05d.dat" % fn)
-
-    def fetchBlock(self, extent):
-        '''Fetch block contents from disk given extents'''
-        with open(self.inFileName(extent.fn), "rb") as f:
-            f.seek(extent.offset)
-            return f.read(extent.size)
-
-    def copyOneBlock(self):
-        '''Find the next block to be written in the input, and copy it to the output.'''
-        extent = self.blockExtents.pop(self.blkCountOut)
-        if self.blkCountOut in self.outOfOrderData:
-            # If the data is cached, use it from memory and remove from the cache
-            rawblock = self.outOfOrderData.pop(self.blkCountOut)
-            self.outOfOrderSize -= len(rawblock)
-        else: # Otherwise look up data on disk
-            rawblock = self.fetchBlock(extent)
-
-        self.writeBlock(extent.inhdr, extent.blkhdr, rawblock)
-
     def run(self):
-        while self.blkCountOut < len(self.blkindex):
-            if not self.inF:
-                fname = self.inFileName(self.inFn)
-                print("Input file " + fname)
-                try:
-                    self.inF = open(fname, "rb")
-                except IOError:
-                    print("Premature end of block data")
-                    return
-
-            inhdr = self.inF.read(8)
-            if (not inhdr or (inhdr[0] == "\0")):
-                self.inF.close()
-                self.inF = None
-                self.inFn = self.inFn + 1
-                continue
-
-            inMagic = inhdr[:4]
-            if (inMagic != self.settings['netmagic']):
-                # Seek backwards 7 bytes (skipping the first byte in the previous search)
-                # and continue searching from the new position if the magic bytes are not
-                # found.
-                self.inF.seek(-7, os.SEEK_CUR)
-                continue
-            inLenLE = inhdr[4:]
-            su = struct.unpack("<I", inLenLE)
-            inLen = su[0] - 80 # length without header
-            blk_hdr = self.inF.read(80)
-            inExtent = BlockExtent(self.inFn, self.inF.tell(), inhdr, blk_hdr, inLen)
-
-            self.hash_str = calc_hash_str(blk_hdr)
-            if not self.hash_str in blkmap:
-                # Because blocks can be written to files out-of-order as of 0.10, the script
-                # may encounter blocks it doesn't know about. Treat as debug output.
-                if settings['debug_output'] == 'true':
-                    print("Skipping unknown block " + self.hash_str)
-                self.inF.seek(inLen, os.SEEK_CUR)
-                continue
-
-            blkHeight = self.blkmap[self.hash_str]
-            self.blkCountIn += 1
-
-            if self.blkCountOut == blkHeight:
-                # If in-order block, just copy
-                rawblock = self.inF.read(inLen)
-                self.writeBlock(inhdr, blk_hdr, rawblock)
-
-                # See if we can catch up to prior out-of-order blocks
-                while self.blkCountOut in self.blockExtents:
-                    self.copyOneBlock()
-
-            else: # If out-of-order, skip over block data for now
-                self.blockExtents[blkHeight] = inExtent
-                if self.outOfOrderSize < self.settings['out_of_order_cache_sz']:
-                    # If there is space in the cache, read the data
-                    # Reading the data in file sequence instead of seeking and fetching it later is preferred,
-                    # but we don't want to fill up memory
-                    self.outOfOrderData[blkHeight] = self.inF.read(inLen)
-                    self.outOfOrderSize += inLen
-                else: # If no space in cache, seek forward
-                    self.inF.seek(inLen, os.SEEK_CUR)
+        '''Index the input block files, then copy the blocks to the output in
+        hash list order, leaving the data copies to the kernel where possible.'''
+        self.indexBlocks()
+        for extent in self.blockExtents:
+            if extent is None:
+                print("Premature end of block data")
+                break
+            self.writeBlock(extent)
+        if self.outF:
+            self.flushRun()
+            self.outF.close()
+        for fd in self.inFiles.values():
+            os.close(fd)
+        self.inFiles.clear()
 
         print("Done (%i blocks written)" % (self.blkCountOut))
 
@@ -324,17 +333,17 @@ if __name__ == '__main__':
         settings['split_timestamp'] = 0
     if 'max_out_sz' not in settings:
         settings['max_out_sz'] = 1000 * 1000 * 1000
-    if 'out_of_order_cache_sz' not in settings:
-        settings['out_of_order_cache_sz'] = 100 * 1000 * 1000
     if 'debug_output' not in settings:
         settings['debug_output'] = 'false'
+    if 'workers' not in settings:
+        settings['workers'] = os.cpu_count() or 1
 
     settings['max_out_sz'] = int(settings['max_out_sz'])
     settings['split_timestamp'] = int(settings['split_timestamp'])
     settings['file_timestamp'] = int(settings['file_timestamp'])
     settings['netmagic'] = unhexlify(settings['netmagic'].encode('utf-8'))
-    settings['out_of_order_cache_sz'] = int(settings['out_of_order_cache_sz'])
     settings['debug_output'] = settings['debug_output'].lower()
+    settings['workers'] = int(settings['workers'])
 
     if 'output_file' not in settings and 'output' not in settings:
         print("Missing output file / directory")
@@ -7,6 +7,8 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 #
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from http.client import HTTPConnection
 import json
 import re
@@ -14,6 +16,7 @@ import base64
 import sys
 import os
 import os.path
+import threading
 
 settings = {}
 
@@ -63,32 +66,126 @@ class BitcoinRPC:
     def response_is_error(resp_obj):
         return 'error' in resp_obj and resp_obj['error'] is not None
 
-def get_block_hashes(settings, max_blocks_per_call=10000):
-    rpc = BitcoinRPC(settings['host'], settings['port'],
-             settings['rpcuser'], settings['rpcpassword'])
-
-    height = settings['min_height']
-    while height < settings['max_height']+1:
-        num_blocks = min(settings['max_height']+1-height, max_blocks_per_call)
-        batch = []
-        for x in range(num_blocks):
-            batch.append(rpc.build_request(x, 'getblockhash', [height + x]))
+class ListOutput:
+    """A list with one line per height from min_height on, written to a file
+    or to stdout.
+
+    An existing file is appended to, after dropping an incomplete last line,
+    so that an interrupted run can be resumed."""
+
+    def __init__(self, path, min_height):
+        self.last_line = None
+        if path is None:
+            self.f = sys.stdout.buffer
+            self.next_height = min_height
+            return
+        self.f = open(path, 'a+b')
+        self.f.seek(0)
+        lines = 0
+        complete_size = 0
+        for line in self.f:
+            if not line.endswith(b'\n'):
+                break
+            lines += 1
+            complete_size += len(line)
+            self.last_line = line.decode('utf-8').rstrip()
+        self.f.truncate(complete_size)
+        self.next_height = min_height + lines
+
+    def write(self, height, line):
+        if height >= self.next_height:
+            assert height == self.next_height
+            self.f.write(line.encode('utf-8') + b'\n')
+            self.next_height += 1
+
+    def close(self):
+        self.f.flush()
+        if self.f is not sys.stdout.buffer:
+            self.f.close()
+
+def get_rpc(settings, local):
+    '''Return the RPC connection of the current thread.'''
+    if not hasattr(local, 'rpc'):
+        local.rpc = BitcoinRPC(settings['host'], settings['port'],
+                 settings['rpcuser'], settings['rpcpassword'])
+    return local.rpc
+
+def execute_batch(rpc, height, method, params_list):
+    reply = rpc.execute([rpc.build_request(x, method, params) for x, params in enumerate(params_list)])
+    if reply is None:
+        return None
+    results = []
+    for x,resp_obj in enumerate(reply):
+        if rpc.response_is_error(resp_obj):
+            print('JSON-RPC: error at height', height+x, ': ', resp_obj['error'], file=sys.stderr)
+            sys.exit(1)
+        assert(resp_obj['id'] == x) # assume replies are in-sequence
+        results.append(resp_obj['result'])
+    return results
+
+def fetch_chunk(settings, local, height, num_blocks):
+    '''Fetch the hashes, and the headers if requested, of num_blocks blocks
+    starting at height.'''
+    rpc = get_rpc(settings, local)
+    hashes = execute_batch(rpc, height, 'getblockhash', [[height + x] for x in range(num_blocks)])
+    if hashes is None or 'output_headers' not in settings:
+        return hashes, None
+    headers = execute_batch(rpc, height, 'getblockheader', [[h, True] for h in hashes])
+    if headers is None:
+        return None, None
+    return hashes, headers
 
-        reply = rpc.execute(batch)
+def get_block_hashes(settings, max_blocks_per_call=10000):
+    outputs = [ListOutput(settings.get('output_hashlist'), settings['min_height'])]
+    if 'output_headers' in settings:
+        outputs.append(ListOutput(settings['output_headers'], settings['min_height']))
+
+    # Before resuming, check that the lists still end on the active chain.
+    local = threading.local()
+    for out, field in zip(outputs, (0, 1)):
+        if out.last_line is None:
+            continue
+        last_hash = out.last_line.split(',')[field]
+        if field == 0 and settings['rev_hash_bytes'] == 'true':
+            last_hash = hex_switchEndian(last_hash)
+        reply = execute_batch(get_rpc(settings, local), out.next_height - 1, 'getblockhash', [[out.next_height - 1]])
         if reply is None:
             print('Cannot continue. Program will halt.')
             return None
-
-        for x,resp_obj in enumerate(reply):
-            if rpc.response_is_error(resp_obj):
-                print('JSON-RPC: error at height', height+x, ': ', resp_obj['error'], file=sys.stderr)
-                sys.exit(1)
-            assert(resp_obj['id'] == x) # assume replies are in-sequence
-            if settings['rev_hash_bytes'] == 'true':
-                resp_obj['result'] = hex_switchEndian(resp_obj['result'])
-            print(resp_obj['result'])
-
-        height += num_blocks
+        if reply[0] != last_hash:
+            print('%s does not end on the active chain at height %d, remove it to start over' % (out.f.name, out.next_height - 1), file=sys.stderr)
+            sys.exit(1)
+
+    # Keep a few batches in flight on separate connections, and write the
+    # results in height order as they come in.
+    threads = settings['rpc_threads']
+    height = min(out.next_height for out in outputs)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while height < settings['max_height']+1 or pending:
+            while height < settings['max_height']+1 and len(pending) < 2 * threads:
+                num_blocks = min(settings['max_height']+1-height, max_blocks_per_call)
+                pending.append((height, executor.submit(fetch_chunk, settings, local, height, num_blocks)))
+                height += num_blocks
+
+            chunk_height, future = pending.popleft()
+            hashes, headers = future.result()
+            if hashes is None:
+                for _, future in pending:
+                    future.cancel()
+                print('Cannot continue. Program will halt.')
+                return None
+
+            for x, block_hash in enumerate(hashes):
+                if settings['rev_hash_bytes'] == 'true':
+                    block_hash = hex_switchEndian(block_hash)
+                outputs[0].write(chunk_height + x, block_hash)
+            if headers is not None:
+                for x, header in enumerate(headers):
+                    outputs[1].write(chunk_height + x, '%d,%s,%d,%d,%d' % (header['height'], header['hash'], header['time'], header['mediantime'], header['nTx']))
+
+    for out in outputs:
+        out.close()
 
 def get_rpc_cookie():
     # Open the cookie file
@@ -127,6 +224,8 @@ if __name__ == '__main__':
         settings['max_height'] = 313000
     if 'rev_hash_bytes' not in settings:
         settings['rev_hash_bytes'] = 'false'
+    if 'rpc_threads' not in settings:
+        settings['rpc_threads'] = 4
 
     use_userpass = True
     use_datadir = False
@@ -141,6 +240,7 @@ if __name__ == '__main__':
     settings['port'] = int(settings['port'])
     settings['min_height'] = int(settings['min_height'])
     settings['max_height'] = int(settings['max_height'])
+    settings['rpc_threads'] = int(settings['rpc_threads'])
 
     # Force hash byte format setting to be lowercase to make comparisons easier.
     settings['rev_hash_bytes'] = settings['rev_hash_bytes'].lower()
@@ -6,10 +6,20 @@
 # Generate seeds.txt from Pieter's DNS seeder
 #
 
+import argparse
+import bisect
+import collections
+import ipaddress
+import json
+import os
 import re
 import sys
-import dns.resolver
-import collections
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import dns.resolver
+except ImportError:
+    dns = None
 
 NSEEDS=512
 
@@ -142,25 +152,132 @@ def lookup_asn(net, ip):
         sys.stderr.write('ERR: Could not resolve ASN for "' + ip + '"\n')
         return None
 
+class AsnTable:
+    '''
+    Offline ASN lookups from a local prefix-to-ASN table.
+
+    Each line of the table is either "<first ip> <last ip> <asn> ..." (the
+    ip2asn TSV format) or "<prefix>/<length> <asn> ..." (a BGP table dump).
+    Overlapping prefixes are resolved in favour of the most specific one, so
+    each address family becomes a sorted list of disjoint ranges that is
+    searched with bisect.
+    '''
+    def __init__(self, path):
+        ranges = {4: [], 6: []}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                try:
+                    if '/' in fields[0]:
+                        network = ipaddress.ip_network(fields[0], strict=False)
+                        first, last, asn = network.network_address, network.broadcast_address, fields[1]
+                    else:
+                        first, last, asn = ipaddress.ip_address(fields[0]), ipaddress.ip_address(fields[1]), fields[2]
+                    asn = int(asn.upper().lstrip('AS'))
+                except (ValueError, IndexError):
+                    continue
+                if asn == 0: # not routed
+                    continue
+                ranges[first.version].append((int(first), int(last), asn))
+        self.starts = {}
+        self.ends = {}
+        self.asns = {}
+        for version, entries in ranges.items():
+            flat = self.flatten(entries)
+            self.starts[version] = [r[0] for r in flat]
+            self.ends[version] = [r[1] for r in flat]
+            self.asns[version] = [r[2] for r in flat]
+
+    @staticmethod
+    def flatten(entries):
+        '''Turn nested ranges into disjoint ones, the innermost range winning.'''
+        flat = []
+        def emit(first, last, asn):
+            if first > last:
+                return
+            if flat and flat[-1][1] + 1 == first and flat[-1][2] == asn:
+                flat[-1] = (flat[-1][0], last, asn)
+            else:
+                flat.append((first, last, asn))
+        stack = [] # enclosing ranges as (last, asn), innermost last
+        pos = 0
+        for first, last, asn in sorted(entries, key=lambda r: (r[0], -r[1])):
+            while stack and stack[-1][0] < first:
+                end, outer_asn = stack.pop()
+                emit(pos, end, outer_asn)
+                pos = max(pos, end + 1)
+            if stack:
+                emit(pos, first - 1, stack[-1][1])
+            stack.append((last, asn))
+            pos = first
+        while stack:
+            end, outer_asn = stack.pop()
+            emit(pos, end, outer_asn)
+            pos = max(pos, end + 1)
+        return flat
+
+    def lookup(self, net, ip):
+        address = ipaddress.ip_address(ip)
+        i = bisect.bisect_right(self.starts[address.version], int(address)) - 1
+        if i >= 0 and int(address) <= self.ends[address.version][i]:
+            return self.asns[address.version][i]
+        sys.stderr.write('ERR: Could not resolve ASN for "' + ip + '"\n')
+        return None
+
+class AsnCache:
+    '''
+    Persistent cache in front of another lookup function. Only successful
+    lookups are stored, so that failed DNS queries are retried on the next run.
+    '''
+    def __init__(self, path, lookup):
+        self.path = path
+        self.backend = lookup
+        self.asns = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.asns = json.load(f)
+
+    def lookup(self, net, ip):
+        if ip not in self.asns:
+            asn = self.backend(net, ip)
+            if asn is None:
+                return None
+            self.asns[ip] = asn
+        return self.asns[ip]
+
+    def save(self):
+        with open(self.path + '.new', 'w', encoding='utf-8') as f:
+            json.dump(self.asns, f, sort_keys=True)
+        os.replace(self.path + '.new', self.path)
+
 # Based on Greg Maxwell's seed_filter.py
-def filterbyasn(ips, max_per_asn, max_per_net):
+def filterbyasn(ips, max_per_asn, max_per_net, lookup=lookup_asn, jobs=1):
     # Sift out ips by type
     ips_ipv46 = [ip for ip in ips if ip['net'] in ['ipv4', 'ipv6']]
     ips_onion = [ip for ip in ips if ip['net'] == 'onion']
 
-    # Filter IPv46 by ASN, and limit to max_per_net per network
+    # Filter IPv46 by ASN, and limit to max_per_net per network. ASNs are
+    # looked up jobs at a time, a few windows ahead of the filter, so that few
+    # lookups are wasted once both networks are full.
     result = []
     net_count = collections.defaultdict(int)
     asn_count = collections.defaultdict(int)
-    for ip in ips_ipv46:
-        if net_count[ip['net']] == max_per_net:
-            continue
-        asn = lookup_asn(ip['net'], ip['ip'])
-        if asn is None or asn_count[asn] == max_per_asn:
-            continue
-        asn_count[asn] += 1
-        net_count[ip['net']] += 1
-        result.append(ip)
+    window = max(1, jobs * 4)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for start in range(0, len(ips_ipv46), window):
+            if all(net_count[net] == max_per_net for net in ['ipv4', 'ipv6']):
+                break
+            batch = [ip for ip in ips_ipv46[start:start + window] if net_count[ip['net']] < max_per_net]
+            for ip, asn in zip(batch, executor.map(lambda ip: lookup(ip['net'], ip['ip']), batch)):
+                if net_count[ip['net']] == max_per_net:
+                    continue
+                if asn is None or asn_count[asn] == max_per_asn:
+                    continue
+                asn_count[asn] += 1
+                net_count[ip['net']] += 1
+                result.append(ip)
 
     # Add back Onions (up to max_per_net)
     result.extend(ips_onion[0:max_per_net])
@@ -174,7 +291,26 @@ def ip_stats(ips):
 
     return '%6d %6d %6d' % (hist['ipv4'], hist['ipv6'], hist['onion'])
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generate seeds.txt from DNS seeder data read on stdin.')
+    parser.add_argument('--asn-table', help='look up ASNs offline in this prefix-to-ASN table (ip2asn TSV or "prefix/length asn" lines) instead of querying cymru.com')
+    parser.add_argument('--asn-cache', help='JSON file caching ASN lookups between runs')
+    parser.add_argument('-j', '--jobs', type=int, default=16, help='number of concurrent ASN lookups (default: %(default)s)')
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    if args.asn_table:
+        lookup = AsnTable(args.asn_table).lookup
+    elif dns is not None:
+        lookup = lookup_asn
+    else:
+        sys.exit('ERR: dnspython is required for ASN lookups without --asn-table')
+    cache = None
+    if args.asn_cache:
+        cache = AsnCache(args.asn_cache, lookup)
+        lookup = cache.lookup
+
     lines = sys.stdin.readlines()
     ips = [parseline(line) for line in lines]
 
@@ -212,7 +348,9 @@ def main():
     ips = filtermultiport(ips)
     print('%s Filter out hosts with multiple bitcoin ports' % (ip_stats(ips)), file=sys.stderr)
     # Look up ASNs and limit results, both per ASN and globally.
-    ips = filterbyasn(ips, MAX_SEEDS_PER_ASN, NSEEDS)
+    ips = filterbyasn(ips, MAX_SEEDS_PER_ASN, NSEEDS, lookup, args.jobs)
+    if cache is not None:
+        cache.save()
     print('%s Look up ASNs and limit results per ASN and per net' % (ip_stats(ips)), file=sys.stderr)
     # Sort the results by IP address (for deterministic output).
     ips.sort(key=lambda x: (x['net'], x['sortkey']))
@@ -0,0 +1,444 @@
+// Package batchtool implements the prove-batch, verify-batch and derive-batch
+// helper commands. A Tool caches compiled circuits and loaded proving and
+// verifying keys, so a long-lived process such as cmd/batch-server only pays
+// for them on the first request.
+package batchtool
+
+import (
+	"bytes"
+	"encoding/hex"
+	"encoding/json"
+	"fmt"
+	"io"
+	"os"
+	"path/filepath"
+	"sync"
+
+	"github.com/allsagetech/litecoin-patched/contrib/validitysidechain-zk-demo/nativegroth16"
+	"github.com/allsagetech/litecoin-patched/contrib/validitysidechain-zk-demo/realbatch"
+	"github.com/allsagetech/litecoin-patched/contrib/validitysidechain-zk-demo/toybatch"
+	"github.com/consensys/gnark-crypto/ecc"
+	"github.com/consensys/gnark/backend/groth16"
+	groth16bls12381 "github.com/consensys/gnark/backend/groth16/bls12-381"
+	"github.com/consensys/gnark/constraint"
+	"github.com/consensys/gnark/frontend"
+	"github.com/consensys/gnark/frontend/cs/r1cs"
+)
+
+type DeriveResult struct {
+	OK           bool                        `json:"ok"`
+	Error        string                      `json:"error,omitempty"`
+	PublicInputs *toybatch.BatchPublicInputs `json:"public_inputs,omitempty"`
+}
+
+// fileStamp identifies the version of a key file on disk, so that cached keys
+// are reloaded when the artifacts are regenerated.
+type fileStamp struct {
+	modTime int64
+	size    int64
+}
+
+type cachedProvingKey struct {
+	stamp fileStamp
+	key   groth16.ProvingKey
+}
+
+type verifyingKeyID struct {
+	path   string
+	native bool
+}
+
+type cachedVerifyingKey struct {
+	stamp fileStamp
+	key   groth16.VerifyingKey
+}
+
+type Tool struct {
+	// Requests are handled one at a time: gnark already parallelizes proving
+	// internally, and this keeps the caches simple.
+	mu            sync.Mutex
+	circuits      map[string]constraint.ConstraintSystem
+	provingKeys   map[string]cachedProvingKey
+	verifyingKeys map[verifyingKeyID]cachedVerifyingKey
+}
+
+func New() *Tool {
+	return &Tool{
+		circuits:      make(map[string]constraint.ConstraintSystem),
+		provingKeys:   make(map[string]cachedProvingKey),
+		verifyingKeys: make(map[verifyingKeyID]cachedVerifyingKey),
+	}
+}
+
+// Handle reads a single JSON request from input, runs the named command
+// ("prove", "verify" or "derive") on it and writes the JSON result followed by
+// a newline to output. Invalid requests are reported in the result; an error
+// is only returned for an unknown command or if writing the result fails.
+func (t *Tool) Handle(command string, input io.Reader, output io.Writer) error {
+	var result interface{}
+	var request toybatch.CommandRequest
+	decodeErr := json.NewDecoder(input).Decode(&request)
+
+	t.mu.Lock()
+	defer t.mu.Unlock()
+	switch command {
+	case "prove":
+		if decodeErr != nil {
+			result = toybatch.CommandResult{Error: decodeErr.Error()}
+		} else {
+			result = t.Prove(request)
+		}
+	case "verify":
+		if decodeErr != nil {
+			result = toybatch.CommandResult{Error: decodeErr.Error()}
+		} else {
+			result = t.Verify(request)
+		}
+	case "derive":
+		if decodeErr != nil {
+			result = DeriveResult{Error: decodeErr.Error()}
+		} else {
+			result = t.Derive(request)
+		}
+	default:
+		return fmt.Errorf("unknown command %q", command)
+	}
+	return json.NewEncoder(output).Encode(result)
+}
+
+func (t *Tool) Prove(request toybatch.CommandRequest) toybatch.CommandResult {
+	switch request.ProfileName {
+	case toybatch.ProfileName:
+		return t.proveToyProfile(request)
+	default:
+		if realbatch.IsSupportedProfileName(request.ProfileName) {
+			return t.proveRealProfile(request)
+		}
+		return toybatch.CommandResult{Error: "unexpected profile name"}
+	}
+}
+
+func (t *Tool) Verify(request toybatch.CommandRequest) toybatch.CommandResult {
+	switch request.ProfileName {
+	case toybatch.ProfileName:
+		return t.verifyToyProfile(request)
+	default:
+		if realbatch.IsSupportedProfileName(request.ProfileName) {
+			return t.verifyRealProfile(request)
+		}
+		return toybatch.CommandResult{OK: false, Error: "unexpected profile name"}
+	}
+}
+
+func (t *Tool) Derive(request toybatch.CommandRequest) DeriveResult {
+	if !realbatch.IsSupportedProfileName(request.ProfileName) {
+		return DeriveResult{Error: "unexpected profile name"}
+	}
+	if err := realbatch.ValidateProofRequestContract(request); err != nil {
+		return DeriveResult{Error: err.Error()}
+	}
+
+	derived, err := realbatch.DeriveRequest(request)
+	if err != nil {
+		return DeriveResult{Error: err.Error()}
+	}
+
+	return DeriveResult{
+		OK:           true,
+		PublicInputs: &derived.PublicInputs,
+	}
+}
+
+func (t *Tool) proveToyProfile(request toybatch.CommandRequest) toybatch.CommandResult {
+	manifest, err := toybatch.ReadProfileManifest(request.ArtifactDir)
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+	if manifest.ProvingKeyFile == "" {
+		return toybatch.CommandResult{Error: "profile missing proving key file"}
+	}
+
+	fullAssignment, err := toybatch.BuildFullAssignment(request)
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	ccs, err := t.compiledCircuit(request.ProfileName)
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	pk, err := t.provingKey(filepath.Join(request.ArtifactDir, manifest.ProvingKeyFile))
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	witness, err := frontend.NewWitness(&fullAssignment, ecc.BLS12_381.ScalarField())
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	proof, err := groth16.Prove(ccs, pk, witness)
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	var proofBytes bytes.Buffer
+	if _, err := proof.WriteTo(&proofBytes); err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	return toybatch.CommandResult{
+		OK:            true,
+		ProofBytesHex: hex.EncodeToString(proofBytes.Bytes()),
+	}
+}
+
+func (t *Tool) proveRealProfile(request toybatch.CommandRequest) toybatch.CommandResult {
+	if err := realbatch.ValidateProofRequestContract(request); err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	derivedRequest, err := realbatch.DeriveRequest(request)
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+	if err := realbatch.ValidateDerivedRequest(request); err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	manifest, err := readRealProfileManifest(request.ArtifactDir, request.ProfileName)
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+	if manifest.ProvingKeyFile == "" {
+		return toybatch.CommandResult{Error: os.ErrInvalid.Error()}
+	}
+
+	assignment, err := realbatch.BuildAssignment(derivedRequest)
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	ccs, err := t.compiledCircuit(request.ProfileName)
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	pk, err := t.provingKey(filepath.Join(request.ArtifactDir, manifest.ProvingKeyFile))
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	witness, err := frontend.NewWitness(assignment, ecc.BLS12_381.ScalarField())
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	proof, err := groth16.Prove(ccs, pk, witness)
+	if err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	var proofBytes bytes.Buffer
+	if _, err := proof.WriteTo(&proofBytes); err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	var nativeProof groth16bls12381.Proof
+	if _, err := nativeProof.ReadFrom(bytes.NewReader(proofBytes.Bytes())); err != nil {
+		return toybatch.CommandResult{Error: err.Error()}
+	}
+
+	encoded, err := nativegroth16.EncodeProof(&nativeProof)
+	if err != nil {
+		panic(err)
+	}
+	return toybatch.CommandResult{
+		OK:            true,
+		ProofBytesHex: hex.EncodeToString(encoded),
+	}
+}
+
+func (t *Tool) verifyToyProfile(request toybatch.CommandRequest) toybatch.CommandResult {
+	manifest, err := toybatch.ReadProfileManifest(request.ArtifactDir)
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	publicAssignment, err := toybatch.BuildPublicAssignment(request)
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+	publicWitness, err := frontend.NewWitness(&publicAssignment, ecc.BLS12_381.ScalarField(), frontend.PublicOnly())
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	proofBytes, err := toybatch.DecodeProofHex(request.ProofBytesHex)
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	proof := groth16.NewProof(ecc.BLS12_381)
+	if _, err := proof.ReadFrom(bytes.NewReader(proofBytes)); err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	vk, err := t.verifyingKey(filepath.Join(request.ArtifactDir, manifest.VerifyingKeyFile), false)
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	if err := groth16.Verify(proof, vk, publicWitness); err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	return toybatch.CommandResult{OK: true}
+}
+
+func (t *Tool) verifyRealProfile(request toybatch.CommandRequest) toybatch.CommandResult {
+	manifest, err := readRealProfileManifest(request.ArtifactDir, request.ProfileName)
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+	if manifest.VerifyingKeyFile == "" {
+		return toybatch.CommandResult{OK: false, Error: os.ErrInvalid.Error()}
+	}
+
+	publicAssignment, err := realbatch.BuildPublicAssignment(request)
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+	publicWitness, err := frontend.NewWitness(publicAssignment, ecc.BLS12_381.ScalarField(), frontend.PublicOnly())
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	proofBytes, err := toybatch.DecodeProofHex(request.ProofBytesHex)
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+	proof, err := nativegroth16.DecodeProof(proofBytes)
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	vk, err := t.verifyingKey(filepath.Join(request.ArtifactDir, manifest.VerifyingKeyFile), true)
+	if err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	if err := groth16.Verify(proof, vk, publicWitness); err != nil {
+		return toybatch.CommandResult{OK: false, Error: err.Error()}
+	}
+
+	return toybatch.CommandResult{OK: true}
+}
+
+// compiledCircuit returns the constraint system for a profile, compiling it on
+// first use.
+func (t *Tool) compiledCircuit(profileName string) (constraint.ConstraintSystem, error) {
+	if ccs, ok := t.circuits[profileName]; ok {
+		return ccs, nil
+	}
+
+	var circuit frontend.Circuit
+	if profileName == toybatch.ProfileName {
+		circuit = &toybatch.ToyBatchTransitionCircuit{}
+	} else {
+		var err error
+		circuit, err = realbatch.NewCircuit(profileName)
+		if err != nil {
+			return nil, err
+		}
+	}
+	ccs, err := frontend.Compile(ecc.BLS12_381.ScalarField(), r1cs.NewBuilder, circuit)
+	if err != nil {
+		return nil, err
+	}
+	t.circuits[profileName] = ccs
+	return ccs, nil
+}
+
+// provingKey returns the gnark proving key stored at path, reading it again
+// only if the file has changed since it was last loaded.
+func (t *Tool) provingKey(path string) (groth16.ProvingKey, error) {
+	file, stamp, err := openKeyFile(path)
+	if err != nil {
+		return nil, err
+	}
+	defer file.Close()
+	if cached, ok := t.provingKeys[path]; ok && cached.stamp == stamp {
+		return cached.key, nil
+	}
+
+	pk := groth16.NewProvingKey(ecc.BLS12_381)
+	if _, err := pk.ReadFrom(file); err != nil {
+		return nil, err
+	}
+	t.provingKeys[path] = cachedProvingKey{stamp: stamp, key: pk}
+	return pk, nil
+}
+
+// verifyingKey returns the verifying key stored at path, in the node's native
+// encoding if native is set and in gnark's encoding otherwise, reading it
+// again only if the file has changed since it was last loaded.
+func (t *Tool) verifyingKey(path string, native bool) (groth16.VerifyingKey, error) {
+	file, stamp, err := openKeyFile(path)
+	if err != nil {
+		return nil, err
+	}
+	defer file.Close()
+	id := verifyingKeyID{path: path, native: native}
+	if cached, ok := t.verifyingKeys[id]; ok && cached.stamp == stamp {
+		return cached.key, nil
+	}
+
+	var vk groth16.VerifyingKey
+	if native {
+		vkBytes, err := io.ReadAll(file)
+		if err != nil {
+			return nil, err
+		}
+		vk, err = nativegroth16.DecodeVerificationKey(vkBytes)
+		if err != nil {
+			return nil, err
+		}
+	} else {
+		vk = groth16.NewVerifyingKey(ecc.BLS12_381)
+		if _, err := vk.ReadFrom(file); err != nil {
+			return nil, err
+		}
+	}
+	t.verifyingKeys[id] = cachedVerifyingKey{stamp: stamp, key: vk}
+	return vk, nil
+}
+
+func openKeyFile(path string) (*os.File, fileStamp, error) {
+	file, err := os.Open(path)
+	if err != nil {
+		return nil, fileStamp{}, err
+	}
+	info, err := file.Stat()
+	if err != nil {
+		file.Close()
+		return nil, fileStamp{}, err
+	}
+	return file, fileStamp{modTime: info.ModTime().UnixNano(), size: info.Size()}, nil
+}
+
+func readRealProfileManifest(artifactDir string, expectedProfileName string) (toybatch.ProfileManifest, error) {
+	var manifest toybatch.ProfileManifest
+	contents, err := os.ReadFile(filepath.Join(artifactDir, "profile.json"))
+	if err != nil {
+		return manifest, err
+	}
+	if err := json.Unmarshal(contents, &manifest); err != nil {
+		return manifest, err
+	}
+	if manifest.Name != expectedProfileName {
+		return manifest, os.ErrInvalid
+	}
+	return manifest, nil
+}
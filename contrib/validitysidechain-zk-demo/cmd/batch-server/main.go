@@ -0,0 +1,140 @@
+// Command batch-server serves prove, verify and derive requests over a Unix
+// socket, keeping compiled circuits and proving/verifying keys loaded between
+// requests. Each request is a single line of JSON:
+//
+//	{"command": "prove", "input": "<the JSON request prove-batch reads on stdin>"}
+//
+// and is answered with the line the corresponding one-shot command would have
+// written to stdout. {"command": "shutdown"} stops the server. run_tool.py
+// starts the server on demand.
+package main
+
+import (
+	"bufio"
+	"bytes"
+	"encoding/json"
+	"flag"
+	"fmt"
+	"net"
+	"os"
+	"strings"
+	"sync"
+	"time"
+
+	"github.com/allsagetech/litecoin-patched/contrib/validitysidechain-zk-demo/batchtool"
+	"github.com/rs/zerolog"
+)
+
+type serverRequest struct {
+	Command string `json:"command"`
+	Input   string `json:"input"`
+}
+
+type serverResult struct {
+	OK          bool   `json:"ok"`
+	ServerError string `json:"server_error,omitempty"`
+}
+
+type server struct {
+	tool     *batchtool.Tool
+	activity chan struct{}
+	shutdown chan struct{}
+	stopOnce sync.Once
+}
+
+func main() {
+	zerolog.SetGlobalLevel(zerolog.Disabled)
+
+	socketPath := flag.String("socket", "", "path of the Unix socket to listen on")
+	idleTimeout := flag.Duration("idle-timeout", 10*time.Minute, "exit after this long without a request")
+	flag.Parse()
+	if *socketPath == "" {
+		fmt.Fprintln(os.Stderr, "batch-server: -socket is required")
+		os.Exit(1)
+	}
+
+	// A socket file left behind by a server that did not exit cleanly would
+	// make Listen fail. run_tool.py only starts a server while holding a lock
+	// and after failing to connect, so it is safe to remove.
+	os.Remove(*socketPath)
+	listener, err := net.Listen("unix", *socketPath)
+	if err != nil {
+		fmt.Fprintln(os.Stderr, err)
+		os.Exit(1)
+	}
+	defer listener.Close()
+
+	s := &server{
+		tool:     batchtool.New(),
+		activity: make(chan struct{}, 1),
+		shutdown: make(chan struct{}),
+	}
+	go func() {
+		for {
+			conn, err := listener.Accept()
+			if err != nil {
+				return
+			}
+			go s.serve(conn)
+		}
+	}()
+
+	idle := time.NewTimer(*idleTimeout)
+	for {
+		select {
+		case <-s.activity:
+			if !idle.Stop() {
+				<-idle.C
+			}
+			idle.Reset(*idleTimeout)
+		case <-idle.C:
+			return
+		case <-s.shutdown:
+			return
+		}
+	}
+}
+
+func (s *server) touch() {
+	select {
+	case s.activity <- struct{}{}:
+	default:
+	}
+}
+
+func (s *server) serve(conn net.Conn) {
+	defer conn.Close()
+	reader := bufio.NewReader(conn)
+	encoder := json.NewEncoder(conn)
+	for {
+		line, err := reader.ReadBytes('\n')
+		if len(bytes.TrimSpace(line)) == 0 {
+			if err != nil {
+				return
+			}
+			continue
+		}
+		s.touch()
+
+		var request serverRequest
+		if err := json.Unmarshal(line, &request); err != nil {
+			encoder.Encode(serverResult{ServerError: err.Error()})
+			return
+		}
+		if request.Command == "shutdown" {
+			encoder.Encode(serverResult{OK: true})
+			s.stopOnce.Do(func() { close(s.shutdown) })
+			return
+		}
+
+		// Handle terminates the result with a newline, and JSON escapes any
+		// newlines inside it, so the reply is exactly one line.
+		var output bytes.Buffer
+		if err := s.tool.Handle(request.Command, strings.NewReader(request.Input), &output); err != nil {
+			encoder.Encode(serverResult{ServerError: err.Error()})
+		} else if _, err := conn.Write(output.Bytes()); err != nil {
+			return
+		}
+		s.touch()
+	}
+}
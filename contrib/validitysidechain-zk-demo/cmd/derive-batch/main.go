@@ -1,53 +1,16 @@
 package main
 
 import (
-	"encoding/json"
 	"os"
 
-	"github.com/allsagetech/litecoin-patched/contrib/validitysidechain-zk-demo/realbatch"
-	"github.com/allsagetech/litecoin-patched/contrib/validitysidechain-zk-demo/toybatch"
+	"github.com/allsagetech/litecoin-patched/contrib/validitysidechain-zk-demo/batchtool"
 	"github.com/rs/zerolog"
 )
 
-type deriveResult struct {
-	OK           bool                        `json:"ok"`
-	Error        string                      `json:"error,omitempty"`
-	PublicInputs *toybatch.BatchPublicInputs `json:"public_inputs,omitempty"`
-}
-
 func main() {
 	zerolog.SetGlobalLevel(zerolog.Disabled)
 
-	var request toybatch.CommandRequest
-	if err := json.NewDecoder(os.Stdin).Decode(&request); err != nil {
-		emit(deriveResult{Error: err.Error()})
-		return
-	}
-
-	if !realbatch.IsSupportedProfileName(request.ProfileName) {
-		emit(deriveResult{Error: "unexpected profile name"})
-		return
-	}
-	if err := realbatch.ValidateProofRequestContract(request); err != nil {
-		emit(deriveResult{Error: err.Error()})
-		return
-	}
-
-	derived, err := realbatch.DeriveRequest(request)
-	if err != nil {
-		emit(deriveResult{Error: err.Error()})
-		return
-	}
-
-	emit(deriveResult{
-		OK:           true,
-		PublicInputs: &derived.PublicInputs,
-	})
-}
-
-func emit(result deriveResult) {
-	encoder := json.NewEncoder(os.Stdout)
-	if err := encoder.Encode(result); err != nil {
+	if err := batchtool.New().Handle("derive", os.Stdin, os.Stdout); err != nil {
 		panic(err)
 	}
 }
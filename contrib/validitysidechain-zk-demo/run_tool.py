@@ -1,26 +1,39 @@
 #!/usr/bin/env python3
+"""Run a helper command on the JSON request read from stdin.
+
+Requests are forwarded to a batch-server daemon over a Unix socket, so the
+circuits and keys stay loaded between calls. The daemon is built and started
+on first use and exits by itself after being idle for a while; a rebuilt
+daemon is used automatically once any Go source changes. Set
+VALIDITY_ZK_DEMO_NO_DAEMON=1, or run on a platform without Unix sockets, to
+run `go run ./cmd/<tool>` for every call instead.
+"""
+import hashlib
+import json
 import os
+import socket
 import subprocess
 import sys
+import tempfile
+import time
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def main():
-    command_map = {
-        "prove": "prove-batch",
-        "verify": "verify-batch",
-        "derive": "derive-batch",
-    }
-    if len(sys.argv) != 2 or sys.argv[1] not in command_map:
-        print("usage: run_tool.py [prove|verify|derive]", file=sys.stderr)
-        return 1
+COMMAND_MAP = {
+    "prove": "prove-batch",
+    "verify": "verify-batch",
+    "derive": "derive-batch",
+}
+DAEMON_START_TIMEOUT = 60
 
-    script_dir = Path(__file__).resolve().parent
-    command = ["go", "run", f"./cmd/{command_map[sys.argv[1]]}"]
-    request = sys.stdin.buffer.read()
 
+def run_once(script_dir, command, request):
     completed = subprocess.run(
-        command,
+        ["go", "run", f"./cmd/{COMMAND_MAP[command]}"],
         cwd=script_dir,
         input=request,
         stdout=subprocess.PIPE,
@@ -36,5 +49,118 @@ def main():
     return completed.returncode
 
 
+def source_fingerprint(script_dir):
+    """Identify the daemon build by the Go sources it is built from."""
+    fingerprint = hashlib.sha256()
+    for root, dirs, files in os.walk(script_dir):
+        dirs[:] = sorted(d for d in dirs if d != "generated")
+        for name in sorted(files):
+            if name.endswith(".go") or name in ("go.mod", "go.sum"):
+                stat = os.stat(os.path.join(root, name))
+                fingerprint.update(f"{os.path.relpath(os.path.join(root, name), script_dir)}:{stat.st_mtime_ns}:{stat.st_size}\n".encode())
+    return fingerprint.hexdigest()[:16]
+
+
+def daemon_socket_path(script_dir):
+    if os.environ.get("VALIDITY_ZK_DEMO_SOCKET"):
+        return os.environ["VALIDITY_ZK_DEMO_SOCKET"]
+    return os.path.join(tempfile.gettempdir(), f"litecoin-zk-demo-{os.getuid()}-{source_fingerprint(script_dir)}.sock")
+
+
+def connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def start_daemon(script_dir, socket_path):
+    """Build and start the daemon unless another process already did, and connect to it."""
+    with open(socket_path + ".lock", "wb") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        sock = connect(socket_path)
+        if sock is not None:
+            return sock
+
+        binary = socket_path + ".bin"
+        build = subprocess.run(
+            ["go", "build", "-o", binary, "./cmd/batch-server"],
+            cwd=script_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+        if build.returncode != 0:
+            raise RuntimeError("go build ./cmd/batch-server failed")
+        with open(socket_path + ".log", "ab") as log_file:
+            daemon = subprocess.Popen(
+                [binary, "-socket", socket_path],
+                cwd=script_dir,
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=log_file,
+                start_new_session=True,
+            )
+
+        deadline = time.time() + DAEMON_START_TIMEOUT
+        while time.time() < deadline:
+            sock = connect(socket_path)
+            if sock is not None:
+                return sock
+            if daemon.poll() is not None:
+                break
+            time.sleep(0.05)
+        raise RuntimeError(f"batch-server did not start, see {socket_path}.log")
+
+
+def call_daemon(sock, command, request=b""):
+    with sock, sock.makefile("rb") as replies:
+        message = {"command": command, "input": request.decode("utf-8", errors="replace")}
+        sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        reply = replies.readline()
+    if not reply:
+        raise RuntimeError("batch-server closed the connection")
+    server_error = json.loads(reply).get("server_error")
+    if server_error:
+        raise RuntimeError(server_error)
+    return reply
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in list(COMMAND_MAP) + ["shutdown"]:
+        print("usage: run_tool.py [prove|verify|derive|shutdown]", file=sys.stderr)
+        return 1
+
+    script_dir = Path(__file__).resolve().parent
+    command = sys.argv[1]
+    use_daemon = hasattr(socket, "AF_UNIX") and fcntl is not None and not os.environ.get("VALIDITY_ZK_DEMO_NO_DAEMON")
+    if command == "shutdown":
+        # Stops the daemon for the current sources, if it is running.
+        sock = connect(daemon_socket_path(script_dir)) if use_daemon else None
+        if sock is not None:
+            call_daemon(sock, command)
+        return 0
+
+    request = sys.stdin.buffer.read()
+    if not use_daemon:
+        return run_once(script_dir, command, request)
+
+    socket_path = daemon_socket_path(script_dir)
+    try:
+        sock = connect(socket_path) or start_daemon(script_dir, socket_path)
+        reply = call_daemon(sock, command, request)
+    except (OSError, RuntimeError) as e:
+        # Fall back to the one-shot command, which also reproduces any build
+        # errors on stderr.
+        print(f"run_tool.py: batch-server unavailable ({e}), running {COMMAND_MAP[command]} directly", file=sys.stderr)
+        return run_once(script_dir, command, request)
+
+    sys.stdout.buffer.write(reply)
+    return 0
+
+
 if __name__ == "__main__":
     raise SystemExit(main())
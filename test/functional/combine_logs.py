@@ -10,6 +10,8 @@ to write to an outputfile.
 If no argument is provided, the most recent test directory will be used."""
 
 import argparse
+import bisect
+import io
 from collections import defaultdict, namedtuple
 import heapq
 import itertools
@@ -18,6 +20,8 @@ import pathlib
 import re
 import sys
 import tempfile
+import unittest
+from unittest import mock
 
 # N.B.: don't import any local modules here - this script must remain executable
 # without the parent module installed.
@@ -27,9 +31,18 @@ TMPDIR_PREFIX = "litecoin_func_test_"
 
 # Matches on the date format at the start of the log event
 TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{6})?Z")
+# Matches on the start of any log event in a block of text
+EVENT_START_PATTERN = re.compile(TIMESTAMP_PATTERN.pattern, re.MULTILINE)
 
 LogEvent = namedtuple('LogEvent', ['timestamp', 'source', 'event'])
 
+# Continuation lines are indented by the width of the source and timestamp
+CONTINUATION_INDENT = " " * 35
+# Size of each read from a log file
+READ_CHUNK_SIZE = 1 << 20
+# Distance between the entries of the sparse timestamp index of a log file
+INDEX_STRIDE = 1 << 22
+
 def main():
     """Main function. Parses args, reads the log files and renders them as text or html."""
     parser = argparse.ArgumentParser(
@@ -40,6 +53,9 @@ def main():
               'Defaults to the most recent'))
     parser.add_argument('-c', '--color', dest='color', action='store_true', help='outputs the combined log with events colored by source (requires posix terminal colors. Use less -r for viewing)')
     parser.add_argument('--html', dest='html', action='store_true', help='outputs the combined log as html. Requires jinja2. pip install jinja2')
+    parser.add_argument('--since', help='only output events at or after this time, e.g. 2021-01-01T12:00:00')
+    parser.add_argument('--until', help='only output events before this time')
+    parser.add_argument('--sources', help='comma-separated list of the logs to combine, e.g. test,node0,node2. Defaults to all')
     args = parser.parse_args()
 
     if args.html and args.color:
@@ -64,7 +80,8 @@ def main():
         colors["node3"] = "\033[0;33m"  # YELLOW
         colors["reset"] = "\033[0m"  # Reset font color
 
-    log_events = read_logs(testdir)
+    sources = args.sources.split(',') if args.sources else None
+    log_events = read_logs(testdir, sources, args.since, args.until)
 
     if args.html:
         print_logs_html(log_events)
@@ -73,11 +90,12 @@ def main():
         print_node_warnings(testdir, colors)
 
 
-def read_logs(tmp_dir):
+def read_logs(tmp_dir, sources=None, since=None, until=None):
     """Reads log files.
 
     Delegates to generator function get_log_events() to provide individual log events
-    for each of the input log files."""
+    for each of the input log files. Only the logs in sources are read, if given,
+    and only the events from since until (excluding) until, if given."""
 
     # Find out what the folder is called that holds the debug.log file
     glob = pathlib.Path(tmp_dir).glob('node0/**/debug.log')
@@ -95,7 +113,10 @@ def read_logs(tmp_dir):
             break
         files.append(("node%d" % i, logfile))
 
-    return heapq.merge(*[get_log_events(source, f) for source, f in files])
+    if sources is not None:
+        files = [(source, f) for source, f in files if source in sources]
+
+    return heapq.merge(*[get_log_events(source, f, since, until) for source, f in files])
 
 
 def print_node_warnings(tmp_dir, colors):
@@ -140,61 +161,168 @@ def find_latest_test_dir():
     return max(testdir_paths, key=os.path.getmtime) if testdir_paths else None
 
 
-def get_log_events(source, logfile):
+def get_log_events(source, logfile, since=None, until=None):
     """Generator function that returns individual log events.
 
     Log events may be split over multiple lines. We use the timestamp
-    regex match as the marker for a new log event."""
+    regex match as the marker for a new log event. The file is read in large
+    chunks, and the sparse index from build_log_index() is used to skip
+    directly to the events at or after since."""
     try:
-        with open(logfile, 'r', encoding='utf-8') as infile:
-            event = ''
-            timestamp = ''
-            for line in infile:
-                # skip blank lines
-                if line == '\n':
-                    continue
-                # if this line has a timestamp, it's the start of a new log event.
-                time_match = TIMESTAMP_PATTERN.match(line)
-                if time_match:
-                    if event:
-                        yield LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
-                    timestamp = time_match.group()
-                    if time_match.group(1) is None:
-                        # timestamp does not have microseconds. Add zeroes.
-                        timestamp_micro = timestamp.replace("Z", ".000000Z")
-                        line = line.replace(timestamp, timestamp_micro)
-                        timestamp = timestamp_micro
-                    event = line
-                # if it doesn't have a timestamp, it's a continuation line of the previous log.
-                else:
-                    # Add the line. Prefix with space equivalent to the source + timestamp so log lines are aligned
-                    event += "                                   " + line
-            # Flush the final event
-            yield LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
+        infile = open(logfile, 'rb')
     except FileNotFoundError:
         print("File %s could not be opened. Continuing without it." % logfile, file=sys.stderr)
+        return
+    with infile:
+        if since:
+            index = build_log_index(infile)
+            i = bisect.bisect_left([timestamp for timestamp, _ in index], since) - 1
+            infile.seek(index[i][1] if i >= 0 else 0)
+        # Like a file opened in text mode, translate \r\n line endings
+        text = io.TextIOWrapper(infile, encoding='utf-8', errors='replace', newline=None)
+        buf = ''
+        while True:
+            chunk = text.read(READ_CHUNK_SIZE)
+            # Only the lines that were incomplete before may now start an event
+            scan_from = buf.rfind('\n') + 1
+            buf += chunk
+            event_start = 0
+            for match in EVENT_START_PATTERN.finditer(buf, scan_from):
+                if match.start() == 0:
+                    continue
+                event = make_log_event(source, buf[event_start:match.start()])
+                event_start = match.start()
+                # Skip blank lines before the first event, which every
+                # debug.log starts with
+                if not event.event:
+                    continue
+                if since and event.timestamp < since:
+                    continue
+                if until and event.timestamp >= until:
+                    return
+                yield event
+            buf = buf[event_start:]
+            if not chunk:
+                break
+        # Flush the final event
+        event = make_log_event(source, buf)
+        if event.event and not (since and event.timestamp < since) and not (until and event.timestamp >= until):
+            yield event
+
+
+def make_log_event(source, text):
+    """Turns the text of one event into a LogEvent."""
+    time_match = TIMESTAMP_PATTERN.match(text)
+    timestamp = ''
+    if time_match:
+        timestamp = time_match.group()
+        if time_match.group(1) is None:
+            # timestamp does not have microseconds. Add zeroes.
+            timestamp = timestamp.replace("Z", ".000000Z")
+            first_line, newline, rest = text.partition('\n')
+            text = first_line.replace(time_match.group(), timestamp) + newline + rest
+    if '\n' not in text.rstrip('\n') and time_match:
+        return LogEvent(timestamp=timestamp, source=source, event=text.rstrip())
+    # Skip blank lines, and prefix continuation lines with space equivalent to
+    # the source + timestamp so log lines are aligned
+    lines = [line for line in text.split('\n') if line]
+    if time_match:
+        event = lines[0] + '\n' + ''.join(CONTINUATION_INDENT + line + '\n' for line in lines[1:])
+    else:
+        event = ''.join(CONTINUATION_INDENT + line + '\n' for line in lines)
+    return LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
+
+
+def build_log_index(infile, stride=INDEX_STRIDE):
+    """Returns a sparse index of a log file.
+
+    The index is a list of (timestamp, offset) pairs, one for the first event
+    starting after each multiple of stride bytes, ordered by offset. Log files
+    are written in time order, so the index is ordered by timestamp too."""
+    index = []
+    size = os.fstat(infile.fileno()).st_size
+    for offset in range(0, size, stride):
+        infile.seek(offset)
+        if offset:
+            infile.readline()  # skip the partial line
+        while True:
+            line_offset = infile.tell()
+            line = infile.readline()
+            if not line or line_offset >= offset + stride:
+                break
+            time_match = TIMESTAMP_PATTERN.match(line.decode('utf-8', errors='replace'))
+            if time_match:
+                timestamp = time_match.group()
+                if time_match.group(1) is None:
+                    timestamp = timestamp.replace("Z", ".000000Z")
+                index.append((timestamp, line_offset))
+                break
+    return index
 
 
 def print_logs_plain(log_events, colors):
     """Renders the iterator of log events into text."""
+    write = sys.stdout.write
     for event in log_events:
+        color = colors[event.source.rstrip()]
         lines = event.event.splitlines()
-        print("{0} {1: <5} {2} {3}".format(colors[event.source.rstrip()], event.source, lines[0], colors["reset"]))
-        if len(lines) > 1:
-            for line in lines[1:]:
-                print("{0}{1}{2}".format(colors[event.source.rstrip()], line, colors["reset"]))
+        write("{0} {1: <5} {2} {3}\n".format(color, event.source, lines[0], colors["reset"]))
+        for line in lines[1:]:
+            write("{0}{1}{2}\n".format(color, line, colors["reset"]))
 
 
 def print_logs_html(log_events):
-    """Renders the iterator of log events into html."""
+    """Renders the iterator of log events into html.
+
+    The page is written out as it is rendered, so the events are never all
+    held in memory at once."""
     try:
         import jinja2
     except ImportError:
         print("jinja2 not found. Try `pip install jinja2`")
         sys.exit(1)
-    print(jinja2.Environment(loader=jinja2.FileSystemLoader('./'))
-                    .get_template('combined_log_template.html')
-                    .render(title="Combined Logs from testcase", log_events=[event._asdict() for event in log_events]))
+    template = (jinja2.Environment(loader=jinja2.FileSystemLoader('./'))
+                    .get_template('combined_log_template.html'))
+    for chunk in template.generate(title="Combined Logs from testcase", log_events=(event._asdict() for event in log_events)):
+        sys.stdout.write(chunk)
+
+
+class TestCombineLogs(unittest.TestCase):
+    def write_logs(self, tmp_dir):
+        os.makedirs(os.path.join(tmp_dir, "node0", "regtest"))
+        os.makedirs(os.path.join(tmp_dir, "node1", "regtest"))
+        with open(os.path.join(tmp_dir, "test_framework.log"), "wb") as f:
+            f.write(b"2021-01-01T00:00:00.000001Z TestFramework (INFO): start\r\n"
+                    b"2021-01-01T00:00:00.000004Z TestFramework (ERROR): failed\r\n"
+                    b"Traceback (most recent call last):\r\n"
+                    b"  File \"test.py\"\r\n")
+        # debug.log always starts with blank lines, see src/logging.cpp
+        with open(os.path.join(tmp_dir, "node0", "regtest", "debug.log"), "wb") as f:
+            f.write(b"\n\n\n\n\n2021-01-01T00:00:00.000002Z Litecoin Core version\n")
+        with open(os.path.join(tmp_dir, "node1", "regtest", "debug.log"), "wb") as f:
+            f.write(b"\n\n\n\n\n2021-01-01T00:00:00Z init message: Done loading\n\n")
+
+    def test_read_logs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.write_logs(tmp_dir)
+            for chunk_size in (READ_CHUNK_SIZE, 7):
+                with mock.patch(__name__ + ".READ_CHUNK_SIZE", chunk_size):
+                    events = list(read_logs(tmp_dir))
+                self.assertEqual([(event.source, event.timestamp) for event in events], [
+                    ("node1", "2021-01-01T00:00:00.000000Z"),
+                    ("test", "2021-01-01T00:00:00.000001Z"),
+                    ("node0", "2021-01-01T00:00:00.000002Z"),
+                    ("test", "2021-01-01T00:00:00.000004Z"),
+                ])
+                self.assertNotIn("\r", "".join(event.event for event in events))
+                self.assertEqual(events[3].event.splitlines()[1:], [
+                    CONTINUATION_INDENT + "Traceback (most recent call last):",
+                    CONTINUATION_INDENT + '  File "test.py"',
+                ])
+            output = io.StringIO()
+            with mock.patch("sys.stdout", output):
+                print_logs_plain(read_logs(tmp_dir), defaultdict(str))
+            self.assertEqual(len(output.getvalue().splitlines()), 6)
 
 
 if __name__ == '__main__':
@@ -20,7 +20,8 @@ from test_framework.util import assert_equal, mine_large_block
 
 class TestP2PConn(P2PInterface):
     def __init__(self):
-        super().__init__()
+        # Only the hashes of the many large blocks received are needed.
+        super().__init__(lazy_messages=True)
         self.block_receive_map = defaultdict(int)
 
     def on_inv(self, message):
@@ -66,6 +66,7 @@ from test_framework.script import (
     OP_RETURN,
     OP_SWAP,
     OP_VERIFY,
+    PrecomputedTransactionData,
     SIGHASH_DEFAULT,
     SIGHASH_ALL,
     SIGHASH_NONE,
@@ -195,6 +196,7 @@ def default_sighash(ctx):
     idx = get(ctx, "idx")
     hashtype = get(ctx, "hashtype_actual")
     mode = get(ctx, "mode")
+    txdata = get(ctx, "txdata")
     if mode == "taproot":
         # BIP341 signature hash
         utxos = get(ctx, "utxos")
@@ -203,18 +205,18 @@ def default_sighash(ctx):
             codeseppos = get(ctx, "codeseppos")
             leaf_ver = get(ctx, "leafversion")
             script = get(ctx, "script_taproot")
-            return TaprootSignatureHash(tx, utxos, hashtype, idx, scriptpath=True, script=script, leaf_ver=leaf_ver, codeseparator_pos=codeseppos, annex=annex)
+            return TaprootSignatureHash(tx, utxos, hashtype, idx, scriptpath=True, script=script, leaf_ver=leaf_ver, codeseparator_pos=codeseppos, annex=annex, txdata=txdata)
         else:
-            return TaprootSignatureHash(tx, utxos, hashtype, idx, scriptpath=False, annex=annex)
+            return TaprootSignatureHash(tx, utxos, hashtype, idx, scriptpath=False, annex=annex, txdata=txdata)
     elif mode == "witv0":
         # BIP143 signature hash
         scriptcode = get(ctx, "scriptcode")
         utxos = get(ctx, "utxos")
-        return SegwitV0SignatureHash(scriptcode, tx, idx, hashtype, utxos[idx].nValue)
+        return SegwitV0SignatureHash(scriptcode, tx, idx, hashtype, utxos[idx].nValue, txdata)
     else:
         # Pre-segwit signature hash
         scriptcode = get(ctx, "scriptcode")
-        return LegacySignatureHash(scriptcode, tx, idx, hashtype)[0]
+        return LegacySignatureHash(scriptcode, tx, idx, hashtype, txdata)[0]
 
 def default_tweak(ctx):
     """Default expression for "tweak": None if a leaf is specified, tap[0] otherwise."""
@@ -371,6 +373,8 @@ DEFAULT_CONTEXT = {
     "leaf": None,
     # The input arguments to provide to the executed script
     "inputs": [],
+    # The PrecomputedTransactionData for tx and utxos (None to compute sighashes from scratch).
+    "txdata": None,
 
     # == Parameters to be set before evaluation: ==
     # - mode: what spending style to use ("taproot", "witv0", or "legacy").
@@ -498,12 +502,12 @@ def make_spender(comment, *, tap=None, witv0=False, script=None, pkh=None, p2sh=
 
     conf = {**conf, **kwargs}
 
-    def sat_fn(tx, idx, utxos, valid):
+    def sat_fn(tx, idx, utxos, valid, txdata=None):
         if valid:
-            return spend(tx, idx, utxos, **conf)
+            return spend(tx, idx, utxos, txdata=txdata, **conf)
         else:
             assert failure is not None
-            return spend(tx, idx, utxos, **{**conf, **failure})
+            return spend(tx, idx, utxos, txdata=txdata, **{**conf, **failure})
 
     return Spender(script=spk, comment=comment, is_standard=standard, sat_function=sat_fn, err_msg=err_msg, sigops_weight=sigops_weight, no_fail=failure is None, need_vin_vout_mismatch=need_vin_vout_mismatch)
 
@@ -1394,12 +1398,14 @@ class TaprootTest(BitcoinTestFramework):
 
             # Precompute one satisfying and one failing scriptSig/witness for each input.
             input_data = []
+            spent_utxos = [utxo.output for utxo in input_utxos]
+            txdata = PrecomputedTransactionData(tx, spent_utxos)
             for i in range(len(input_utxos)):
                 fn = input_utxos[i].spender.sat_function
                 fail = None
-                success = fn(tx, i, [utxo.output for utxo in input_utxos], True)
+                success = fn(tx, i, spent_utxos, True, txdata)
                 if not input_utxos[i].spender.no_fail:
-                    fail = fn(tx, i, [utxo.output for utxo in input_utxos], False)
+                    fail = fn(tx, i, spent_utxos, False, txdata)
                 input_data.append((fail, success))
                 if self.options.dump_tests:
                     dump_json_test(tx, input_utxos, i, success, fail)
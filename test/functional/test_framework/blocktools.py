@@ -29,6 +29,7 @@ from .messages import (
     hex_str_to_bytes,
     ser_uint256,
     sha256,
+    uint256_from_compact,
     uint256_from_str,
 )
 from .script import (
@@ -250,3 +251,34 @@ class TestFrameworkBlockTools(unittest.TestCase):
         height = 20
         coinbase_tx = create_coinbase(height=height)
         assert_equal(CScriptNum.decode(coinbase_tx.vin[0].scriptSig), height)
+
+    def test_solve(self):
+        block = create_block(hashprev=0x1234, coinbase=create_coinbase(height=1), ntime=1600000000)
+        block.nBits = 0x1f0fffff  # target about 2^244, so about 4096 attempts per block
+        block.solve()
+        target = uint256_from_compact(block.nBits)
+        assert block.scrypt256 <= target
+        nonce = block.nNonce
+        for n in range(nonce):
+            block.nNonce = n
+            block.rehash()
+            assert block.scrypt256 > target
+        block.nNonce = nonce
+        block.rehash()
+        block.solve()
+        assert_equal(block.nNonce, nonce)
+
+    def test_tx_memo_invalidation(self):
+        tx = create_coinbase(height=20)
+        tx.wit.vtxinwit = [CTxInWitness()]
+        tx.rehash()
+        txid, wtxid = tx.sha256, tx.calc_sha256(True)
+        tx.vin[0].scriptSig = CScript([OP_TRUE])
+        tx.vout.append(CTxOut(1, b"\x51"))
+        tx.wit.vtxinwit[0].scriptWitness.stack.append(b"\x01")
+        for t in [tx, CTransaction(tx)]:
+            assert_equal(t.serialize_with_witness(), t._serialize_with_witness())
+            assert_equal(t.serialize_without_witness(), t._serialize_without_witness())
+            assert t.calc_sha256(True) != wtxid
+            t.rehash()
+            assert t.sha256 != txid
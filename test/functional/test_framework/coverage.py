@@ -36,7 +36,10 @@ class AuthServiceProxyWrapper():
         if not isinstance(return_val, type(self.auth_service_proxy_instance)):
             # If proxy getattr returned an unwrapped value, do the same here.
             return return_val
-        return AuthServiceProxyWrapper(return_val, self.coverage_logfile)
+        # The proxy caches its method proxies, so cache their wrappers too
+        wrapper = AuthServiceProxyWrapper(return_val, self.coverage_logfile)
+        self.__dict__[name] = wrapper
+        return wrapper
 
     def __call__(self, *args, **kwargs):
         """
@@ -63,12 +63,40 @@ def modsqrt(a, p):
         return sqrt
     return None
 
+def wnaf(n, w):
+    """Compute the width-w non-adjacent form of a non-negative integer n.
+
+    Returns the list of digits, least significant first. Every nonzero digit
+    is odd and in (-2**(w-1), 2**(w-1)), and any w consecutive digits contain
+    at most one nonzero digit."""
+    digits = []
+    while n:
+        if n & 1:
+            d = n & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            n -= d
+        else:
+            d = 0
+        digits.append(d)
+        n >>= 1
+    return digits
+
 class EllipticCurve:
+    # Window size for the wNAF representation of variable-base scalars.
+    WNAF_WINDOW = 5
+    # Window size (in bits) of the precomputed tables for fixed bases.
+    FIXED_BASE_WINDOW = 8
+    FIXED_BASE_BITS = 256
+
     def __init__(self, p, a, b):
         """Initialize elliptic curve y^2 = x^3 + a*x + b over GF(p)."""
         self.p = p
         self.a = a % p
         self.b = b % p
+        # Precomputed multiples of the points registered with add_fixed_base,
+        # built on first use.
+        self.fixed_bases = {}
 
     def affine(self, p1):
         """Convert a Jacobian point tuple p1 to affine form, or None if at infinity.
@@ -202,17 +230,101 @@ class EllipticCurve:
         z3 = (h*z1*z2) % self.p
         return (x3, y3, z3)
 
+    def affine_batch(self, points):
+        """Convert a list of Jacobian tuples (none at infinity) to affine form.
+
+        Uses Montgomery's trick to need a single modular inversion."""
+        prefix = []
+        acc = 1
+        for (_, _, z) in points:
+            prefix.append(acc)
+            acc = (acc * z) % self.p
+        inv = modinv(acc, self.p)
+        ret = [None] * len(points)
+        for i in range(len(points) - 1, -1, -1):
+            x, y, z = points[i]
+            inv_z = (inv * prefix[i]) % self.p
+            inv = (inv * z) % self.p
+            inv_z2 = (inv_z**2) % self.p
+            ret[i] = ((x * inv_z2) % self.p, (y * inv_z2 * inv_z) % self.p, 1)
+        return ret
+
+    def add_fixed_base(self, p1):
+        """Register p1 as a point that is often multiplied, like a generator.
+
+        mul() uses a table of precomputed multiples of p1 for it, which is
+        built the first time it is needed."""
+        self.fixed_bases[p1] = None
+
+    def _fixed_base_table(self, p1):
+        """Build the table of i * 2**(w*j) * p1 (i < 2**w) for all windows j."""
+        w = self.FIXED_BASE_WINDOW
+        points = []
+        base = p1
+        for _ in range((self.FIXED_BASE_BITS + w - 1) // w):
+            multiple = base
+            for _ in range((1 << w) - 1):
+                points.append(multiple)
+                multiple = self.add(multiple, base)
+            base = multiple
+        points = self.affine_batch(points)
+        size = (1 << w) - 1
+        return [points[i:i + size] for i in range(0, len(points), size)]
+
+    def _odd_multiples(self, p1):
+        """Return the Jacobian points p1, 3*p1, 5*p1, ... used for wNAF digits."""
+        points = [p1]
+        p1_2 = self.double(p1)
+        for _ in range((1 << (self.WNAF_WINDOW - 2)) - 1):
+            points.append(self.add(points[-1], p1_2))
+        return points
+
     def mul(self, ps):
         """Compute a (multi) point multiplication
 
         ps is a list of (Jacobian tuple, scalar) pairs.
-        """
+
+        Multiples of points registered with add_fixed_base are looked up in
+        their precomputed table, without any doublings. The remaining points
+        are multiplied together using Strauss' algorithm over wNAF scalars:
+        one shared chain of doublings, and additions of precomputed odd
+        multiples."""
         r = (0, 1, 0)
-        for i in range(255, -1, -1):
-            r = self.double(r)
-            for (p, n) in ps:
-                if ((n >> i) & 1):
-                    r = self.add(r, p)
+        variable = []
+        for (p, n) in ps:
+            if n == 0 or p[2] == 0:
+                continue
+            if p in self.fixed_bases and n >> self.FIXED_BASE_BITS == 0:
+                table = self.fixed_bases[p]
+                if table is None:
+                    table = self.fixed_bases[p] = self._fixed_base_table(p)
+                w = self.FIXED_BASE_WINDOW
+                mask = (1 << w) - 1
+                for window in table:
+                    if n & mask:
+                        r = self.add_mixed(r, window[(n & mask) - 1])
+                    n >>= w
+                    if n == 0:
+                        break
+            else:
+                variable.append((p, wnaf(n, self.WNAF_WINDOW)))
+        if variable:
+            # Convert the odd multiples of all points to affine at once.
+            count = 1 << (self.WNAF_WINDOW - 2)
+            multiples = self.affine_batch([m for (p, _) in variable for m in self._odd_multiples(p)])
+            variable = [(multiples[i * count:(i + 1) * count], digits) for i, (_, digits) in enumerate(variable)]
+            acc = (0, 1, 0)
+            for i in range(max(len(digits) for (_, digits) in variable) - 1, -1, -1):
+                acc = self.double(acc)
+                for (multiples, digits) in variable:
+                    if i < len(digits) and digits[i]:
+                        d = digits[i]
+                        if d > 0:
+                            acc = self.add_mixed(acc, multiples[d >> 1])
+                        else:
+                            x, y, _ = multiples[(-d) >> 1]
+                            acc = self.add_mixed(acc, (x, self.p - y, 1))
+            r = self.add(r, acc)
         return r
 
 SECP256K1_FIELD_SIZE = 2**256 - 2**32 - 977
@@ -220,6 +332,7 @@ SECP256K1 = EllipticCurve(SECP256K1_FIELD_SIZE, 0, 7)
 SECP256K1_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798, 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8, 1)
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+SECP256K1.add_fixed_base(SECP256K1_G)
 
 class ECPubKey():
     """A secp256k1 public key"""
@@ -476,6 +589,62 @@ def verify_schnorr(key, sig, msg):
         return False
     return True
 
+def verify_schnorr_batch(items):
+    """Verify a batch of Schnorr signatures (see BIP 340, "Batch Verification").
+
+    - items is an iterable of (key, sig, msg) tuples, with the same formats as
+      the arguments of verify_schnorr.
+
+    All signatures that parse are checked at once with a random linear
+    combination and a single multi-scalar multiplication. If that check
+    fails, they are verified one by one to find the invalid ones.
+
+    Returns a list with the verification result of each item.
+    """
+    items = list(items)
+    results = [False] * len(items)
+    batch = []
+    terms = []
+    s_sum = 0
+    for i, (key, sig, msg) in enumerate(items):
+        assert len(key) == 32
+        assert len(msg) == 32
+        assert len(sig) == 64
+
+        x_coord = int.from_bytes(key, 'big')
+        if x_coord == 0 or x_coord >= SECP256K1_FIELD_SIZE:
+            continue
+        P = SECP256K1.lift_x(x_coord)
+        if P is None:
+            continue
+        r = int.from_bytes(sig[0:32], 'big')
+        if r >= SECP256K1_FIELD_SIZE:
+            continue
+        R = SECP256K1.lift_x(r)
+        if R is None:
+            continue
+        s = int.from_bytes(sig[32:64], 'big')
+        if s >= SECP256K1_ORDER:
+            continue
+        e = int.from_bytes(TaggedHash("BIP0340/challenge", sig[0:32] + key + msg), 'big') % SECP256K1_ORDER
+        # The first signature gets weight 1, the others a random weight.
+        a = random.randrange(1, SECP256K1_ORDER) if batch else 1
+        s_sum += a * s
+        terms.append((R, SECP256K1_ORDER - a))
+        terms.append((P, (SECP256K1_ORDER - a * e) % SECP256K1_ORDER))
+        batch.append(i)
+
+    if not batch:
+        return results
+    # (a_1*s_1 + ... + a_u*s_u)*G - (a_1*R_1 + ... + a_u*R_u) - (a_1*e_1*P_1 + ... + a_u*e_u*P_u) must be infinity.
+    if SECP256K1.mul([(SECP256K1_G, s_sum % SECP256K1_ORDER)] + terms)[2] == 0:
+        for i in batch:
+            results[i] = True
+    else:
+        for i in batch:
+            results[i] = verify_schnorr(*items[i])
+    return results
+
 def sign_schnorr(key, msg, aux=None, flip_p=False, flip_r=False):
     """Create a Schnorr signature (see BIP 340)."""
 
@@ -501,6 +670,24 @@ def sign_schnorr(key, msg, aux=None, flip_p=False, flip_r=False):
     return R[0].to_bytes(32, 'big') + ((k + e * sec) % SECP256K1_ORDER).to_bytes(32, 'big')
 
 class TestFrameworkKey(unittest.TestCase):
+    def test_mul(self):
+        """Compare EllipticCurve.mul against plain double-and-add."""
+        def mul_reference(ps):
+            r = (0, 1, 0)
+            for i in range(max(n.bit_length() for (_, n) in ps) - 1, -1, -1):
+                r = SECP256K1.double(r)
+                for (p, n) in ps:
+                    if (n >> i) & 1:
+                        r = SECP256K1.add(r, p)
+            return SECP256K1.affine(r)
+
+        P = SECP256K1.mul([(SECP256K1_G, random.randrange(1, SECP256K1_ORDER))])  # Jacobian
+        Q = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, random.randrange(1, SECP256K1_ORDER))]))
+        scalars = [0, 1, 2, 3, 255, 256, SECP256K1_ORDER - 1, SECP256K1_ORDER, 2**256 - 1] + [random.getrandbits(256) for _ in range(4)]
+        for n in scalars:
+            for ps in [[(SECP256K1_G, n)], [(P, n)], [(SECP256K1_G, n), (P, n ^ 0x55)], [(P, n), (Q, n + 7), (SECP256K1_G, 3)], [(P, n), (SECP256K1.negate(P), n)]]:
+                self.assertEqual(SECP256K1.affine(SECP256K1.mul(ps)), mul_reference(ps))
+
     def test_schnorr(self):
         """Test the Python Schnorr implementation."""
         byte_arrays = [generate_privkey() for _ in range(3)] + [v.to_bytes(32, 'big') for v in [0, SECP256K1_ORDER - 1, SECP256K1_ORDER, 2**256 - 1]]
@@ -520,9 +707,29 @@ class TestFrameworkKey(unittest.TestCase):
                         sig = bytes(sig)
                     self.assertFalse(verify_schnorr(verify_pubkey, sig, msg))
 
+    def test_schnorr_batch(self):
+        """Test batch verification against single verification."""
+        keys = [generate_privkey() for _ in range(3)]
+        items = []
+        for i in range(12):
+            key = keys[i % len(keys)]
+            msg = random.getrandbits(256).to_bytes(32, 'big')
+            items.append((compute_xonly_pubkey(key)[0], sign_schnorr(key, msg), msg))
+        self.assertEqual(verify_schnorr_batch(items), [True] * len(items))
+        self.assertEqual(verify_schnorr_batch([]), [])
+        for bad in [0, 5, 11]:
+            damaged = list(items)
+            key, sig, msg = damaged[bad]
+            sig = list(sig)
+            sig[random.randrange(64)] ^= (1 << (random.randrange(8)))
+            damaged[bad] = (key, bytes(sig), msg)
+            self.assertEqual(verify_schnorr_batch(damaged), [i != bad for i in range(len(items))])
+
     def test_schnorr_testvectors(self):
         """Implement the BIP340 test vectors (read from bip340_test_vectors.csv)."""
         num_tests = 0
+        batch_items = []
+        batch_results = []
         vectors_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bip340_test_vectors.csv')
         with open(vectors_file, newline='', encoding='utf8') as csvfile:
             reader = csv.reader(csvfile)
@@ -545,9 +752,14 @@ class TestFrameworkKey(unittest.TestCase):
                     except RuntimeError as e:
                         self.fail("BIP340 test vector %i (%s): signing raised exception %s" % (i, comment, e))
                 result_actual = verify_schnorr(pubkey, sig, msg)
+                batch_items.append((pubkey, sig, msg))
+                batch_results.append(result_actual)
                 if result:
                     self.assertEqual(result, result_actual, "BIP340 test vector %i (%s): verification failed" % (i, comment))
                 else:
                     self.assertEqual(result, result_actual, "BIP340 test vector %i (%s): verification succeeded unexpectedly" % (i, comment))
                 num_tests += 1
         self.assertTrue(num_tests >= 15) # expect at least 15 test vectors
+        self.assertEqual(verify_schnorr_batch(batch_items), batch_results)
+        valid = [item for item, result in zip(batch_items, batch_results) if result]
+        self.assertEqual(verify_schnorr_batch(valid), [True] * len(valid))
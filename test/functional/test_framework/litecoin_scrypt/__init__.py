@@ -1,5 +1,5 @@
 # test/functional/test_framework/litecoin_scrypt/__init__.py
 
-from ._litecoin_scrypt import getPoWHash
+from ._litecoin_scrypt import getPoWHash, scan_nonces, scan_nonces_parallel
 
-__all__ = ["getPoWHash"]
+__all__ = ["getPoWHash", "scan_nonces", "scan_nonces_parallel"]
@@ -1 +1 @@
-from ._litecoin_scrypt import getPoWHash
+from ._litecoin_scrypt import getPoWHash, scan_nonces, scan_nonces_parallel
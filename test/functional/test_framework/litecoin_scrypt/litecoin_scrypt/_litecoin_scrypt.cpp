@@ -2,6 +2,13 @@
 #include <Python.h>
 #include "crypto/scrypt.h"
 
+#include <algorithm>
+#include <atomic>
+#include <cstdint>
+#include <cstring>
+#include <thread>
+#include <vector>
+
 /**
  * getPoWHash(header: bytes) -> bytes
  *
@@ -40,9 +47,185 @@ static PyObject* getPoWHash(PyObject* self, PyObject* args)
     );
 }
 
+/** Number of nonces a worker claims at a time in scan_nonces_parallel. */
+static const uint64_t SCAN_BATCH_SIZE = 256;
+
+/** Compare two 256-bit little-endian numbers: returns true if hash <= target. */
+static bool HashMeetsTarget(const unsigned char* hash, const unsigned char* target)
+{
+    for (int i = 31; i >= 0; --i) {
+        if (hash[i] != target[i]) return hash[i] < target[i];
+    }
+    return true;
+}
+
+/**
+ * Hash nonces [begin, end) of the header and return the first one whose
+ * PoW hash meets target, or end if there is none. Stops early once a
+ * nonce below *stop has been found (by this or another worker).
+ */
+static uint64_t ScanRange(const unsigned char* header76, uint64_t begin, uint64_t end,
+                          const unsigned char* target, const std::atomic<uint64_t>* stop)
+{
+    unsigned char header[80];
+    unsigned char hash[32];
+    std::memcpy(header, header76, 76);
+    for (uint64_t nonce = begin; nonce < end; ++nonce) {
+        if (stop && nonce >= stop->load(std::memory_order_relaxed)) break;
+        const uint32_t n = static_cast<uint32_t>(nonce);
+        header[76] = n & 0xff;
+        header[77] = (n >> 8) & 0xff;
+        header[78] = (n >> 16) & 0xff;
+        header[79] = (n >> 24) & 0xff;
+        scrypt_1024_1_1_256(reinterpret_cast<const char*>(header), reinterpret_cast<char*>(hash));
+        if (HashMeetsTarget(hash, target)) return nonce;
+    }
+    return end;
+}
+
+/**
+ * Parse the (header76, start, count, target) arguments shared by the scan
+ * functions. target may be an int or 32 little-endian bytes.
+ */
+static bool ParseScanArgs(PyObject* args, PyObject* kwargs, const char* const* kwlist,
+                          Py_buffer* header, uint64_t* start, uint64_t* count,
+                          unsigned char* target, int* threads)
+{
+    unsigned long long start_arg = 0;
+    unsigned long long count_arg = 0;
+    PyObject* target_obj = nullptr;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*KKO|i", const_cast<char**>(kwlist),
+                                     header, &start_arg, &count_arg, &target_obj, threads)) {
+        return false;
+    }
+    if (header->len != 76) {
+        PyErr_SetString(PyExc_ValueError, "expected 76-byte block header prefix (without nonce)");
+        PyBuffer_Release(header);
+        return false;
+    }
+    if (start_arg > 0xffffffffULL || count_arg > 0x100000000ULL - start_arg) {
+        PyErr_SetString(PyExc_ValueError, "nonce range exceeds 32 bits");
+        PyBuffer_Release(header);
+        return false;
+    }
+
+    PyObject* target_bytes = nullptr;
+    if (PyLong_Check(target_obj)) {
+        target_bytes = PyObject_CallMethod(target_obj, "to_bytes", "is", 32, "little");
+    } else {
+        target_bytes = PyBytes_FromObject(target_obj);
+    }
+    if (!target_bytes) {
+        PyBuffer_Release(header);
+        return false;
+    }
+    if (PyBytes_GET_SIZE(target_bytes) != 32) {
+        PyErr_SetString(PyExc_ValueError, "expected 32-byte target");
+        Py_DECREF(target_bytes);
+        PyBuffer_Release(header);
+        return false;
+    }
+    std::memcpy(target, PyBytes_AS_STRING(target_bytes), 32);
+    Py_DECREF(target_bytes);
+
+    *start = start_arg;
+    *count = count_arg;
+    return true;
+}
+
+/**
+ * scan_nonces(header76: bytes, start: int, count: int, target: int) -> int | None
+ *
+ * Try nonces start, start + 1, ..., start + count - 1 on the 76-byte header
+ * prefix and return the first one whose PoW hash is <= target, or None.
+ * The GIL is released while hashing.
+ */
+static PyObject* scan_nonces(PyObject* self, PyObject* args, PyObject* kwargs)
+{
+    static const char* const kwlist[] = {"header76", "start", "count", "target", nullptr};
+    Py_buffer header;
+    uint64_t start, count;
+    unsigned char target[32];
+    int threads = 1;
+
+    if (!ParseScanArgs(args, kwargs, kwlist, &header, &start, &count, target, &threads)) {
+        return nullptr;
+    }
+
+    uint64_t found;
+    Py_BEGIN_ALLOW_THREADS
+    found = ScanRange(static_cast<const unsigned char*>(header.buf), start, start + count, target, nullptr);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&header);
+
+    if (found == start + count) Py_RETURN_NONE;
+    return PyLong_FromUnsignedLongLong(found);
+}
+
+/**
+ * scan_nonces_parallel(header76: bytes, start: int, count: int, target: int, threads: int = 0) -> int | None
+ *
+ * Like scan_nonces, but splits the nonce range across threads (0 means one
+ * per core). Workers claim batches in increasing nonce order, so the
+ * result is the same as that of scan_nonces.
+ */
+static PyObject* scan_nonces_parallel(PyObject* self, PyObject* args, PyObject* kwargs)
+{
+    static const char* const kwlist[] = {"header76", "start", "count", "target", "threads", nullptr};
+    Py_buffer header;
+    uint64_t start, count;
+    unsigned char target[32];
+    int threads = 0;
+
+    if (!ParseScanArgs(args, kwargs, kwlist, &header, &start, &count, target, &threads)) {
+        return nullptr;
+    }
+    if (threads <= 0) {
+        threads = std::max(1u, std::thread::hardware_concurrency());
+    }
+
+    const uint64_t end = start + count;
+    std::atomic<uint64_t> next{start};
+    std::atomic<uint64_t> best{end};
+    const unsigned char* header76 = static_cast<const unsigned char*>(header.buf);
+
+    Py_BEGIN_ALLOW_THREADS
+    auto worker = [&]() {
+        while (true) {
+            const uint64_t begin = next.fetch_add(SCAN_BATCH_SIZE);
+            if (begin >= best.load()) break;
+            const uint64_t batch_end = std::min(begin + SCAN_BATCH_SIZE, end);
+            const uint64_t found = ScanRange(header76, begin, batch_end, target, &best);
+            if (found < batch_end) {
+                uint64_t current = best.load();
+                while (found < current && !best.compare_exchange_weak(current, found)) {}
+            }
+        }
+    };
+    std::vector<std::thread> workers;
+    for (int i = 1; i < threads; ++i) {
+        workers.emplace_back(worker);
+    }
+    worker();
+    for (auto& t : workers) {
+        t.join();
+    }
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&header);
+
+    const uint64_t found = best.load();
+    if (found == end) Py_RETURN_NONE;
+    return PyLong_FromUnsignedLongLong(found);
+}
+
 static PyMethodDef Methods[] = {
     {"getPoWHash", getPoWHash, METH_VARARGS,
      "Compute Litecoin PoW hash (scrypt_1024_1_1_256) for an 80-byte block header."},
+    {"scan_nonces", reinterpret_cast<PyCFunction>(reinterpret_cast<void (*)(void)>(scan_nonces)), METH_VARARGS | METH_KEYWORDS,
+     "Return the first nonce in [start, start + count) for which the PoW hash of the header is <= target, or None."},
+    {"scan_nonces_parallel", reinterpret_cast<PyCFunction>(reinterpret_cast<void (*)(void)>(scan_nonces_parallel)), METH_VARARGS | METH_KEYWORDS,
+     "Multi-threaded scan_nonces. threads=0 uses one thread per core."},
     {nullptr, nullptr, 0, nullptr}
 };
 
@@ -17,7 +17,8 @@ ext = Extension(
     ],
     libraries=["crypto"],
     language="c++",
-    extra_compile_args=["-std=c++17"],
+    extra_compile_args=["-std=c++17", "-pthread"],
+    extra_link_args=["-pthread"],
 )
 
 
@@ -28,7 +28,9 @@ import math
 import random
 import socket
 import struct
+import threading
 import time
+import unittest
 
 from test_framework.siphash import siphash256
 from test_framework.util import hex_str_to_bytes, assert_equal
@@ -39,23 +41,45 @@ MY_SUBVERSION = b"/python-p2p-tester:0.0.3/"
 MY_RELAY = 1 # from version 70001 onwards, fRelay should be appended to version messages (BIP37)
 
 
-class _HashlibLitecoinScrypt:
-    @staticmethod
-    def getPoWHash(header):
-        return hashlib.scrypt(header, salt=header, n=1024, r=1, p=1, maxmem=0, dklen=32)
+class _LitecoinScryptFallback:
+    """The batched nonce search on top of a plain getPoWHash function, for
+    hashlib and for litecoin_scrypt builds that predate scan_nonces."""
+    def __init__(self, getPoWHash):
+        self.getPoWHash = getPoWHash
+
+    def scan_nonces(self, header76, start, count, target):
+        for nonce in range(start, start + count):
+            if uint256_from_str(self.getPoWHash(header76 + struct.pack("<I", nonce))) <= target:
+                return nonce
+        return None
+
+    def scan_nonces_parallel(self, header76, start, count, target, threads=0):
+        return self.scan_nonces(header76, start, count, target)
+
+
+def _hashlib_scrypt_pow_hash(header):
+    return hashlib.scrypt(header, salt=header, n=1024, r=1, p=1, maxmem=0, dklen=32)
 
 
 @functools.lru_cache(maxsize=1)
 def _get_litecoin_scrypt():
+    modules = []
     try:
         import litecoin_scrypt
+        modules.append(litecoin_scrypt)
     except ImportError:
-        try:
-            from . import litecoin_scrypt
-        except ImportError:
-            return _HashlibLitecoinScrypt()
-        return litecoin_scrypt
-    return litecoin_scrypt
+        pass
+    try:
+        from . import litecoin_scrypt as in_tree_litecoin_scrypt
+        modules.append(in_tree_litecoin_scrypt)
+    except ImportError:
+        pass
+    for module in modules:
+        if hasattr(module, "scan_nonces"):
+            return module
+    if modules:
+        return _LitecoinScryptFallback(modules[0].getPoWHash)
+    return _LitecoinScryptFallback(_hashlib_scrypt_pow_hash)
 
 
 @functools.lru_cache(maxsize=1)
@@ -116,26 +140,146 @@ def sha256(s):
 def hash256(s):
     return sha256(sha256(s))
 
+# Precompiled packers for the fixed-size fields
+_U8 = struct.Struct("<B")
+_I8 = struct.Struct("<b")
+_BOOL = struct.Struct("<?")
+_U16 = struct.Struct("<H")
+_U16_BE = struct.Struct(">H")
+_I32 = struct.Struct("<i")
+_U32 = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_U64 = struct.Struct("<Q")
+_COMPACT_U16 = struct.Struct("<BH")
+_COMPACT_U32 = struct.Struct("<BI")
+_COMPACT_U64 = struct.Struct("<BQ")
+_UINT256_MASK = (1 << 256) - 1
+_UINT256 = struct.Struct("<32s")
+# CInv: type, hash
+_INV = struct.Struct("<I32s")
+# COutPoint: hash, n
+_OUTPOINT = struct.Struct("<32sI")
+
+
+class Serializable:
+    """Base class of the objects below that can be serialized.
+
+    Serialization writes into a shared bytearray, so that serializing a
+    container is linear in the size of the result instead of concatenating
+    immutable bytes at every level. Subclasses implement serialize_into(w);
+    serialize() returns the result as bytes.
+
+    Subclasses (e.g. in tests) that only override serialize() keep working
+    when serialized as part of a container."""
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'serialize_into' in cls.__dict__:
+            cls._native_serialize_into = cls.__dict__['serialize_into']
+        elif 'serialize' in cls.__dict__:
+            def serialize_into(self, w, *args, **kwargs):
+                w += self.serialize(*args, **kwargs)
+            cls.serialize_into = serialize_into
+
+    def serialize(self, *args, **kwargs):
+        # Use the writer of the class, not one routed back through an
+        # overridden serialize() that may call this one.
+        w = bytearray()
+        self._native_serialize_into(w, *args, **kwargs)
+        return bytes(w)
+
+    def serialize_into(self, w):
+        raise NotImplementedError
+
+
+class LazyDecoding:
+    """Mixin for received objects that keep their serialization and only
+    deserialize the fields in _lazy_fields when one of them is first read.
+
+    Instances are created with from_payload(). Subclasses need _payload and
+    _decode_lock slots and implement _decode_payload(f), which returns a new
+    object holding the decoded fields. The fields are copied only once the
+    whole payload was decoded, so a malformed payload raises on every read
+    and readers never see a partly decoded field. Fields assigned before
+    decoding keep the assigned values."""
+    __slots__ = ()
+    _lazy_fields = frozenset()
+
+    @classmethod
+    def from_payload(cls, payload):
+        obj = cls.__new__(cls)
+        obj._payload = payload
+        # The object may be first read by an event loop and a test at the
+        # same time.
+        obj._decode_lock = threading.Lock()
+        return obj
+
+    def __getattr__(self, name):
+        # Only called for fields that have not been set yet.
+        if name in self._lazy_fields and getattr(self, "_payload", None) is not None:
+            self._decode()
+            return getattr(self, name)
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+
+    def _decode(self):
+        if getattr(self, "_payload", None) is None:
+            return
+        with self._decode_lock:
+            if self._payload is None:
+                return
+            decoded = self._decode_payload(BytesIO(self._payload))
+            for name in self._lazy_fields:
+                try:
+                    object.__getattribute__(self, name)
+                except AttributeError:
+                    setattr(self, name, getattr(decoded, name))
+            self._payload = None
+
+    def __repr__(self):
+        payload = getattr(self, "_payload", None)
+        if payload is None:
+            return super().__repr__()
+        return "%s(<%d bytes not decoded yet>)" % (type(self).__name__, len(payload))
+
+
+@functools.lru_cache(maxsize=None)
+def lazy_message_class(cls):
+    """Return the subclass of message class cls whose fields are decoded on
+    first access."""
+    fields = (cls.__slots__,) if isinstance(cls.__slots__, str) else cls.__slots__
+
+    def _decode_payload(self, f):
+        decoded = cls()
+        decoded.deserialize(f)
+        return decoded
+
+    return type(cls.__name__, (LazyDecoding, cls), {
+        "__slots__": ("_payload", "_decode_lock"),
+        "__module__": cls.__module__,
+        "_lazy_fields": frozenset(fields),
+        "_decode_payload": _decode_payload,
+    })
+
+
 def ser_compact_size(l):
-    r = b""
     if l < 253:
-        r = struct.pack("B", l)
+        return _U8.pack(l)
     elif l < 0x10000:
-        r = struct.pack("<BH", 253, l)
+        return _COMPACT_U16.pack(253, l)
     elif l < 0x100000000:
-        r = struct.pack("<BI", 254, l)
+        return _COMPACT_U32.pack(254, l)
     else:
-        r = struct.pack("<BQ", 255, l)
-    return r
+        return _COMPACT_U64.pack(255, l)
 
 def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
+    nit = _U8.unpack(f.read(1))[0]
     if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
+        nit = _U16.unpack(f.read(2))[0]
     elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
+        nit = _U32.unpack(f.read(4))[0]
     elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+        nit = _U64.unpack(f.read(8))[0]
     return nit
 
 def deser_string(f):
@@ -146,27 +290,15 @@ def ser_string(s):
     return ser_compact_size(len(s)) + s
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return int.from_bytes(_UINT256.unpack(f.read(32))[0], 'little')
 
 
 def ser_uint256(u):
-    rs = b""
-    for _ in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & _UINT256_MASK).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(_UINT256.unpack_from(s)[0], 'little')
 
 
 def uint256_from_compact(c):
@@ -175,49 +307,36 @@ def uint256_from_compact(c):
     return v
 
 
-def deser_fixed_bytes(f, size):
-    r = []
-    for i in range(size):
-        r.append(struct.unpack("B", f.read(1))[0])
+def read_exact(f, size):
+    """Read exactly size bytes from f, like the struct unpackers would."""
+    # A message can't be larger than 4 GB, whatever a malformed size says.
+    r = f.read(size) if size < (1 << 32) else b""
+    if len(r) != size:
+        raise struct.error("expected %d bytes, got %d" % (size, len(r)))
     return r
 
+def deser_fixed_bytes(f, size):
+    return list(read_exact(f, size))
+
 def ser_fixed_bytes(u, size):
-    rs = b""
-    for i in range(size):
-        rs += struct.pack("B", u[i])
-        #rs += struct.pack("B", u & 0xFF)
-        #u >>= 8
+    rs = bytes(u[:size])
+    if len(rs) != size:
+        raise IndexError("expected %d bytes, got %d" % (size, len(rs)))
     return rs
     
 
 def deser_pubkey(f):
-    r = 0
-    for i in range(33):
-        t = struct.unpack("B", f.read(1))[0]
-        r += t << (i * 8)
-    return r
+    return int.from_bytes(read_exact(f, 33), 'little')
 
 def ser_pubkey(u):
-    rs = b""
-    for _ in range(33):
-        rs += struct.pack("B", u & 0xFF)
-        u >>= 8
-    return rs
+    return (u & ((1 << 264) - 1)).to_bytes(33, 'little')
     
 
 def deser_signature(f):
-    r = 0
-    for i in range(64):
-        t = struct.unpack("B", f.read(1))[0]
-        r += t << (i * 8)
-    return r
+    return int.from_bytes(read_exact(f, 64), 'little')
 
 def ser_signature(u):
-    rs = b""
-    for _ in range(64):
-        rs += struct.pack("B", u & 0xFF)
-        u >>= 8
-    return rs
+    return (u & ((1 << 512) - 1)).to_bytes(64, 'little')
         
 
 
@@ -226,13 +345,17 @@ def ser_signature(u):
 def deser_vector(f, c, deser_function_name=None):
     nit = deser_compact_size(f)
     r = []
-    for _ in range(nit):
-        t = c()
-        if deser_function_name:
-            getattr(t, deser_function_name)(f)
-        else:
+    if deser_function_name:
+        deser_function = getattr(c, deser_function_name)
+        for _ in range(nit):
+            t = c()
+            deser_function(t, f)
+            r.append(t)
+    else:
+        for _ in range(nit):
+            t = c()
             t.deserialize(f)
-        r.append(t)
+            r.append(t)
     return r
 
 
@@ -240,29 +363,37 @@ def deser_vector(f, c, deser_function_name=None):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
-    for i in l:
-        if ser_function_name:
-            r += getattr(i, ser_function_name)()
-        else:
-            r += i.serialize()
-    return r
+    w = bytearray()
+    ser_vector_into(w, l, ser_function_name)
+    return bytes(w)
 
 
+def ser_vector_into(w, l, ser_function_name=None):
+    w += ser_compact_size(len(l))
+    if ser_function_name:
+        for i in l:
+            w += getattr(i, ser_function_name)()
+    else:
+        for i in l:
+            i.serialize_into(w)
+
+
+# The bulk decoders below read a whole array of fixed-size entries at once and
+# split it with struct.iter_unpack.
 def deser_uint256_vector(f):
     nit = deser_compact_size(f)
-    r = []
-    for _ in range(nit):
-        t = deser_uint256(f)
-        r.append(t)
-    return r
+    data = read_exact(f, nit * _UINT256.size)
+    return [int.from_bytes(h, 'little') for (h,) in _UINT256.iter_unpack(data)]
+
+
+def deser_inv_vector(f):
+    nit = deser_compact_size(f)
+    data = read_exact(f, nit * _INV.size)
+    return [CInv(t, int.from_bytes(h, 'little')) for (t, h) in _INV.iter_unpack(data)]
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
-    for i in l:
-        r += ser_uint256(i)
-    return r
+    return ser_compact_size(len(l)) + b"".join([ser_uint256(i) for i in l])
 
 
 def deser_string_vector(f):
@@ -275,10 +406,7 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
-    for sv in l:
-        r += ser_string(sv)
-    return r
+    return ser_compact_size(len(l)) + b"".join([ser_string(sv) for sv in l])
 
 
 # Deserialize from a hex string representation (eg from RPC)
@@ -293,7 +421,7 @@ def ToHex(obj):
 # Objects that map to bitcoind objects, which can be serialized/deserialized
 
 
-class CAddress:
+class CAddress(Serializable):
     __slots__ = ("net", "ip", "nServices", "port", "time")
 
     # see https://github.com/bitcoin/bips/blob/master/bip-0155.mediawiki
@@ -318,34 +446,32 @@ class CAddress:
         """Deserialize from addrv1 format (pre-BIP155)"""
         if with_time:
             # VERSION messages serialize CAddress objects without time
-            self.time = struct.unpack("<I", f.read(4))[0]
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
+            self.time = _U32.unpack(f.read(4))[0]
+        self.nServices = _U64.unpack(f.read(8))[0]
         # We only support IPv4 which means skip 12 bytes and read the next 4 as IPv4 address.
         f.read(12)
         self.net = self.NET_IPV4
         self.ip = socket.inet_ntoa(f.read(4))
-        self.port = struct.unpack(">H", f.read(2))[0]
+        self.port = _U16_BE.unpack(f.read(2))[0]
 
-    def serialize(self, *, with_time=True):
+    def serialize_into(self, w, *, with_time=True):
         """Serialize in addrv1 format (pre-BIP155)"""
         assert self.net == self.NET_IPV4
-        r = b""
         if with_time:
             # VERSION messages serialize CAddress objects without time
-            r += struct.pack("<I", self.time)
-        r += struct.pack("<Q", self.nServices)
-        r += b"\x00" * 10 + b"\xff" * 2
-        r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
-        return r
+            w += _U32.pack(self.time)
+        w += _U64.pack(self.nServices)
+        w += b"\x00" * 10 + b"\xff" * 2
+        w += socket.inet_aton(self.ip)
+        w += _U16_BE.pack(self.port)
 
     def deserialize_v2(self, f):
         """Deserialize from addrv2 format (BIP155)"""
-        self.time = struct.unpack("<I", f.read(4))[0]
+        self.time = _U32.unpack(f.read(4))[0]
 
         self.nServices = deser_compact_size(f)
 
-        self.net = struct.unpack("B", f.read(1))[0]
+        self.net = _U8.unpack(f.read(1))[0]
         assert self.net == self.NET_IPV4
 
         address_length = deser_compact_size(f)
@@ -353,26 +479,29 @@ class CAddress:
 
         self.ip = socket.inet_ntoa(f.read(4))
 
-        self.port = struct.unpack(">H", f.read(2))[0]
+        self.port = _U16_BE.unpack(f.read(2))[0]
 
     def serialize_v2(self):
         """Serialize in addrv2 format (BIP155)"""
+        w = bytearray()
+        self.serialize_v2_into(w)
+        return bytes(w)
+
+    def serialize_v2_into(self, w):
         assert self.net == self.NET_IPV4
-        r = b""
-        r += struct.pack("<I", self.time)
-        r += ser_compact_size(self.nServices)
-        r += struct.pack("B", self.net)
-        r += ser_compact_size(self.ADDRV2_ADDRESS_LENGTH[self.net])
-        r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
-        return r
+        w += _U32.pack(self.time)
+        w += ser_compact_size(self.nServices)
+        w += _U8.pack(self.net)
+        w += ser_compact_size(self.ADDRV2_ADDRESS_LENGTH[self.net])
+        w += socket.inet_aton(self.ip)
+        w += _U16_BE.pack(self.port)
 
     def __repr__(self):
         return ("CAddress(nServices=%i net=%s addr=%s port=%i)"
                 % (self.nServices, self.ADDRV2_NET_NAME[self.net], self.ip, self.port))
 
 
-class CInv:
+class CInv(Serializable):
     __slots__ = ("hash", "type")
 
     typemap = {
@@ -395,14 +524,12 @@ class CInv:
         self.hash = h
 
     def deserialize(self, f):
-        self.type = struct.unpack("<I", f.read(4))[0]
+        self.type = _U32.unpack(f.read(4))[0]
         self.hash = deser_uint256(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<I", self.type)
-        r += ser_uint256(self.hash)
-        return r
+    def serialize_into(self, w):
+        w += _U32.pack(self.type)
+        w += ser_uint256(self.hash)
 
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
@@ -412,7 +539,7 @@ class CInv:
         return isinstance(other, CInv) and self.hash == other.hash and self.type == other.type
 
 
-class CBlockLocator:
+class CBlockLocator(Serializable):
     __slots__ = ("nVersion", "vHave")
 
     def __init__(self):
@@ -420,21 +547,19 @@ class CBlockLocator:
         self.vHave = []
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = _I32.unpack(f.read(4))[0]
         self.vHave = deser_uint256_vector(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256_vector(self.vHave)
-        return r
+    def serialize_into(self, w):
+        w += _I32.pack(self.nVersion)
+        w += ser_uint256_vector(self.vHave)
 
     def __repr__(self):
         return "CBlockLocator(nVersion=%i vHave=%s)" \
             % (self.nVersion, repr(self.vHave))
 
 
-class COutPoint:
+class COutPoint(Serializable):
     __slots__ = ("hash", "n")
 
     def __init__(self, hash=0, n=0):
@@ -442,20 +567,18 @@ class COutPoint:
         self.n = n
 
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        h, self.n = _OUTPOINT.unpack(f.read(36))
+        self.hash = int.from_bytes(h, 'little')
 
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+    def serialize_into(self, w):
+        w += ser_uint256(self.hash)
+        w += _U32.pack(self.n)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
 
-class CTxIn:
+class CTxIn(Serializable):
     __slots__ = ("nSequence", "prevout", "scriptSig")
 
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
@@ -470,14 +593,13 @@ class CTxIn:
         self.prevout = COutPoint()
         self.prevout.deserialize(f)
         self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        self.nSequence = _U32.unpack(f.read(4))[0]
 
-    def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+    def serialize_into(self, w):
+        self.prevout.serialize_into(w)
+        w += ser_compact_size(len(self.scriptSig))
+        w += self.scriptSig
+        w += _U32.pack(self.nSequence)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -485,7 +607,7 @@ class CTxIn:
                self.nSequence)
 
 
-class CTxOut:
+class CTxOut(Serializable):
     __slots__ = ("nValue", "scriptPubKey")
 
     def __init__(self, nValue=0, scriptPubKey=b""):
@@ -493,14 +615,13 @@ class CTxOut:
         self.scriptPubKey = scriptPubKey
 
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
+        self.nValue = _I64.unpack(f.read(8))[0]
         self.scriptPubKey = deser_string(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+    def serialize_into(self, w):
+        w += _I64.pack(self.nValue)
+        w += ser_compact_size(len(self.scriptPubKey))
+        w += self.scriptPubKey
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -525,7 +646,7 @@ class CScriptWitness:
         return True
 
 
-class CTxInWitness:
+class CTxInWitness(Serializable):
     __slots__ = ("scriptWitness",)
 
     def __init__(self):
@@ -534,8 +655,11 @@ class CTxInWitness:
     def deserialize(self, f):
         self.scriptWitness.stack = deser_string_vector(f)
 
-    def serialize(self):
-        return ser_string_vector(self.scriptWitness.stack)
+    def serialize_into(self, w):
+        w += ser_compact_size(len(self.scriptWitness.stack))
+        for sv in self.scriptWitness.stack:
+            w += ser_compact_size(len(sv))
+            w += sv
 
     def __repr__(self):
         return repr(self.scriptWitness)
@@ -544,7 +668,7 @@ class CTxInWitness:
         return self.scriptWitness.is_null()
 
 
-class CTxWitness:
+class CTxWitness(Serializable):
     __slots__ = ("vtxinwit",)
 
     def __init__(self):
@@ -554,14 +678,12 @@ class CTxWitness:
         for i in range(len(self.vtxinwit)):
             self.vtxinwit[i].deserialize(f)
 
-    def serialize(self):
-        r = b""
+    def serialize_into(self, w):
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
-            r += x.serialize()
-        return r
+            x.serialize_into(w)
 
     def __repr__(self):
         return "CTxWitness(%s)" % \
@@ -574,9 +696,9 @@ class CTxWitness:
         return True
 
 
-class CTransaction:
+class CTransaction(Serializable):
     __slots__ = ("hash", "nLockTime", "nVersion", "sha256", "vin", "vout",
-                 "wit", "mweb_tx", "hogex")
+                 "wit", "mweb_tx", "hogex", "_memo_key", "_memo")
 
     def __init__(self, tx=None):
         if tx is None:
@@ -589,6 +711,8 @@ class CTransaction:
             self.hash = None
             self.mweb_tx = None
             self.hogex = False
+            self._memo_key = None
+            self._memo = {}
         else:
             self.nVersion = tx.nVersion
             self.vin = copy.deepcopy(tx.vin)
@@ -599,13 +723,16 @@ class CTransaction:
             self.wit = copy.deepcopy(tx.wit)
             self.mweb_tx = tx.mweb_tx
             self.hogex = tx.hogex
+            # The memo is keyed by value, so the copy can share it.
+            self._memo_key = tx._memo_key
+            self._memo = tx._memo
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = _I32.unpack(f.read(4))[0]
         self.vin = deser_vector(f, CTxIn)
         flags = 0
         if len(self.vin) == 0:
-            flags = struct.unpack("<B", f.read(1))[0]
+            flags = _U8.unpack(f.read(1))[0]
             # Not sure why flags can't be zero, but this
             # matches the implementation in bitcoind
             if (flags != 0):
@@ -624,68 +751,105 @@ class CTransaction:
             if self.mweb_tx == None:
                 self.hogex = True
 
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        self.nLockTime = _U32.unpack(f.read(4))[0]
         self.sha256 = None
         self.hash = None
+        self._memo_key = None
+        self._memo = {}
+
+    def _get_memo(self):
+        """Return the memo of serializations and hashes of this transaction.
+
+        The memo is keyed by a snapshot of every serialized field, so any
+        change to the transaction, including in-place changes to its inputs,
+        outputs and witness stacks, starts a fresh memo. The MWEB transaction
+        is compared by identity, so rehash() drops the memo of transactions
+        that have one."""
+        key = (self.nVersion, self.nLockTime, self.hogex, self.mweb_tx,
+               tuple([(i.prevout.hash, i.prevout.n, i.scriptSig, i.nSequence) for i in self.vin]),
+               tuple([(o.nValue, o.scriptPubKey) for o in self.vout]),
+               tuple([tuple(w.scriptWitness.stack) for w in self.wit.vtxinwit]))
+        if key != self._memo_key:
+            self._memo_key = key
+            self._memo = {}
+        return self._memo
 
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        memo = self._get_memo()
+        if "stripped" not in memo:
+            memo["stripped"] = self._serialize_without_witness()
+        return memo["stripped"]
+
+    def _serialize_without_witness(self):
+        w = bytearray()
+        w += _I32.pack(self.nVersion)
+        ser_vector_into(w, self.vin)
+        ser_vector_into(w, self.vout)
+        w += _U32.pack(self.nLockTime)
+        return bytes(w)
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        memo = self._get_memo()
+        if "witness" not in memo:
+            memo["witness"] = self._serialize_with_witness()
+        return memo["witness"]
+
+    def _serialize_with_witness(self):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        w = bytearray()
+        w += _I32.pack(self.nVersion)
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            ser_vector_into(w, dummy)
+            w += _U8.pack(flags)
+        ser_vector_into(w, self.vin)
+        ser_vector_into(w, self.vout)
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for _ in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            self.wit.serialize_into(w)
+        w += _U32.pack(self.nLockTime)
+        return bytes(w)
 
     
     # Only serialize with mweb when explicitly called for
     def serialize_with_mweb(self):
+        memo = self._get_memo()
+        if "mweb" not in memo:
+            memo["mweb"] = self._serialize_with_mweb()
+        return memo["mweb"]
+
+    def _serialize_with_mweb(self):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
         if self.hogex or self.mweb_tx != None:
             flags |= 8
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        w = bytearray()
+        w += _I32.pack(self.nVersion)
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            ser_vector_into(w, dummy)
+            w += _U8.pack(flags)
+        ser_vector_into(w, self.vin)
+        ser_vector_into(w, self.vout)
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for _ in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
+            self.wit.serialize_into(w)
         if flags & 8:
-            r += ser_mweb_tx(self.mweb_tx)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            ser_mweb_tx_into(w, self.mweb_tx)
+        w += _U32.pack(self.nLockTime)
+        return bytes(w)
 
     # Regular serialization is with mweb -- must explicitly
     # call serialize_with_witness to exclude mweb data or
@@ -693,22 +857,34 @@ class CTransaction:
     def serialize(self):
         return self.serialize_with_mweb()
 
+    def serialize_into(self, w):
+        w += self.serialize_with_mweb()
+
     # Recalculate the txid (transaction hash without witness)
     def rehash(self):
         self.sha256 = None
+        if self.mweb_tx is not None:
+            # The memo cannot see in-place changes to the MWEB transaction.
+            self._memo_key = None
         self.calc_sha256()
         return self.hash
 
     # We will only cache the serialization without witness in
     # self.sha256 and self.hash -- those are expected to be the txid.
     def calc_sha256(self, with_witness=False):
+        memo = self._get_memo()
         if with_witness:
-            # Don't cache the result, just return it
-            return uint256_from_str(hash256(self.serialize_with_witness()))
-
+            # Don't cache the result in self.sha256, just return it
+            if "wtxid" not in memo:
+                memo["wtxid"] = uint256_from_str(hash256(self.serialize_with_witness()))
+            return memo["wtxid"]
+
+        if "txid" not in memo:
+            txid = hash256(self.serialize_without_witness())
+            memo["txid"] = (uint256_from_str(txid), encode(txid[::-1], 'hex_codec').decode('ascii'))
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize_without_witness())[::-1], 'hex_codec').decode('ascii')
+            self.sha256 = memo["txid"][0]
+        self.hash = memo["txid"][1]
 
     def is_valid(self):
         self.calc_sha256()
@@ -731,9 +907,12 @@ class CTransaction:
     def __eq__(self, other):
         return isinstance(other, CTransaction) and repr(self) == repr(other)
 
-class CBlockHeader:
+# nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, nNonce
+_BLOCK_HEADER = struct.Struct("<i32s32sIII")
+
+class CBlockHeader(Serializable):
     __slots__ = ("hash", "hashMerkleRoot", "hashPrevBlock", "nBits", "nNonce",
-                 "nTime", "nVersion", "sha256", "scrypt256")
+                 "nTime", "nVersion", "sha256", "_header_cache", "_scrypt256")
 
     def __init__(self, header=None):
         if header is None:
@@ -747,7 +926,8 @@ class CBlockHeader:
             self.nNonce = header.nNonce
             self.sha256 = header.sha256
             self.hash = header.hash
-            self.scrypt256 = header.scrypt256
+            self._header_cache = header._header_cache
+            self._scrypt256 = header._scrypt256
             self.calc_sha256()
 
     def set_null(self):
@@ -759,45 +939,58 @@ class CBlockHeader:
         self.nNonce = 0
         self.sha256 = None
         self.hash = None
-        self.scrypt256 = None
+        self._header_cache = None
+        self._scrypt256 = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        self._set_serialized(f.read(BLOCK_HEADER_SIZE))
+
+    def _set_serialized(self, r):
+        nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, nNonce = _BLOCK_HEADER.unpack(r)
+        self.nVersion = nVersion
+        self.hashPrevBlock = int.from_bytes(hashPrevBlock, 'little')
+        self.hashMerkleRoot = int.from_bytes(hashMerkleRoot, 'little')
+        self.nTime = nTime
+        self.nBits = nBits
+        self.nNonce = nNonce
         self.sha256 = None
         self.hash = None
-        self.scrypt256 = None
+        # The bytes just read are the serialization of these fields.
+        self._header_cache = ((nVersion, self.hashPrevBlock, self.hashMerkleRoot, nTime, nBits, nNonce), bytes(r))
+        self._scrypt256 = None
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        # The serialization is cached together with the field values it was
+        # built from, and rebuilt as soon as any of them changes.
+        fields = (self.nVersion, self.hashPrevBlock, self.hashMerkleRoot, self.nTime, self.nBits, self.nNonce)
+        if self._header_cache is None or self._header_cache[0] != fields:
+            r = _BLOCK_HEADER.pack(self.nVersion, ser_uint256(self.hashPrevBlock), ser_uint256(self.hashMerkleRoot),
+                                   self.nTime, self.nBits, self.nNonce)
+            self._header_cache = (fields, r)
+        return self._header_cache[1]
+
+    def serialize_into(self, w):
+        w += CBlockHeader.serialize(self)
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
-            self.scrypt256 = uint256_from_str(_get_litecoin_scrypt().getPoWHash(r))
+            h = hash256(CBlockHeader.serialize(self))
+            self.sha256 = uint256_from_str(h)
+            self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
+
+    @property
+    def scrypt256(self):
+        """The scrypt PoW hash of the header.
+
+        This is expensive and only needed to check or grind proof of work, so
+        it is computed on first access and cached until the header changes."""
+        r = CBlockHeader.serialize(self)
+        if self._scrypt256 is None or self._scrypt256[0] is not r:
+            self._scrypt256 = (r, uint256_from_str(_get_litecoin_scrypt().getPoWHash(r)))
+        return self._scrypt256[1]
 
     def rehash(self):
         self.sha256 = None
-        self.scrypt256 = None
         self.calc_sha256()
         return self.sha256
 
@@ -809,8 +1002,15 @@ class CBlockHeader:
     def __eq__(self, other):
         return isinstance(other, CBlockHeader) and repr(self) == repr(other)
 
-BLOCK_HEADER_SIZE = len(CBlockHeader().serialize())
-assert_equal(BLOCK_HEADER_SIZE, 80)
+BLOCK_HEADER_SIZE = _BLOCK_HEADER.size
+assert_equal(len(CBlockHeader().serialize()), BLOCK_HEADER_SIZE)
+# A header in a headers message, followed by its (empty) transaction count
+_HEADERS_ENTRY = struct.Struct("<%dsB" % BLOCK_HEADER_SIZE)
+
+# Number of nonces CBlock.solve() hands to the scrypt module per call, and the
+# expected number of attempts above which it uses the multi-threaded search.
+SOLVE_BATCH_SIZE = 1 << 16
+SOLVE_PARALLEL_MIN_WORK = 1 << 12
 
 class CBlock(CBlockHeader):
     __slots__ = ("vtx", "mweb_block")
@@ -822,23 +1022,30 @@ class CBlock(CBlockHeader):
 
     def deserialize(self, f):
         super().deserialize(f)
+        self._deserialize_transactions(f)
+
+    def _deserialize_transactions(self, f):
         self.vtx = deser_vector(f, CTransaction)
         if len(self.vtx) > 0 and self.vtx[-1].hogex:
             self.mweb_block = deser_mweb_block(f)
+        else:
+            self.mweb_block = None
 
     def serialize(self, with_witness=True, with_mweb=True):
-        r = b""
-        r += super().serialize()
+        w = bytearray()
+        CBlock.serialize_into(self, w, with_witness, with_mweb)
+        return bytes(w)
+
+    def serialize_into(self, w, with_witness=True, with_mweb=True):
+        w += CBlockHeader.serialize(self)
         if with_mweb and with_witness:
-            r += ser_vector(self.vtx, "serialize_with_mweb")
+            ser_vector_into(w, self.vtx, "serialize_with_mweb")
             if len(self.vtx) > 0 and self.vtx[-1].hogex:
-                r += ser_mweb_block(self.mweb_block)
+                ser_mweb_block_into(w, self.mweb_block)
         elif with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
+            ser_vector_into(w, self.vtx, "serialize_with_witness")
         else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
-        
-        return r
+            ser_vector_into(w, self.vtx, "serialize_without_witness")
 
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
@@ -882,11 +1089,25 @@ class CBlock(CBlockHeader):
         return True
 
     def solve(self):
-        self.rehash()
         target = uint256_from_compact(self.nBits)
-        while self.scrypt256 > target:
-            self.nNonce += 1
-            self.rehash()
+        header76 = CBlockHeader.serialize(self)[:76]
+        scrypt = _get_litecoin_scrypt()
+        # Spreading the search over all cores only pays off when many
+        # attempts are expected; regtest blocks need about two.
+        if (1 << 256) // (target + 1) > SOLVE_PARALLEL_MIN_WORK:
+            scan_nonces = scrypt.scan_nonces_parallel
+        else:
+            scan_nonces = scrypt.scan_nonces
+        nonce = self.nNonce
+        while True:
+            assert nonce <= 0xffffffff, "nonce space exhausted"
+            count = min(SOLVE_BATCH_SIZE, 0x100000000 - nonce)
+            found = scan_nonces(header76, nonce, count, target)
+            if found is not None:
+                break
+            nonce += count
+        self.nNonce = found
+        self.rehash()
 
     def __repr__(self):
         return "CBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx=%s)" \
@@ -894,7 +1115,33 @@ class CBlock(CBlockHeader):
                time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
 
 
-class PrefilledTransaction:
+class LazyCBlock(LazyDecoding, CBlock):
+    """A received block whose header is decoded right away and whose
+    transactions and MWEB block are decoded on first access."""
+    __slots__ = ("_payload", "_decode_lock")
+    _lazy_fields = frozenset(("vtx", "mweb_block"))
+
+    @classmethod
+    def from_payload(cls, payload):
+        block = super().from_payload(payload)
+        block._set_serialized(payload[:BLOCK_HEADER_SIZE])
+        return block
+
+    def _decode_payload(self, f):
+        decoded = CBlock()
+        f.seek(BLOCK_HEADER_SIZE)
+        decoded._deserialize_transactions(f)
+        return decoded
+
+    def __eq__(self, other):
+        # Blocks compare by repr, which needs the transactions.
+        self._decode()
+        if isinstance(other, LazyDecoding):
+            other._decode()
+        return super().__eq__(other)
+
+
+class PrefilledTransaction(Serializable):
     __slots__ = ("index", "tx")
 
     def __init__(self, index=0, tx = None):
@@ -906,16 +1153,14 @@ class PrefilledTransaction:
         self.tx = CTransaction()
         self.tx.deserialize(f)
 
-    def serialize(self, with_witness=True, with_mweb=True):
-        r = b""
-        r += ser_compact_size(self.index)
+    def serialize_into(self, w, with_witness=True, with_mweb=True):
+        w += ser_compact_size(self.index)
         if with_witness and with_mweb:
-            r += self.tx.serialize_with_mweb()
+            w += self.tx.serialize_with_mweb()
         elif with_witness:
-            r += self.tx.serialize_with_witness()
+            w += self.tx.serialize_with_witness()
         else:
-            r += self.tx.serialize_without_witness()
-        return r
+            w += self.tx.serialize_without_witness()
 
     def serialize_without_witness(self):
         return self.serialize(with_witness=False, with_mweb=False)
@@ -931,7 +1176,7 @@ class PrefilledTransaction:
 
 
 # This is what we send on the wire, in a cmpctblock message.
-class P2PHeaderAndShortIDs:
+class P2PHeaderAndShortIDs(Serializable):
     __slots__ = ("header", "nonce", "prefilled_txn", "prefilled_txn_length",
                  "shortids", "shortids_length", "mweb_block")
 
@@ -946,12 +1191,12 @@ class P2PHeaderAndShortIDs:
 
     def deserialize(self, f):
         self.header.deserialize(f)
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = _U64.unpack(f.read(8))[0]
         self.shortids_length = deser_compact_size(f)
         for _ in range(self.shortids_length):
             # shortids are defined to be 6 bytes in the spec, so append
             # two zero bytes and read it in as an 8-byte number
-            self.shortids.append(struct.unpack("<Q", f.read(6) + b'\x00\x00')[0])
+            self.shortids.append(_U64.unpack(f.read(6) + b'\x00\x00')[0])
         self.prefilled_txn = deser_vector(f, PrefilledTransaction)
         self.prefilled_txn_length = len(self.prefilled_txn)
         
@@ -960,22 +1205,20 @@ class P2PHeaderAndShortIDs:
                 
     # When using version 2 compact blocks, we must serialize with_witness.
     # When using version 3 compact blocks, we must serialize with_mweb.
-    def serialize(self, version=1):
-        r = b""
-        r += self.header.serialize()
-        r += struct.pack("<Q", self.nonce)
-        r += ser_compact_size(self.shortids_length)
+    def serialize_into(self, w, version=1):
+        self.header.serialize_into(w)
+        w += _U64.pack(self.nonce)
+        w += ser_compact_size(self.shortids_length)
         for x in self.shortids:
             # We only want the first 6 bytes
-            r += struct.pack("<Q", x)[0:6]
+            w += _U64.pack(x)[0:6]
         if version >= 3:
-            r += ser_vector(self.prefilled_txn, "serialize_with_mweb")
-            r += ser_mweb_block(self.mweb_block)
+            ser_vector_into(w, self.prefilled_txn, "serialize_with_mweb")
+            ser_mweb_block_into(w, self.mweb_block)
         elif version == 2:
-            r += ser_vector(self.prefilled_txn, "serialize_with_witness")
+            ser_vector_into(w, self.prefilled_txn, "serialize_with_witness")
         else:
-            r += ser_vector(self.prefilled_txn, "serialize_without_witness")
-        return r
+            ser_vector_into(w, self.prefilled_txn, "serialize_without_witness")
 
     def __repr__(self):
         return "P2PHeaderAndShortIDs(header=%s, nonce=%d, shortids_length=%d, shortids=%s, prefilled_txn_length=%d, prefilledtxn=%s" % (repr(self.header), self.nonce, self.shortids_length, repr(self.shortids), self.prefilled_txn_length, repr(self.prefilled_txn))
@@ -1053,7 +1296,7 @@ class HeaderAndShortIDs:
         return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr(self.shortids), repr(self.prefilled_txn))
 
 
-class BlockTransactionsRequest:
+class BlockTransactionsRequest(Serializable):
     __slots__ = ("blockhash", "indexes")
 
     def __init__(self, blockhash=0, indexes = None):
@@ -1066,13 +1309,11 @@ class BlockTransactionsRequest:
         for _ in range(indexes_length):
             self.indexes.append(deser_compact_size(f))
 
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_compact_size(len(self.indexes))
+    def serialize_into(self, w):
+        w += ser_uint256(self.blockhash)
+        w += ser_compact_size(len(self.indexes))
         for x in self.indexes:
-            r += ser_compact_size(x)
-        return r
+            w += ser_compact_size(x)
 
     # helper to set the differentially encoded indexes from absolute ones
     def from_absolute(self, absolute_indexes):
@@ -1094,7 +1335,7 @@ class BlockTransactionsRequest:
         return "BlockTransactionsRequest(hash=%064x indexes=%s)" % (self.blockhash, repr(self.indexes))
 
 
-class BlockTransactions:
+class BlockTransactions(Serializable):
     __slots__ = ("blockhash", "transactions")
 
     def __init__(self, blockhash=0, transactions = None):
@@ -1105,22 +1346,20 @@ class BlockTransactions:
         self.blockhash = deser_uint256(f)
         self.transactions = deser_vector(f, CTransaction)
 
-    def serialize(self, with_witness=True, with_mweb=True):
-        r = b""
-        r += ser_uint256(self.blockhash)
+    def serialize_into(self, w, with_witness=True, with_mweb=True):
+        w += ser_uint256(self.blockhash)
         if with_mweb and with_witness:
-            r += ser_vector(self.transactions, "serialize_with_mweb")
+            ser_vector_into(w, self.transactions, "serialize_with_mweb")
         elif with_witness:
-            r += ser_vector(self.transactions, "serialize_with_witness")
+            ser_vector_into(w, self.transactions, "serialize_with_witness")
         else:
-            r += ser_vector(self.transactions, "serialize_without_witness")
-        return r
+            ser_vector_into(w, self.transactions, "serialize_without_witness")
 
     def __repr__(self):
         return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr(self.transactions))
 
 
-class CPartialMerkleTree:
+class CPartialMerkleTree(Serializable):
     __slots__ = ("nTransactions", "vBits", "vHash")
 
     def __init__(self):
@@ -1129,28 +1368,26 @@ class CPartialMerkleTree:
         self.vBits = []
 
     def deserialize(self, f):
-        self.nTransactions = struct.unpack("<i", f.read(4))[0]
+        self.nTransactions = _I32.unpack(f.read(4))[0]
         self.vHash = deser_uint256_vector(f)
         vBytes = deser_string(f)
         self.vBits = []
         for i in range(len(vBytes) * 8):
             self.vBits.append(vBytes[i//8] & (1 << (i % 8)) != 0)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nTransactions)
-        r += ser_uint256_vector(self.vHash)
+    def serialize_into(self, w):
+        w += _I32.pack(self.nTransactions)
+        w += ser_uint256_vector(self.vHash)
         vBytesArray = bytearray([0x00] * ((len(self.vBits) + 7)//8))
         for i in range(len(self.vBits)):
             vBytesArray[i // 8] |= self.vBits[i] << (i % 8)
-        r += ser_string(bytes(vBytesArray))
-        return r
+        w += ser_string(bytes(vBytesArray))
 
     def __repr__(self):
         return "CPartialMerkleTree(nTransactions=%d, vHash=%s, vBits=%s)" % (self.nTransactions, repr(self.vHash), repr(self.vBits))
 
 
-class CMerkleBlock:
+class CMerkleBlock(Serializable):
     __slots__ = ("header", "txn")
 
     def __init__(self):
@@ -1161,18 +1398,16 @@ class CMerkleBlock:
         self.header.deserialize(f)
         self.txn.deserialize(f)
 
-    def serialize(self):
-        r = b""
-        r += self.header.serialize()
-        r += self.txn.serialize()
-        return r
+    def serialize_into(self, w):
+        self.header.serialize_into(w)
+        self.txn.serialize_into(w)
 
     def __repr__(self):
         return "CMerkleBlock(header=%s, txn=%s)" % (repr(self.header), repr(self.txn))
 
 
 # Objects that correspond to messages on the wire
-class msg_version:
+class msg_version(Serializable):
     __slots__ = ("addrFrom", "addrTo", "nNonce", "nRelay", "nServices",
                  "nStartingHeight", "nTime", "nVersion", "strSubVer")
     msgtype = b"version"
@@ -1189,40 +1424,38 @@ class msg_version:
         self.nRelay = MY_RELAY
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.nTime = struct.unpack("<q", f.read(8))[0]
+        self.nVersion = _I32.unpack(f.read(4))[0]
+        self.nServices = _U64.unpack(f.read(8))[0]
+        self.nTime = _I64.unpack(f.read(8))[0]
         self.addrTo = CAddress()
         self.addrTo.deserialize(f, with_time=False)
 
         self.addrFrom = CAddress()
         self.addrFrom.deserialize(f, with_time=False)
-        self.nNonce = struct.unpack("<Q", f.read(8))[0]
+        self.nNonce = _U64.unpack(f.read(8))[0]
         self.strSubVer = deser_string(f)
 
-        self.nStartingHeight = struct.unpack("<i", f.read(4))[0]
+        self.nStartingHeight = _I32.unpack(f.read(4))[0]
 
         if self.nVersion >= 70001:
             # Relay field is optional for version 70001 onwards
             try:
-                self.nRelay = struct.unpack("<b", f.read(1))[0]
+                self.nRelay = _I8.unpack(f.read(1))[0]
             except:
                 self.nRelay = 0
         else:
             self.nRelay = 0
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<Q", self.nServices)
-        r += struct.pack("<q", self.nTime)
-        r += self.addrTo.serialize(with_time=False)
-        r += self.addrFrom.serialize(with_time=False)
-        r += struct.pack("<Q", self.nNonce)
-        r += ser_string(self.strSubVer)
-        r += struct.pack("<i", self.nStartingHeight)
-        r += struct.pack("<b", self.nRelay)
-        return r
+    def serialize_into(self, w):
+        w += _I32.pack(self.nVersion)
+        w += _U64.pack(self.nServices)
+        w += _I64.pack(self.nTime)
+        self.addrTo.serialize_into(w, with_time=False)
+        self.addrFrom.serialize_into(w, with_time=False)
+        w += _U64.pack(self.nNonce)
+        w += ser_string(self.strSubVer)
+        w += _I32.pack(self.nStartingHeight)
+        w += _I8.pack(self.nRelay)
 
     def __repr__(self):
         return 'msg_version(nVersion=%i nServices=%i nTime=%s addrTo=%s addrFrom=%s nNonce=0x%016X strSubVer=%s nStartingHeight=%i nRelay=%i)' \
@@ -1231,7 +1464,7 @@ class msg_version:
                self.strSubVer, self.nStartingHeight, self.nRelay)
 
 
-class msg_verack:
+class msg_verack(Serializable):
     __slots__ = ()
     msgtype = b"verack"
 
@@ -1241,14 +1474,14 @@ class msg_verack:
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, w):
+        pass
 
     def __repr__(self):
         return "msg_verack()"
 
 
-class msg_addr:
+class msg_addr(Serializable):
     __slots__ = ("addrs",)
     msgtype = b"addr"
 
@@ -1258,14 +1491,14 @@ class msg_addr:
     def deserialize(self, f):
         self.addrs = deser_vector(f, CAddress)
 
-    def serialize(self):
-        return ser_vector(self.addrs)
+    def serialize_into(self, w):
+        ser_vector_into(w, self.addrs)
 
     def __repr__(self):
         return "msg_addr(addrs=%s)" % (repr(self.addrs))
 
 
-class msg_addrv2:
+class msg_addrv2(Serializable):
     __slots__ = ("addrs",)
     msgtype = b"addrv2"
 
@@ -1275,14 +1508,14 @@ class msg_addrv2:
     def deserialize(self, f):
         self.addrs = deser_vector(f, CAddress, "deserialize_v2")
 
-    def serialize(self):
-        return ser_vector(self.addrs, "serialize_v2")
+    def serialize_into(self, w):
+        ser_vector_into(w, self.addrs, "serialize_v2")
 
     def __repr__(self):
         return "msg_addrv2(addrs=%s)" % (repr(self.addrs))
 
 
-class msg_sendaddrv2:
+class msg_sendaddrv2(Serializable):
     __slots__ = ()
     msgtype = b"sendaddrv2"
 
@@ -1292,14 +1525,14 @@ class msg_sendaddrv2:
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, w):
+        pass
 
     def __repr__(self):
         return "msg_sendaddrv2()"
 
 
-class msg_inv:
+class msg_inv(Serializable):
     __slots__ = ("inv",)
     msgtype = b"inv"
 
@@ -1310,16 +1543,16 @@ class msg_inv:
             self.inv = inv
 
     def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
+        self.inv = deser_inv_vector(f)
 
-    def serialize(self):
-        return ser_vector(self.inv)
+    def serialize_into(self, w):
+        ser_vector_into(w, self.inv)
 
     def __repr__(self):
         return "msg_inv(inv=%s)" % (repr(self.inv))
 
 
-class msg_getdata:
+class msg_getdata(Serializable):
     __slots__ = ("inv",)
     msgtype = b"getdata"
 
@@ -1327,16 +1560,16 @@ class msg_getdata:
         self.inv = inv if inv is not None else []
 
     def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
+        self.inv = deser_inv_vector(f)
 
-    def serialize(self):
-        return ser_vector(self.inv)
+    def serialize_into(self, w):
+        ser_vector_into(w, self.inv)
 
     def __repr__(self):
         return "msg_getdata(inv=%s)" % (repr(self.inv))
 
 
-class msg_getblocks:
+class msg_getblocks(Serializable):
     __slots__ = ("locator", "hashstop")
     msgtype = b"getblocks"
 
@@ -1349,18 +1582,16 @@ class msg_getblocks:
         self.locator.deserialize(f)
         self.hashstop = deser_uint256(f)
 
-    def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+    def serialize_into(self, w):
+        self.locator.serialize_into(w)
+        w += ser_uint256(self.hashstop)
 
     def __repr__(self):
         return "msg_getblocks(locator=%s hashstop=%064x)" \
             % (repr(self.locator), self.hashstop)
 
 
-class msg_tx:
+class msg_tx(Serializable):
     __slots__ = ("tx",)
     msgtype = b"tx"
 
@@ -1370,13 +1601,13 @@ class msg_tx:
     def deserialize(self, f):
         self.tx.deserialize(f)
 
-    def serialize(self):
-        return self.tx.serialize_with_mweb()
+    def serialize_into(self, w):
+        w += self.tx.serialize_with_mweb()
 
     def __repr__(self):
         return "msg_tx(tx=%s)" % (repr(self.tx))
 
-class msg_wtxidrelay:
+class msg_wtxidrelay(Serializable):
     __slots__ = ()
     msgtype = b"wtxidrelay"
 
@@ -1386,8 +1617,8 @@ class msg_wtxidrelay:
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, w):
+        pass
 
     def __repr__(self):
         return "msg_wtxidrelay()"
@@ -1396,16 +1627,16 @@ class msg_wtxidrelay:
 class msg_no_witness_tx(msg_tx):
     __slots__ = ()
 
-    def serialize(self):
-        return self.tx.serialize_without_witness()
+    def serialize_into(self, w):
+        w += self.tx.serialize_without_witness()
 
 class msg_no_mweb_tx(msg_tx):
     __slots__ = ()
 
-    def serialize(self):
-        return self.tx.serialize_with_witness()
+    def serialize_into(self, w):
+        w += self.tx.serialize_with_witness()
 
-class msg_block:
+class msg_block(Serializable):
     __slots__ = ("block",)
     msgtype = b"block"
 
@@ -1418,8 +1649,8 @@ class msg_block:
     def deserialize(self, f):
         self.block.deserialize(f)
 
-    def serialize(self):
-        return self.block.serialize()
+    def serialize_into(self, w):
+        self.block.serialize_into(w)
 
     def __repr__(self):
         return "msg_block(block=%s)" % (repr(self.block))
@@ -1443,15 +1674,15 @@ class msg_generic:
 
 class msg_no_witness_block(msg_block):
     __slots__ = ()
-    def serialize(self):
-        return self.block.serialize(with_witness=False, with_mweb=False)
+    def serialize_into(self, w):
+        self.block.serialize_into(w, with_witness=False, with_mweb=False)
     
 class msg_no_mweb_block(msg_block):
     __slots__ = ()
-    def serialize(self):
-        return self.block.serialize(with_witness=True, with_mweb=False)
+    def serialize_into(self, w):
+        self.block.serialize_into(w, with_witness=True, with_mweb=False)
 
-class msg_getaddr:
+class msg_getaddr(Serializable):
     __slots__ = ()
     msgtype = b"getaddr"
 
@@ -1461,14 +1692,14 @@ class msg_getaddr:
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, w):
+        pass
 
     def __repr__(self):
         return "msg_getaddr()"
 
 
-class msg_ping:
+class msg_ping(Serializable):
     __slots__ = ("nonce",)
     msgtype = b"ping"
 
@@ -1476,18 +1707,16 @@ class msg_ping:
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = _U64.unpack(f.read(8))[0]
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+    def serialize_into(self, w):
+        w += _U64.pack(self.nonce)
 
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
 
 
-class msg_pong:
+class msg_pong(Serializable):
     __slots__ = ("nonce",)
     msgtype = b"pong"
 
@@ -1495,18 +1724,16 @@ class msg_pong:
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = _U64.unpack(f.read(8))[0]
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+    def serialize_into(self, w):
+        w += _U64.pack(self.nonce)
 
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
 
 
-class msg_mempool:
+class msg_mempool(Serializable):
     __slots__ = ()
     msgtype = b"mempool"
 
@@ -1516,14 +1743,14 @@ class msg_mempool:
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, w):
+        pass
 
     def __repr__(self):
         return "msg_mempool()"
 
 
-class msg_notfound:
+class msg_notfound(Serializable):
     __slots__ = ("vec", )
     msgtype = b"notfound"
 
@@ -1531,16 +1758,16 @@ class msg_notfound:
         self.vec = vec or []
 
     def deserialize(self, f):
-        self.vec = deser_vector(f, CInv)
+        self.vec = deser_inv_vector(f)
 
-    def serialize(self):
-        return ser_vector(self.vec)
+    def serialize_into(self, w):
+        ser_vector_into(w, self.vec)
 
     def __repr__(self):
         return "msg_notfound(vec=%s)" % (repr(self.vec))
 
 
-class msg_sendheaders:
+class msg_sendheaders(Serializable):
     __slots__ = ()
     msgtype = b"sendheaders"
 
@@ -1550,8 +1777,8 @@ class msg_sendheaders:
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, w):
+        pass
 
     def __repr__(self):
         return "msg_sendheaders()"
@@ -1561,7 +1788,7 @@ class msg_sendheaders:
 # number of entries
 # vector of hashes
 # hash_stop (hash of last desired block header, 0 to get as many as possible)
-class msg_getheaders:
+class msg_getheaders(Serializable):
     __slots__ = ("hashstop", "locator",)
     msgtype = b"getheaders"
 
@@ -1574,11 +1801,9 @@ class msg_getheaders:
         self.locator.deserialize(f)
         self.hashstop = deser_uint256(f)
 
-    def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+    def serialize_into(self, w):
+        self.locator.serialize_into(w)
+        w += ser_uint256(self.hashstop)
 
     def __repr__(self):
         return "msg_getheaders(locator=%s, stop=%064x)" \
@@ -1587,7 +1812,7 @@ class msg_getheaders:
 
 # headers message has
 # <count> <vector of block headers>
-class msg_headers:
+class msg_headers(Serializable):
     __slots__ = ("headers",)
     msgtype = b"headers"
 
@@ -1596,19 +1821,35 @@ class msg_headers:
 
     def deserialize(self, f):
         # comment in bitcoind indicates these should be deserialized as blocks
-        blocks = deser_vector(f, CBlock)
-        for x in blocks:
-            self.headers.append(CBlockHeader(x))
-
-    def serialize(self):
-        blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        nit = deser_compact_size(f)
+        start = f.tell()
+        entries = list(_HEADERS_ENTRY.iter_unpack(read_exact(f, nit * _HEADERS_ENTRY.size)))
+        if any(ntx for (_, ntx) in entries):
+            # Not all of them are bare headers, decode them as blocks
+            f.seek(start)
+            for _ in range(nit):
+                x = CBlock()
+                x.deserialize(f)
+                self.headers.append(CBlockHeader(x))
+            return
+        for (r, _) in entries:
+            header = CBlockHeader()
+            header._set_serialized(r)
+            header.calc_sha256()
+            self.headers.append(header)
+
+    def serialize_into(self, w):
+        # Headers are sent as blocks without transactions.
+        w += ser_compact_size(len(self.headers))
+        for h in self.headers:
+            w += CBlockHeader.serialize(h)
+            w += b"\x00"
 
     def __repr__(self):
         return "msg_headers(headers=%s)" % repr(self.headers)
 
 
-class msg_merkleblock:
+class msg_merkleblock(Serializable):
     __slots__ = ("merkleblock",)
     msgtype = b"merkleblock"
 
@@ -1621,14 +1862,14 @@ class msg_merkleblock:
     def deserialize(self, f):
         self.merkleblock.deserialize(f)
 
-    def serialize(self):
-        return self.merkleblock.serialize()
+    def serialize_into(self, w):
+        self.merkleblock.serialize_into(w)
 
     def __repr__(self):
         return "msg_merkleblock(merkleblock=%s)" % (repr(self.merkleblock))
 
 
-class msg_filterload:
+class msg_filterload(Serializable):
     __slots__ = ("data", "nHashFuncs", "nTweak", "nFlags")
     msgtype = b"filterload"
 
@@ -1640,24 +1881,22 @@ class msg_filterload:
 
     def deserialize(self, f):
         self.data = deser_string(f)
-        self.nHashFuncs = struct.unpack("<I", f.read(4))[0]
-        self.nTweak = struct.unpack("<I", f.read(4))[0]
-        self.nFlags = struct.unpack("<B", f.read(1))[0]
+        self.nHashFuncs = _U32.unpack(f.read(4))[0]
+        self.nTweak = _U32.unpack(f.read(4))[0]
+        self.nFlags = _U8.unpack(f.read(1))[0]
 
-    def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        r += struct.pack("<I", self.nHashFuncs)
-        r += struct.pack("<I", self.nTweak)
-        r += struct.pack("<B", self.nFlags)
-        return r
+    def serialize_into(self, w):
+        w += ser_string(self.data)
+        w += _U32.pack(self.nHashFuncs)
+        w += _U32.pack(self.nTweak)
+        w += _U8.pack(self.nFlags)
 
     def __repr__(self):
         return "msg_filterload(data={}, nHashFuncs={}, nTweak={}, nFlags={})".format(
             self.data, self.nHashFuncs, self.nTweak, self.nFlags)
 
 
-class msg_filteradd:
+class msg_filteradd(Serializable):
     __slots__ = ("data")
     msgtype = b"filteradd"
 
@@ -1667,16 +1906,14 @@ class msg_filteradd:
     def deserialize(self, f):
         self.data = deser_string(f)
 
-    def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        return r
+    def serialize_into(self, w):
+        w += ser_string(self.data)
 
     def __repr__(self):
         return "msg_filteradd(data={})".format(self.data)
 
 
-class msg_filterclear:
+class msg_filterclear(Serializable):
     __slots__ = ()
     msgtype = b"filterclear"
 
@@ -1686,14 +1923,14 @@ class msg_filterclear:
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, w):
+        pass
 
     def __repr__(self):
         return "msg_filterclear()"
 
 
-class msg_feefilter:
+class msg_feefilter(Serializable):
     __slots__ = ("feerate",)
     msgtype = b"feefilter"
 
@@ -1701,18 +1938,16 @@ class msg_feefilter:
         self.feerate = feerate
 
     def deserialize(self, f):
-        self.feerate = struct.unpack("<Q", f.read(8))[0]
+        self.feerate = _U64.unpack(f.read(8))[0]
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.feerate)
-        return r
+    def serialize_into(self, w):
+        w += _U64.pack(self.feerate)
 
     def __repr__(self):
         return "msg_feefilter(feerate=%08x)" % self.feerate
 
 
-class msg_sendcmpct:
+class msg_sendcmpct(Serializable):
     __slots__ = ("announce", "version")
     msgtype = b"sendcmpct"
 
@@ -1721,20 +1956,18 @@ class msg_sendcmpct:
         self.version = version
 
     def deserialize(self, f):
-        self.announce = struct.unpack("<?", f.read(1))[0]
-        self.version = struct.unpack("<Q", f.read(8))[0]
+        self.announce = _BOOL.unpack(f.read(1))[0]
+        self.version = _U64.unpack(f.read(8))[0]
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<?", self.announce)
-        r += struct.pack("<Q", self.version)
-        return r
+    def serialize_into(self, w):
+        w += _BOOL.pack(self.announce)
+        w += _U64.pack(self.version)
 
     def __repr__(self):
         return "msg_sendcmpct(announce=%s, version=%lu)" % (self.announce, self.version)
 
 
-class msg_cmpctblock:
+class msg_cmpctblock(Serializable):
     __slots__ = ("header_and_shortids", "version")
     msgtype = b"cmpctblock"
 
@@ -1746,16 +1979,14 @@ class msg_cmpctblock:
         self.header_and_shortids = P2PHeaderAndShortIDs()
         self.header_and_shortids.deserialize(f)
 
-    def serialize(self):
-        r = b""
-        r += self.header_and_shortids.serialize(version=self.version)
-        return r
+    def serialize_into(self, w):
+        self.header_and_shortids.serialize_into(w, version=self.version)
 
     def __repr__(self):
         return "msg_cmpctblock(HeaderAndShortIDs=%s)" % repr(self.header_and_shortids)
 
 
-class msg_getblocktxn:
+class msg_getblocktxn(Serializable):
     __slots__ = ("block_txn_request",)
     msgtype = b"getblocktxn"
 
@@ -1766,16 +1997,14 @@ class msg_getblocktxn:
         self.block_txn_request = BlockTransactionsRequest()
         self.block_txn_request.deserialize(f)
 
-    def serialize(self):
-        r = b""
-        r += self.block_txn_request.serialize()
-        return r
+    def serialize_into(self, w):
+        self.block_txn_request.serialize_into(w)
 
     def __repr__(self):
         return "msg_getblocktxn(block_txn_request=%s)" % (repr(self.block_txn_request))
 
 
-class msg_blocktxn:
+class msg_blocktxn(Serializable):
     __slots__ = ("block_transactions",)
     msgtype = b"blocktxn"
 
@@ -1785,10 +2014,8 @@ class msg_blocktxn:
     def deserialize(self, f):
         self.block_transactions.deserialize(f)
 
-    def serialize(self):
-        r = b""
-        r += self.block_transactions.serialize()
-        return r
+    def serialize_into(self, w):
+        self.block_transactions.serialize_into(w)
 
     def __repr__(self):
         return "msg_blocktxn(block_transactions=%s)" % (repr(self.block_transactions))
@@ -1797,11 +2024,11 @@ class msg_blocktxn:
 class msg_no_witness_blocktxn(msg_blocktxn):
     __slots__ = ()
 
-    def serialize(self):
-        return self.block_transactions.serialize(with_witness=False, with_mweb=False)
+    def serialize_into(self, w):
+        self.block_transactions.serialize_into(w, with_witness=False, with_mweb=False)
 
 
-class msg_getcfilters:
+class msg_getcfilters(Serializable):
     __slots__ = ("filter_type", "start_height", "stop_hash")
     msgtype =  b"getcfilters"
 
@@ -1811,22 +2038,20 @@ class msg_getcfilters:
         self.stop_hash = stop_hash
 
     def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
-        self.start_height = struct.unpack("<I", f.read(4))[0]
+        self.filter_type = _U8.unpack(f.read(1))[0]
+        self.start_height = _U32.unpack(f.read(4))[0]
         self.stop_hash = deser_uint256(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += struct.pack("<I", self.start_height)
-        r += ser_uint256(self.stop_hash)
-        return r
+    def serialize_into(self, w):
+        w += _U8.pack(self.filter_type)
+        w += _U32.pack(self.start_height)
+        w += ser_uint256(self.stop_hash)
 
     def __repr__(self):
         return "msg_getcfilters(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
             self.filter_type, self.start_height, self.stop_hash)
 
-class msg_cfilter:
+class msg_cfilter(Serializable):
     __slots__ = ("filter_type", "block_hash", "filter_data")
     msgtype =  b"cfilter"
 
@@ -1836,22 +2061,20 @@ class msg_cfilter:
         self.filter_data = filter_data
 
     def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
+        self.filter_type = _U8.unpack(f.read(1))[0]
         self.block_hash = deser_uint256(f)
         self.filter_data = deser_string(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.block_hash)
-        r += ser_string(self.filter_data)
-        return r
+    def serialize_into(self, w):
+        w += _U8.pack(self.filter_type)
+        w += ser_uint256(self.block_hash)
+        w += ser_string(self.filter_data)
 
     def __repr__(self):
         return "msg_cfilter(filter_type={:#x}, block_hash={:x})".format(
             self.filter_type, self.block_hash)
 
-class msg_getcfheaders:
+class msg_getcfheaders(Serializable):
     __slots__ = ("filter_type", "start_height", "stop_hash")
     msgtype =  b"getcfheaders"
 
@@ -1861,22 +2084,20 @@ class msg_getcfheaders:
         self.stop_hash = stop_hash
 
     def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
-        self.start_height = struct.unpack("<I", f.read(4))[0]
+        self.filter_type = _U8.unpack(f.read(1))[0]
+        self.start_height = _U32.unpack(f.read(4))[0]
         self.stop_hash = deser_uint256(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += struct.pack("<I", self.start_height)
-        r += ser_uint256(self.stop_hash)
-        return r
+    def serialize_into(self, w):
+        w += _U8.pack(self.filter_type)
+        w += _U32.pack(self.start_height)
+        w += ser_uint256(self.stop_hash)
 
     def __repr__(self):
         return "msg_getcfheaders(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
             self.filter_type, self.start_height, self.stop_hash)
 
-class msg_cfheaders:
+class msg_cfheaders(Serializable):
     __slots__ = ("filter_type", "stop_hash", "prev_header", "hashes")
     msgtype =  b"cfheaders"
 
@@ -1887,24 +2108,22 @@ class msg_cfheaders:
         self.hashes = hashes
 
     def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
+        self.filter_type = _U8.unpack(f.read(1))[0]
         self.stop_hash = deser_uint256(f)
         self.prev_header = deser_uint256(f)
         self.hashes = deser_uint256_vector(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        r += ser_uint256(self.prev_header)
-        r += ser_uint256_vector(self.hashes)
-        return r
+    def serialize_into(self, w):
+        w += _U8.pack(self.filter_type)
+        w += ser_uint256(self.stop_hash)
+        w += ser_uint256(self.prev_header)
+        w += ser_uint256_vector(self.hashes)
 
     def __repr__(self):
         return "msg_cfheaders(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
 
-class msg_getcfcheckpt:
+class msg_getcfcheckpt(Serializable):
     __slots__ = ("filter_type", "stop_hash")
     msgtype =  b"getcfcheckpt"
 
@@ -1913,20 +2132,18 @@ class msg_getcfcheckpt:
         self.stop_hash = stop_hash
 
     def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
+        self.filter_type = _U8.unpack(f.read(1))[0]
         self.stop_hash = deser_uint256(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        return r
+    def serialize_into(self, w):
+        w += _U8.pack(self.filter_type)
+        w += ser_uint256(self.stop_hash)
 
     def __repr__(self):
         return "msg_getcfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
 
-class msg_cfcheckpt:
+class msg_cfcheckpt(Serializable):
     __slots__ = ("filter_type", "stop_hash", "headers")
     msgtype =  b"cfcheckpt"
 
@@ -1936,16 +2153,14 @@ class msg_cfcheckpt:
         self.headers = headers
 
     def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
+        self.filter_type = _U8.unpack(f.read(1))[0]
         self.stop_hash = deser_uint256(f)
         self.headers = deser_uint256_vector(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        r += ser_uint256_vector(self.headers)
-        return r
+    def serialize_into(self, w):
+        w += _U8.pack(self.filter_type)
+        w += ser_uint256(self.stop_hash)
+        w += ser_uint256_vector(self.headers)
 
     def __repr__(self):
         return "msg_cfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
@@ -1958,7 +2173,7 @@ class msg_cfcheckpt:
 def hex_reverse(h):
     return "".join(reversed([h[i:i+2] for i in range(0, len(h), 2)]))
 
-class Hash:
+class Hash(Serializable):
     __slots__ = ("val")
 
     def __init__(self, val = 0):
@@ -1986,8 +2201,8 @@ class Hash:
     def deserialize(cls, f):
         return cls(deser_uint256(f))
 
-    def serialize(self):
-        return ser_uint256(self.val)
+    def serialize_into(self, w):
+        w += ser_uint256(self.val)
 
     def __hash__(self):
         return hash(self.val)
@@ -2005,24 +2220,28 @@ class Hash:
 def blake3(s):
     return Hash.from_rev_hex(_get_blake3_module().blake3(s).hexdigest())
 
+def deser_hash_vector(f):
+    return [Hash(h) for h in deser_uint256_vector(f)]
+
 def ser_varint(n):
-    r = b""
+    # Digits are produced least significant first and written out reversed.
+    r = bytearray()
 
     l=0;
     while True:
-        t = (n & 0x7F) | (0x80, 0x00)[l == 0]
-        r = struct.pack("B", t) + r
+        r.append((n & 0x7F) | (0x80, 0x00)[l == 0])
         if n <= 0x7F:
             break
         n = (n >> 7) - 1;
         l = l + 1
 
-    return r
+    r.reverse()
+    return bytes(r)
 
 def deser_varint(f):
     n = 0;
     while True: 
-        chData = struct.unpack("B", f.read(1))[0]
+        chData = _U8.unpack(f.read(1))[0]
         n = (n << 7) | (chData & 0x7F)
         if chData & 0x80:
             n = n + 1
@@ -2032,13 +2251,19 @@ def deser_varint(f):
     return n
 
 def ser_mweb_block(b):
+    w = bytearray()
+    ser_mweb_block_into(w, b)
+    return bytes(w)
+
+def ser_mweb_block_into(w, b):
     if b == None:
-        return struct.pack("B", 0)
+        w.append(0)
     else:
-        return struct.pack("B", 1) + b.serialize()
+        w.append(1)
+        b.serialize_into(w)
 
 def deser_mweb_block(f):
-    has_mweb = struct.unpack("B", f.read(1))[0]
+    has_mweb = _U8.unpack(f.read(1))[0]
     if has_mweb == 1:
         mweb_block = MWEBBlock()
         mweb_block.deserialize(f)
@@ -2047,13 +2272,19 @@ def deser_mweb_block(f):
         return None
 
 def ser_mweb_tx(t):
+    w = bytearray()
+    ser_mweb_tx_into(w, t)
+    return bytes(w)
+
+def ser_mweb_tx_into(w, t):
     if t == None:
-        return struct.pack("B", 0)
+        w.append(0)
     else:
-        return struct.pack("B", 1) + t.serialize()
+        w.append(1)
+        t.serialize_into(w)
 
 def deser_mweb_tx(f):
-    has_mweb = struct.unpack("B", f.read(1))[0]
+    has_mweb = _U8.unpack(f.read(1))[0]
     if has_mweb == 1:
         mweb_tx = MWEBTransaction()
         return mweb_tx.deserialize(f)
@@ -2061,7 +2292,7 @@ def deser_mweb_tx(f):
         return None
         
 
-class MWEBInput:
+class MWEBInput(Serializable):
     __slots__ = ("features", "output_id", "commitment", "input_pubkey",
                 "output_pubkey", "extradata", "signature", "hash")
 
@@ -2076,7 +2307,7 @@ class MWEBInput:
         self.hash = None
 
     def deserialize(self, f):
-        self.features = struct.unpack("B", f.read(1))[0]
+        self.features = _U8.unpack(f.read(1))[0]
         self.output_id = Hash.deserialize(f)
         self.commitment = deser_pubkey(f)
         self.output_pubkey = deser_pubkey(f)
@@ -2088,25 +2319,23 @@ class MWEBInput:
         self.signature = deser_signature(f)
         self.hash = None
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("B", self.features)
-        r += self.output_id.serialize()
-        r += ser_pubkey(self.commitment)
-        r += ser_pubkey(self.output_pubkey)
+    def serialize_into(self, w):
+        w += _U8.pack(self.features)
+        self.output_id.serialize_into(w)
+        w += ser_pubkey(self.commitment)
+        w += ser_pubkey(self.output_pubkey)
         if self.features & 1:
-            r += ser_pubkey(self.input_pubkey)
+            w += ser_pubkey(self.input_pubkey)
         if self.features & 2:
-            r += ser_compact_size(len(self.extradata))
-            r += ser_fixed_bytes(self.extradata, len(self.extradata))
-        r += ser_signature(self.signature)
-        return r
+            w += ser_compact_size(len(self.extradata))
+            w += ser_fixed_bytes(self.extradata, len(self.extradata))
+        w += ser_signature(self.signature)
     
     def rehash(self):
         self.hash = blake3(self.serialize())
         return self.hash.to_hex()
 
-class MWEBOutputMessage:
+class MWEBOutputMessage(Serializable):
     __slots__ = ("features", "key_exchange_pubkey", "view_tag", "masked_value",
                 "masked_nonce", "extradata", "hash")
 
@@ -2120,35 +2349,33 @@ class MWEBOutputMessage:
         self.hash = None
 
     def deserialize(self, f):
-        self.features = struct.unpack("B", f.read(1))[0]
+        self.features = _U8.unpack(f.read(1))[0]
         if self.features & 1:
             self.key_exchange_pubkey = deser_pubkey(f)
-            self.view_tag = struct.unpack("B", f.read(1))[0]
-            self.masked_value = struct.unpack("<q", f.read(8))[0]
+            self.view_tag = _U8.unpack(f.read(1))[0]
+            self.masked_value = _I64.unpack(f.read(8))[0]
             self.masked_nonce = deser_fixed_bytes(f, 16)
         self.extradata = None
         if self.features & 2:
             self.extradata = deser_fixed_bytes(f, deser_compact_size(f))
         self.hash = None
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("B", self.features)
+    def serialize_into(self, w):
+        w += _U8.pack(self.features)
         if self.features & 1:
-            r += ser_pubkey(self.key_exchange_pubkey)
-            r += struct.pack("B", self.view_tag)
-            r += struct.pack("<q", self.masked_value)
-            r += ser_fixed_bytes(self.masked_nonce, 16)
+            w += ser_pubkey(self.key_exchange_pubkey)
+            w += _U8.pack(self.view_tag)
+            w += _I64.pack(self.masked_value)
+            w += ser_fixed_bytes(self.masked_nonce, 16)
         if self.features & 2:
-            r += ser_compact_size(len(self.extradata))
-            r += ser_fixed_bytes(self.extradata, len(self.extradata))
-        return r
+            w += ser_compact_size(len(self.extradata))
+            w += ser_fixed_bytes(self.extradata, len(self.extradata))
     
     def rehash(self):
         self.hash = blake3(self.serialize())
         return self.hash.to_hex()
 
-class MWEBOutput:
+class MWEBOutput(Serializable):
     __slots__ = ("commitment", "sender_pubkey", "receiver_pubkey", "message",
                 "proof", "signature", "hash")
 
@@ -2170,21 +2397,19 @@ class MWEBOutput:
         self.signature = deser_signature(f)
         self.hash = None
 
-    def serialize(self):
-        r = b""
-        r += ser_pubkey(self.commitment)
-        r += ser_pubkey(self.sender_pubkey)
-        r += ser_pubkey(self.receiver_pubkey)
-        r += self.message.serialize()
-        r += ser_fixed_bytes(self.proof, 675)
-        r += ser_signature(self.signature)
-        return r
+    def serialize_into(self, w):
+        w += ser_pubkey(self.commitment)
+        w += ser_pubkey(self.sender_pubkey)
+        w += ser_pubkey(self.receiver_pubkey)
+        self.message.serialize_into(w)
+        w += ser_fixed_bytes(self.proof, 675)
+        w += ser_signature(self.signature)
     
     def rehash(self):
         self.hash = blake3(self.serialize())
         return self.hash.to_hex()
 
-class MWEBCompactOutput:
+class MWEBCompactOutput(Serializable):
     __slots__ = ("commitment", "sender_pubkey", "receiver_pubkey", "message",
                 "proof_hash", "signature", "hash")
 
@@ -2206,20 +2431,18 @@ class MWEBCompactOutput:
         self.signature = deser_signature(f)
         self.hash = None
 
-    def serialize(self):
-        r = b""
-        r += ser_pubkey(self.commitment)
-        r += ser_pubkey(self.sender_pubkey)
-        r += ser_pubkey(self.receiver_pubkey)
-        r += self.message.serialize()
-        r += self.proof_hash.serialize()
-        r += ser_signature(self.signature)
-        return r
+    def serialize_into(self, w):
+        w += ser_pubkey(self.commitment)
+        w += ser_pubkey(self.sender_pubkey)
+        w += ser_pubkey(self.receiver_pubkey)
+        self.message.serialize_into(w)
+        self.proof_hash.serialize_into(w)
+        w += ser_signature(self.signature)
 
     def __repr__(self):
         return "MWEBCompactOutput(commitment=%s)" % (repr(self.commitment))
 
-class MWEBKernel:
+class MWEBKernel(Serializable):
     __slots__ = ("features", "fee", "pegin", "pegouts", "lock_height",
                 "stealth_excess", "extradata", "excess", "signature", "hash")
 
@@ -2236,7 +2459,7 @@ class MWEBKernel:
         self.hash = None
 
     def deserialize(self, f):
-        self.features = struct.unpack("B", f.read(1))[0]
+        self.features = _U8.unpack(f.read(1))[0]
         self.fee = None
         if self.features & 1:
             self.fee = deser_varint(f)
@@ -2259,25 +2482,23 @@ class MWEBKernel:
         self.signature = deser_signature(f)
         self.hash = None
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("B", self.features)
+    def serialize_into(self, w):
+        w += _U8.pack(self.features)
         if self.features & 1:
-            r += ser_varint(self.fee)
+            w += ser_varint(self.fee)
         if self.features & 2:
-            r += ser_varint(self.pegin)
+            w += ser_varint(self.pegin)
         if self.features & 4:
-            r += ser_vector(self.pegouts)
+            ser_vector_into(w, self.pegouts)
         if self.features & 8:
-            r += ser_varint(self.lock_height)
+            w += ser_varint(self.lock_height)
         if self.features & 16:
-            r += ser_pubkey(self.stealth_excess)
+            w += ser_pubkey(self.stealth_excess)
         if self.features & 32:
-            r += ser_compact_size(len(self.extradata))
-            r += ser_fixed_bytes(self.extradata, len(self.extradata))
-        r += ser_pubkey(self.excess)
-        r += ser_signature(self.signature)
-        return r
+            w += ser_compact_size(len(self.extradata))
+            w += ser_fixed_bytes(self.extradata, len(self.extradata))
+        w += ser_pubkey(self.excess)
+        w += ser_signature(self.signature)
     
     def rehash(self):
         self.hash = blake3(self.serialize())
@@ -2287,7 +2508,7 @@ class MWEBKernel:
         return "MWEBKernel(features=%d, excess=%s)" % (self.features, repr(self.excess))
 
 
-class MWEBPegOut:
+class MWEBPegOut(Serializable):
     __slots__ = ("amount", "script_pubkey")
 
     def __init__(self):
@@ -2298,16 +2519,14 @@ class MWEBPegOut:
         self.amount = deser_varint(f)
         self.script_pubkey = deser_string(f)
 
-    def serialize(self):
-        r = b""
-        r += ser_varint(self.amount)
-        r += ser_string(self.script_pubkey)
-        return r
+    def serialize_into(self, w):
+        w += ser_varint(self.amount)
+        w += ser_string(self.script_pubkey)
 
     def __repr__(self):
         return "MWEBPegOut(amount=%d, script_pubkey=%s)" % (self.amount, repr(self.script_pubkey))
 
-class MWEBTxBody:
+class MWEBTxBody(Serializable):
     __slots__ = ("inputs", "outputs", "kernels")
 
     def __init__(self):
@@ -2320,18 +2539,16 @@ class MWEBTxBody:
         self.outputs = deser_vector(f, MWEBOutput)
         self.kernels = deser_vector(f, MWEBKernel)
 
-    def serialize(self):
-        r = b""
-        r += ser_vector(self.inputs)
-        r += ser_vector(self.outputs)
-        r += ser_vector(self.kernels)
-        return r
+    def serialize_into(self, w):
+        ser_vector_into(w, self.inputs)
+        ser_vector_into(w, self.outputs)
+        ser_vector_into(w, self.kernels)
 
     def __repr__(self):
         return "MWEBTxBody(inputs=%s, outputs=%s, kernels=%s)" % (repr(self.inputs), repr(self.outputs), repr(self.kernels))
 
 
-class MWEBTransaction:
+class MWEBTransaction(Serializable):
     __slots__ = ("kernel_offset", "stealth_offset", "body", "hash")
 
     def __init__(self):
@@ -2346,12 +2563,10 @@ class MWEBTransaction:
         self.body.deserialize(f)
         self.hash = None
 
-    def serialize(self):
-        r = b""
-        r += self.kernel_offset.serialize()
-        r += self.stealth_offset.serialize()
-        r += self.body.serialize()
-        return r
+    def serialize_into(self, w):
+        self.kernel_offset.serialize_into(w)
+        self.stealth_offset.serialize_into(w)
+        self.body.serialize_into(w)
     
     def rehash(self):
         self.hash = blake3(self.serialize())
@@ -2360,7 +2575,7 @@ class MWEBTransaction:
     def __repr__(self):
         return "MWEBTransaction(kernel_offset=%s, stealth_offset=%s, body=%s, hash=%s)" % (repr(self.kernel_offset), repr(self.stealth_offset), repr(self.body), repr(self.hash))
 
-class MWEBHeader:
+class MWEBHeader(Serializable):
     __slots__ = ("height", "output_root", "kernel_root", "leafset_root",
                 "kernel_offset", "stealth_offset", "num_txos", "num_kernels", "hash")
 
@@ -2400,17 +2615,15 @@ class MWEBHeader:
         self.num_kernels = deser_varint(f)
         self.hash = None
 
-    def serialize(self):
-        r = b""
-        r += ser_varint(self.height)
-        r += self.output_root.serialize()
-        r += self.kernel_root.serialize()
-        r += self.leafset_root.serialize()
-        r += self.kernel_offset.serialize()
-        r += self.stealth_offset.serialize()
-        r += ser_varint(self.num_txos)
-        r += ser_varint(self.num_kernels)
-        return r
+    def serialize_into(self, w):
+        w += ser_varint(self.height)
+        self.output_root.serialize_into(w)
+        self.kernel_root.serialize_into(w)
+        self.leafset_root.serialize_into(w)
+        self.kernel_offset.serialize_into(w)
+        self.stealth_offset.serialize_into(w)
+        w += ser_varint(self.num_txos)
+        w += ser_varint(self.num_kernels)
     
     def rehash(self):
         self.hash = blake3(self.serialize())
@@ -2433,7 +2646,7 @@ class MWEBHeader:
             and self.num_kernels == other.num_kernels
         )
 
-class MWEBBlock:
+class MWEBBlock(Serializable):
     __slots__ = ("header", "body")
 
     def __init__(self, header = MWEBHeader()):
@@ -2444,11 +2657,9 @@ class MWEBBlock:
         self.header.deserialize(f)
         self.body.deserialize(f)
 
-    def serialize(self):
-        r = b""
-        r += self.header.serialize()
-        r += self.body.serialize()
-        return r
+    def serialize_into(self, w):
+        self.header.serialize_into(w)
+        self.body.serialize_into(w)
     
     def rehash(self):
         return self.header.rehash()
@@ -2457,7 +2668,7 @@ class MWEBBlock:
         return "MWEBBlock(header=%s, body=%s)" % (repr(self.header), repr(self.body))
 
 
-class CMerkleBlockWithMWEB:
+class CMerkleBlockWithMWEB(Serializable):
     __slots__ = ("merkle", "hogex", "mweb_header")
 
     def __init__(self):
@@ -2470,18 +2681,16 @@ class CMerkleBlockWithMWEB:
         self.hogex.deserialize(f)
         self.mweb_header.deserialize(f)
 
-    def serialize(self):
-        r = b""
-        r += self.merkle.serialize()
-        r += self.hogex.serialize_with_mweb()
-        r += self.mweb_header.serialize()
-        return r
+    def serialize_into(self, w):
+        self.merkle.serialize_into(w)
+        w += self.hogex.serialize_with_mweb()
+        self.mweb_header.serialize_into(w)
 
     def __repr__(self):
         return "CMerkleBlockWithMWEB(merkle=%s, hogex=%s, mweb_header=%s)" % (repr(self.merkle), repr(self.hogex), repr(self.mweb_header))
 
 
-class msg_mwebheader:
+class msg_mwebheader(Serializable):
     __slots__ = ("merkleblockwithmweb",)
     msgtype = b"mwebheader"
 
@@ -2491,8 +2700,8 @@ class msg_mwebheader:
     def deserialize(self, f):
         self.merkleblockwithmweb.deserialize(f)
 
-    def serialize(self):
-        return self.merkleblockwithmweb.serialize()
+    def serialize_into(self, w):
+        self.merkleblockwithmweb.serialize_into(w)
 
     def header_hash(self):
         self.merkleblockwithmweb.merkle.header.rehash()
@@ -2501,7 +2710,7 @@ class msg_mwebheader:
     def __repr__(self):
         return "msg_mwebheader(merkleblockwithmweb=%s)" % (repr(self.merkleblockwithmweb))
 
-class msg_mwebleafset:
+class msg_mwebleafset(Serializable):
     __slots__ = ("block_hash", "leafset")
     msgtype = b"mwebleafset"
 
@@ -2513,18 +2722,16 @@ class msg_mwebleafset:
         self.block_hash = Hash.deserialize(f)
         self.leafset = deser_fixed_bytes(f, deser_compact_size(f))
 
-    def serialize(self):
-        r = b""
-        r += self.block_hash.serialize()
-        r += ser_compact_size(len(self.leafset))
-        r += ser_fixed_bytes(self.leafset, len(self.leafset))
-        return r
+    def serialize_into(self, w):
+        self.block_hash.serialize_into(w)
+        w += ser_compact_size(len(self.leafset))
+        w += ser_fixed_bytes(self.leafset, len(self.leafset))
 
     def __repr__(self):
         leafset_hex = ser_fixed_bytes(self.leafset, len(self.leafset)).hex() #encode(self.leafset, 'hex_codec').decode('ascii')
         return "msg_mwebleafset(block_hash=%s, leafset=%s%s)" % (repr(self.block_hash), repr(leafset_hex)[:50], "..." if len(leafset_hex) > 50 else "")
 
-class msg_getmwebutxos:
+class msg_getmwebutxos(Serializable):
     __slots__ = ("block_hash", "start_index", "num_requested", "output_format")
     msgtype = b"getmwebutxos"
 
@@ -2537,23 +2744,21 @@ class msg_getmwebutxos:
     def deserialize(self, f):
         self.block_hash = Hash.deserialize(f)
         self.start_index = deser_varint(f)
-        self.num_requested = (struct.unpack("<B", f.read(1))[0] << 8) + struct.unpack("<B", f.read(1))[0]
-        self.output_format = struct.unpack("B", f.read(1))[0]
+        self.num_requested = (_U8.unpack(f.read(1))[0] << 8) + _U8.unpack(f.read(1))[0]
+        self.output_format = _U8.unpack(f.read(1))[0]
 
-    def serialize(self):
-        r = b""
-        r += self.block_hash.serialize()
-        r += ser_varint(self.start_index)
-        r += struct.pack("B", self.num_requested >> 8) + struct.pack("B", self.num_requested & 0xFF)
-        r += struct.pack("B", self.output_format)
-        return r
+    def serialize_into(self, w):
+        self.block_hash.serialize_into(w)
+        w += ser_varint(self.start_index)
+        w += _U16_BE.pack(self.num_requested)
+        w += _U8.pack(self.output_format)
 
     def __repr__(self):
         return ("msg_getmwebutxos(block_hash=%s, start_index=%d, num_requested=%d, output_format=%d)" %
             (repr(self.block_hash), self.start_index, self.num_requested, self.output_format))
 
 
-class msg_mwebutxos:
+class msg_mwebutxos(Serializable):
     __slots__ = ("block_hash", "start_index", "output_format", "utxos", "proof_hashes")
     msgtype = b"mwebutxos"
 
@@ -2567,26 +2772,113 @@ class msg_mwebutxos:
     def deserialize(self, f):
         self.block_hash = Hash.deserialize(f)
         self.start_index = deser_varint(f)
-        self.output_format = struct.unpack("B", f.read(1))[0]
+        self.output_format = _U8.unpack(f.read(1))[0]
 
         if self.output_format == 0:
-            self.utxos = deser_vector(f, Hash)
+            self.utxos = deser_hash_vector(f)
         elif self.output_format == 1:
             self.utxos = deser_vector(f, MWEBOutput)
         else:
             self.utxos = deser_vector(f, MWEBCompactOutput)
 
-        self.proof_hashes = deser_vector(f, Hash)
+        self.proof_hashes = deser_hash_vector(f)
 
-    def serialize(self):
-        r = b""
-        r += self.block_hash.serialize()
-        r += ser_varint(self.start_index)
-        r += struct.pack("B", self.output_format)
-        r += ser_vector(self.utxos)
-        r += ser_vector(self.proof_hashes)
-        return r
+    def serialize_into(self, w):
+        self.block_hash.serialize_into(w)
+        w += ser_varint(self.start_index)
+        w += _U8.pack(self.output_format)
+        ser_vector_into(w, self.utxos)
+        ser_vector_into(w, self.proof_hashes)
 
     def __repr__(self):
         return ("msg_mwebutxos(block_hash=%s, start_index=%d, output_format=%d, utxos=%s, proof_hashes=%s)" %
             (repr(self.block_hash), self.start_index, self.output_format, repr(self.utxos), repr(self.proof_hashes)))
+
+
+class TestFrameworkMessages(unittest.TestCase):
+    def test_ser_compact_size(self):
+        for n, hex_str in [(0, "00"), (252, "fc"), (253, "fdfd00"), (0xffff, "fdffff"),
+                           (0x10000, "fe00000100"), (0x100000000, "ff0000000001000000")]:
+            assert_equal(ser_compact_size(n).hex(), hex_str)
+            assert_equal(deser_compact_size(BytesIO(ser_compact_size(n))), n)
+
+    def test_ser_varint(self):
+        for n in [0, 1, 0x7f, 0x80, 0x407f, 0x4080, 2**63]:
+            assert_equal(deser_varint(BytesIO(ser_varint(n))), n)
+        assert_equal(ser_varint(0x80).hex(), "8000")
+
+    def test_headers_as_blocks(self):
+        headers = [CBlockHeader() for _ in range(3)]
+        for i, h in enumerate(headers):
+            h.nNonce = i
+        assert_equal(msg_headers(headers).serialize(), ser_vector([CBlock(h) for h in headers]))
+        m = msg_headers()
+        m.deserialize(BytesIO(msg_headers(headers).serialize()))
+        assert_equal([h.nNonce for h in m.headers], [0, 1, 2])
+
+    def test_headers_bulk_decoding(self):
+        headers = [CBlockHeader() for _ in range(3)]
+        for i, h in enumerate(headers):
+            h.nNonce = i
+        m = msg_headers()
+        m.deserialize(BytesIO(msg_headers(headers).serialize()))
+        for h, expected in zip(m.headers, headers):
+            assert_equal(h.sha256, expected.rehash())
+        # A header followed by transactions is still decoded as a block
+        block = CBlock(headers[2])
+        block.vtx = [CTransaction()]
+        m = msg_headers()
+        m.deserialize(BytesIO(ser_vector([CBlock(headers[0]), block, CBlock(headers[1])])))
+        assert_equal([h.nNonce for h in m.headers], [0, 2, 1])
+        with self.assertRaises(struct.error):
+            msg_headers().deserialize(BytesIO(msg_headers(headers).serialize()[:-1]))
+
+    def test_vector_decoding(self):
+        inv = [CInv(MSG_TX, 1 << 255), CInv(MSG_BLOCK, 7)]
+        m = msg_inv()
+        m.deserialize(BytesIO(msg_inv(inv).serialize()))
+        assert_equal(m.inv, inv)
+        assert_equal(deser_uint256_vector(BytesIO(ser_uint256_vector([3, 1 << 200]))), [3, 1 << 200])
+        m = msg_mwebutxos()
+        m.deserialize(BytesIO(msg_mwebutxos(Hash(1), 2, 0, [Hash(3)], [Hash(4), Hash(5)]).serialize()))
+        assert_equal(m.utxos, [Hash(3)])
+        assert_equal(m.proof_hashes, [Hash(4), Hash(5)])
+
+    def test_overridden_serialize(self):
+        class ReversedTx(CTransaction):
+            __slots__ = ()
+
+            def serialize(self):
+                return super().serialize()[::-1]
+
+        tx = ReversedTx()
+        tx.vout.append(CTxOut(1, b"\x51"))
+        assert_equal(tx.serialize(), CTransaction(tx).serialize()[::-1])
+        assert_equal(ser_vector([tx]), b"\x01" + tx.serialize())
+        assert_equal(msg_tx(tx).serialize(), CTransaction(tx).serialize_with_mweb())
+
+    def test_solve_with_old_scrypt_module(self):
+        """A litecoin_scrypt build without scan_nonces is used through its getPoWHash."""
+        import sys
+        import types
+        old_module = types.ModuleType("litecoin_scrypt")
+        old_module.getPoWHash = _hashlib_scrypt_pow_hash
+        names = ("litecoin_scrypt", "test_framework.litecoin_scrypt")
+        saved = {name: sys.modules.get(name) for name in names}
+        sys.modules.update(dict.fromkeys(names, old_module))
+        _get_litecoin_scrypt.cache_clear()
+        try:
+            scrypt = _get_litecoin_scrypt()
+            assert isinstance(scrypt, _LitecoinScryptFallback)
+            assert_equal(scrypt.getPoWHash, _hashlib_scrypt_pow_hash)
+            block = CBlock()
+            block.nBits = 0x207fffff
+            block.solve()
+            assert block.scrypt256 <= uint256_from_compact(block.nBits)
+        finally:
+            for name, module in saved.items():
+                if module is None:
+                    del sys.modules[name]
+                else:
+                    sys.modules[name] = module
+            _get_litecoin_scrypt.cache_clear()
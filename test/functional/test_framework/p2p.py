@@ -11,7 +11,9 @@ node's p2p interface. They can be used to send messages to the node, and
 callbacks can be registered that execute when messages are received from the
 node. Messages are sent to/received from the node on an asyncio event loop.
 State held inside the objects must be guarded by the p2p_lock to avoid data
-races between the main testing thread and the event loop.
+races between the main testing thread and the event loop. With a sharded
+NetworkThread (num_loops > 1) every connection has its own lock instead, which
+must then be taken as peer.p2p_lock.
 
 P2PConnection: A low-level connection object to a node's P2P interface
 P2PInterface: A high-level interface object for communicating to a node over P2P
@@ -21,16 +23,30 @@ P2PTxInvStore: A p2p interface class that inherits from P2PDataStore, and keeps
               a count of how many times each txid has been announced."""
 
 import asyncio
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
 from io import BytesIO
+import itertools
 import logging
+import socket
 import struct
 import sys
 import threading
+import time
+import unittest
+from unittest import mock
 
 from test_framework.messages import (
+    CBlock,
     CBlockHeader,
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
     Hash,
+    hash256,
+    lazy_message_class,
+    LazyCBlock,
     MAX_HEADERS_RESULTS,
     MIN_VERSION_SUPPORTED,
     msg_addr,
@@ -50,6 +66,7 @@ from test_framework.messages import (
     msg_getblocks,
     msg_getblocktxn,
     msg_getdata,
+    msg_generic,
     msg_getheaders,
     msg_getmwebutxos,
     msg_headers,
@@ -75,7 +92,6 @@ from test_framework.messages import (
     NODE_MWEB,
     NODE_NETWORK,
     NODE_WITNESS,
-    sha256,
 )
 from test_framework.util import (
     MAX_NODES,
@@ -123,6 +139,25 @@ MESSAGEMAP = {
     b"wtxidrelay": msg_wtxidrelay,
 }
 
+# Large messages that connections with lazy_messages set keep undecoded until
+# their fields are first read. Blocks decode their header right away, so that
+# their hash is available without decoding the transactions.
+LAZY_MESSAGEMAP = {
+    b"block": lambda payload: msg_block(LazyCBlock.from_payload(payload)),
+    b"blocktxn": lazy_message_class(msg_blocktxn).from_payload,
+    b"cmpctblock": lazy_message_class(msg_cmpctblock).from_payload,
+    b"headers": lazy_message_class(msg_headers).from_payload,
+    b"mwebutxos": lazy_message_class(msg_mwebutxos).from_payload,
+}
+
+# magic (4) + msgtype (12) + payload length (4) + checksum (4)
+MSG_HEADER = struct.Struct("<4s12sI4s")
+MSG_HEADER_SIZE = MSG_HEADER.size
+
+# Maximum number of bytes that may wait in a connection's send queue before
+# send_messages() blocks until the network thread has written some of them.
+MAX_SEND_QUEUE_BYTES = 8 * 1024 * 1024
+
 MAGIC_BYTES = {
     "mainnet": b"\xfb\xc0\xb6\xdb",   # mainnet
     "testnet4": b"\xfd\xd2\xc8\xf1",  # testnet4
@@ -142,12 +177,46 @@ class P2PConnection(asyncio.Protocol):
     - logging messages as they are sent and received
 
     This class contains no logic for handing the P2P message payloads. It must be
-    sub-classed and the on_message() callback overridden."""
+    sub-classed and the on_message() callback overridden.
 
-    def __init__(self):
+    With lazy_messages set, the messages in LAZY_MESSAGEMAP are passed to
+    on_message() undecoded and deserialized when their fields are first read.
+    This saves CPU time and memory for tests that receive many blocks but
+    look at few of them. Decoding errors are then raised by that first read
+    instead of by the network thread.
+
+    Outgoing messages go through a send queue of at most
+    MAX_SEND_QUEUE_BYTES. While the transport's write buffer is full, batches
+    are held back in that queue and senders on other threads block until it
+    drains, so that flooding a node that is slow to read does not buffer
+    unbounded amounts of data in the test."""
+
+    def __init__(self, *, lazy_messages=False):
         # The underlying transport of the connection.
         # Should only call methods on this from the NetworkThread, c.f. call_soon_threadsafe
         self._transport = None
+        # The event loop running this connection, set when connecting.
+        self._loop = None
+        self.lazy_messages = lazy_messages
+        # Guards the state shared with the test logic, and is notified
+        # whenever that state changed. All connections share p2p_lock unless
+        # the NetworkThread is sharded, so that connections on different loops
+        # do not contend for it.
+        if len(NetworkThread.network_event_loops) > 1:
+            self.p2p_lock = threading.Lock()
+            self.p2p_condition = threading.Condition(self.p2p_lock)
+        else:
+            self.p2p_lock = p2p_lock
+            self.p2p_condition = p2p_condition
+        # Batches of frames that wait for the transport to resume writing.
+        # Only accessed from the NetworkThread.
+        self._send_queue = deque()
+        self._writing_paused = False
+        # Bytes handed to the NetworkThread but not written to the transport
+        # yet, and the send statistics. Guarded by _send_condition.
+        self._send_condition = threading.Condition()
+        self._send_queue_bytes = 0
+        self.reset_send_stats()
 
     @property
     def is_connected(self):
@@ -160,13 +229,13 @@ class P2PConnection(asyncio.Protocol):
         self.dstport = dstport
         # The initial message to send after the connection was made:
         self.on_connection_send_msg = None
-        self.recvbuf = b""
+        self._reset_recvbuf()
         self.magic_bytes = MAGIC_BYTES[net]
 
     def peer_connect(self, dstaddr, dstport, *, net, timeout_factor):
         self.peer_connect_helper(dstaddr, dstport, net, timeout_factor)
 
-        loop = NetworkThread.network_event_loop
+        loop = self._loop = NetworkThread.next_event_loop()
         logger.debug('Connecting to Litecoin Node: %s:%d' % (self.dstaddr, self.dstport))
         coroutine = loop.create_connection(lambda: self, host=self.dstaddr, port=self.dstport)
         return lambda: loop.call_soon_threadsafe(loop.create_task, coroutine)
@@ -174,12 +243,16 @@ class P2PConnection(asyncio.Protocol):
     def peer_accept_connection(self, connect_id, connect_cb=lambda: None, *, net, timeout_factor):
         self.peer_connect_helper('0', 0, net, timeout_factor)
 
+        # Connections from the node are accepted by the listening server, which
+        # runs on the first event loop.
+        self._loop = NetworkThread.network_event_loop
         logger.debug('Listening for Litecoin Node with id: {}'.format(connect_id))
         return lambda: NetworkThread.listen(self, connect_cb, idx=connect_id)
 
     def peer_disconnect(self):
         # Connection could have already been closed by other end.
-        NetworkThread.network_event_loop.call_soon_threadsafe(lambda: self._transport and self._transport.abort())
+        loop = self._loop or NetworkThread.network_event_loop
+        loop.call_soon_threadsafe(lambda: self._transport and self._transport.abort())
 
     # Connection and disconnection methods
 
@@ -192,6 +265,8 @@ class P2PConnection(asyncio.Protocol):
             self.send_message(self.on_connection_send_msg)
             self.on_connection_send_msg = None  # Never used again
         self.on_open()
+        with self.p2p_condition:
+            self.p2p_condition.notify_all()
 
     def connection_lost(self, exc):
         """asyncio callback when a connection is closed."""
@@ -200,11 +275,28 @@ class P2PConnection(asyncio.Protocol):
         else:
             logger.debug("Closed connection to: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = None
-        self.recvbuf = b""
+        self._writing_paused = False
+        while self._send_queue:
+            _, nbytes = self._send_queue.popleft()
+            self._release_send_queue(nbytes)
+        with self._send_condition:
+            self._send_condition.notify_all()
+        self._reset_recvbuf()
         self.on_close()
+        with self.p2p_condition:
+            self.p2p_condition.notify_all()
 
     # Socket read methods
 
+    def _reset_recvbuf(self):
+        # Received bytes are appended to recvbuf and consumed from
+        # _recv_offset onwards, so that a message is never copied more than
+        # once no matter how many chunks it arrives in. _recv_header caches
+        # the parsed header of a message whose payload is still incomplete.
+        self.recvbuf = bytearray()
+        self._recv_offset = 0
+        self._recv_header = None
+
     def data_received(self, t):
         """asyncio callback when data is read from the socket."""
         if len(t) > 0:
@@ -219,33 +311,55 @@ class P2PConnection(asyncio.Protocol):
         the on_message callback for processing."""
         try:
             while True:
-                if len(self.recvbuf) < 4:
+                msg = self._read_frame()
+                if msg is None:
                     return
-                if self.recvbuf[:4] != self.magic_bytes:
-                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(self.recvbuf)))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                    return
-                msgtype = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                    return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                th = sha256(msg)
-                h = sha256(th)
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if msgtype not in MESSAGEMAP:
-                    raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(msg)))
-                f = BytesIO(msg)
-                t = MESSAGEMAP[msgtype]()
-                t.deserialize(f)
-                self._log_message("receive", t)
-                self.on_message(t)
+                self._log_message("receive", msg)
+                self.on_message(msg)
         except Exception as e:
             logger.exception('Error reading message:', repr(e))
             raise
+        finally:
+            self._compact_recvbuf()
+
+    def _read_frame(self):
+        """Decode the next complete P2P message in the recv buffer.
+
+        Returns None if more data is needed."""
+        buf = self.recvbuf
+        avail = len(buf) - self._recv_offset
+        if self._recv_header is None:
+            if avail < 4:
+                return None
+            if buf[self._recv_offset:self._recv_offset + 4] != self.magic_bytes:
+                raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(bytes(buf[self._recv_offset:]))))
+            if avail < MSG_HEADER_SIZE:
+                return None
+            _, msgtype, msglen, checksum = MSG_HEADER.unpack_from(buf, self._recv_offset)
+            self._recv_header = (msgtype.split(b"\x00", 1)[0], msglen, checksum)
+        msgtype, msglen, checksum = self._recv_header
+        if avail < MSG_HEADER_SIZE + msglen:
+            return None
+        start = self._recv_offset + MSG_HEADER_SIZE
+        with memoryview(buf) as view, view[start:start + msglen] as payload:
+            if hash256(payload)[:4] != checksum:
+                raise ValueError("got bad checksum " + repr(bytes(buf[self._recv_offset:])))
+            if msgtype not in MESSAGEMAP:
+                raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(bytes(payload))))
+            data = bytes(payload)
+        self._recv_offset = start + msglen
+        self._recv_header = None
+        if self.lazy_messages and msgtype in LAZY_MESSAGEMAP:
+            return LAZY_MESSAGEMAP[msgtype](data)
+        t = MESSAGEMAP[msgtype]()
+        t.deserialize(BytesIO(data))
+        return t
+
+    def _compact_recvbuf(self):
+        """Drop the already consumed prefix of the recv buffer."""
+        if self._recv_offset:
+            del self.recvbuf[:self._recv_offset]
+            self._recv_offset = 0
 
     def on_message(self, message):
         """Callback for processing a P2P payload. Must be overridden by derived class."""
@@ -262,17 +376,122 @@ class P2PConnection(asyncio.Protocol):
         self._log_message("send", message)
         return self.send_raw_message(tmsg)
 
+    def send_messages(self, messages):
+        """Send several P2P messages over the socket.
+
+        The messages are serialized and framed in the calling thread and
+        handed to the connection's event loop as a single batch, which is
+        written to the transport with one writelines() call. This is much
+        cheaper than calling send_message() for each of them when sending many
+        small messages. Blocks while the send queue is full."""
+        frames = []
+        for message in messages:
+            frames.append(self.build_message(message))
+            self._log_message("send", message)
+        self.send_raw_messages(frames)
+
     def send_raw_message(self, raw_message_bytes):
+        self.send_raw_messages([raw_message_bytes])
+
+    def send_raw_messages(self, frames):
+        """Send a batch of already framed messages over the socket, in order."""
         if not self.is_connected:
             raise IOError('Not connected')
-
-        def maybe_write():
-            if not self._transport:
-                return
-            if self._transport.is_closing():
-                return
-            self._transport.write(raw_message_bytes)
-        NetworkThread.network_event_loop.call_soon_threadsafe(maybe_write)
+        if not frames:
+            return
+        nbytes = sum(map(len, frames))
+        self._reserve_send_queue(nbytes)
+        self._loop.call_soon_threadsafe(self._write_frames, frames, nbytes)
+
+    def _reserve_send_queue(self, nbytes):
+        """Account for nbytes entering the send queue, waiting for room first.
+
+        A batch larger than MAX_SEND_QUEUE_BYTES is let through once the queue
+        is empty. Callers on an event loop never wait, as that could block
+        the loop that drains the queue."""
+        with self._send_condition:
+            if self._send_stats_start is None:
+                self._send_stats_start = time.perf_counter()
+            if not self._on_event_loop():
+                def has_room():
+                    return (not self.is_connected or self._send_queue_bytes == 0 or
+                            self._send_queue_bytes + nbytes <= MAX_SEND_QUEUE_BYTES)
+                timeout = 60 * getattr(self, "timeout_factor", 1)
+                if not self._send_condition.wait_for(has_room, timeout=timeout):
+                    raise AssertionError("Send queue to {}:{} did not drain within {} seconds".format(self.dstaddr, self.dstport, timeout))
+            self._send_queue_bytes += nbytes
+
+    def _release_send_queue(self, nbytes):
+        with self._send_condition:
+            self._send_queue_bytes -= nbytes
+            self._send_condition.notify_all()
+
+    @staticmethod
+    def _on_event_loop():
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return True
+
+    def _write_frames(self, frames, nbytes):
+        """Write a batch of frames, or queue it while writing is paused. Runs on the NetworkThread."""
+        if not self._transport or self._transport.is_closing():
+            self._release_send_queue(nbytes)
+            return
+        if self._writing_paused or self._send_queue:
+            self._send_queue.append((frames, nbytes))
+            return
+        self._write_to_transport(frames, nbytes)
+
+    def _write_to_transport(self, frames, nbytes):
+        self._transport.writelines(frames)
+        with self._send_condition:
+            self._sent_messages += len(frames)
+            self._sent_bytes += nbytes
+            self._send_stats_end = time.perf_counter()
+        self._release_send_queue(nbytes)
+
+    def pause_writing(self):
+        """asyncio callback when the transport's write buffer is full."""
+        self._writing_paused = True
+
+    def resume_writing(self):
+        """asyncio callback when the transport's write buffer has drained."""
+        self._writing_paused = False
+        while self._send_queue and not self._writing_paused:
+            frames, nbytes = self._send_queue.popleft()
+            if not self._transport or self._transport.is_closing():
+                self._release_send_queue(nbytes)
+            else:
+                self._write_to_transport(frames, nbytes)
+
+    def reset_send_stats(self):
+        """Restart the throughput measurement of send_stats()."""
+        with self._send_condition:
+            self._sent_messages = 0
+            self._sent_bytes = 0
+            self._send_stats_start = None
+            self._send_stats_end = None
+
+    def send_stats(self):
+        """Return the number of messages and bytes written to the transport
+        since the last reset_send_stats(), and the rates at which they were
+        sent, measured from the first send to the last write."""
+        with self._send_condition:
+            stats = {
+                "messages": self._sent_messages,
+                "bytes": self._sent_bytes,
+                "seconds": 0.0,
+                "messages_per_second": 0.0,
+                "bytes_per_second": 0.0,
+            }
+            if self._send_stats_start is not None and self._send_stats_end is not None:
+                stats["seconds"] = self._send_stats_end - self._send_stats_start
+        if stats["seconds"] > 0:
+            stats["messages_per_second"] = stats["messages"] / stats["seconds"]
+            stats["bytes_per_second"] = stats["bytes"] / stats["seconds"]
+        return stats
 
     # Class utility methods
 
@@ -280,18 +499,21 @@ class P2PConnection(asyncio.Protocol):
         """Build a serialized P2P message"""
         msgtype = message.msgtype
         data = message.serialize()
+        if len(msgtype) <= 12:
+            return MSG_HEADER.pack(self.magic_bytes, msgtype, len(data), hash256(data)[:4]) + data
+        # An overlong msgtype yields a malformed header; keep it as is.
         tmsg = self.magic_bytes
         tmsg += msgtype
         tmsg += b"\x00" * (12 - len(msgtype))
         tmsg += struct.pack("<I", len(data))
-        th = sha256(data)
-        h = sha256(th)
-        tmsg += h[:4]
+        tmsg += hash256(data)[:4]
         tmsg += data
         return tmsg
 
     def _log_message(self, direction, msg):
         """Logs a message being sent or received over the connection."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         if direction == "send":
             log_message = "Send message to "
         elif direction == "receive":
@@ -311,8 +533,8 @@ class P2PInterface(P2PConnection):
 
     Individual testcases should subclass this and override the on_* methods
     if they want to alter message handling behaviour."""
-    def __init__(self, support_addrv2=False):
-        super().__init__()
+    def __init__(self, support_addrv2=False, lazy_messages=False):
+        super().__init__(lazy_messages=lazy_messages)
 
         # Track number of messages of each type received.
         # Should be read-only in a test.
@@ -362,7 +584,7 @@ class P2PInterface(P2PConnection):
 
         We keep a count of how many of each message type has been received
         and the most recent message of each type."""
-        with p2p_lock:
+        with self.p2p_lock:
             try:
                 msgtype = message.msgtype.decode('ascii')
                 self.message_count[msgtype] += 1
@@ -371,6 +593,8 @@ class P2PInterface(P2PConnection):
             except:
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
+            finally:
+                self.p2p_condition.notify_all()
 
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
@@ -441,11 +665,11 @@ class P2PInterface(P2PConnection):
                 assert self.is_connected
             return test_function_in()
 
-        wait_until_helper(test_function, timeout=timeout, lock=p2p_lock, timeout_factor=self.timeout_factor)
+        wait_until_helper(test_function, timeout=timeout, lock=self.p2p_condition, timeout_factor=self.timeout_factor)
 
     def wait_for_connect(self, timeout=60):
         test_function = lambda: self.is_connected
-        wait_until_helper(test_function, timeout=timeout, lock=p2p_lock)
+        wait_until_helper(test_function, timeout=timeout, lock=self.p2p_condition)
 
     def wait_for_disconnect(self, timeout=60):
         test_function = lambda: not self.is_connected
@@ -574,34 +798,67 @@ class P2PInterface(P2PConnection):
 # This lock should be acquired in the thread running the test logic to synchronize
 # access to any data shared with the P2PInterface or P2PConnection.
 p2p_lock = threading.Lock()
+# Notified (with p2p_lock held) whenever a P2PInterface has delivered a message
+# or a connection was opened or closed, so that wait_until() can re-evaluate its
+# predicate right away instead of polling.
+p2p_condition = threading.Condition(p2p_lock)
 
 
 class NetworkThread(threading.Thread):
+    """Runs the asyncio event loops of all P2P connections.
+
+    By default all connections share one event loop. With num_loops > 1,
+    connections made with peer_connect() are distributed round-robin over
+    that many loops, each running in its own thread, so that a test can
+    drive hundreds of peers without one busy connection delaying all of
+    the others. Connections accepted from the node, and the listening
+    servers, always run on the first loop (network_event_loop)."""
     network_event_loop = None
+    network_event_loops = []
 
-    def __init__(self):
+    def __init__(self, num_loops=1):
         super().__init__(name="NetworkThread")
         # There is only one event loop and no more than one thread must be created
         assert not self.network_event_loop
+        assert num_loops >= 1
 
         NetworkThread.listeners = {}
         NetworkThread.protos = {}
         if sys.platform == 'win32':
             asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-        NetworkThread.network_event_loop = asyncio.new_event_loop()
+        NetworkThread.network_event_loops = [asyncio.new_event_loop() for _ in range(num_loops)]
+        NetworkThread.network_event_loop = NetworkThread.network_event_loops[0]
+        NetworkThread._next_loop = itertools.count()
+        self._loop_threads = [
+            threading.Thread(target=loop.run_forever, name="NetworkThread-{}".format(i), daemon=True)
+            for i, loop in enumerate(self.network_event_loops[1:], start=1)
+        ]
 
     def run(self):
         """Start the network thread."""
+        for thread in self._loop_threads:
+            thread.start()
         self.network_event_loop.run_forever()
 
     def close(self, timeout=10):
-        """Close the connections and network event loop."""
-        self.network_event_loop.call_soon_threadsafe(self.network_event_loop.stop)
-        wait_until_helper(lambda: not self.network_event_loop.is_running(), timeout=timeout)
-        self.network_event_loop.close()
+        """Close the connections and network event loops."""
+        loops = self.network_event_loops
+        for loop in loops:
+            loop.call_soon_threadsafe(loop.stop)
+        wait_until_helper(lambda: not any(loop.is_running() for loop in loops), timeout=timeout)
+        for loop in loops:
+            loop.close()
         self.join(timeout)
-        # Safe to remove event loop.
+        for thread in self._loop_threads:
+            thread.join(timeout)
+        # Safe to remove event loops.
         NetworkThread.network_event_loop = None
+        NetworkThread.network_event_loops = []
+
+    @classmethod
+    def next_event_loop(cls):
+        """Return the event loop to run the next outbound connection on."""
+        return cls.network_event_loops[next(cls._next_loop) % len(cls.network_event_loops)]
 
     @classmethod
     def listen(cls, p2p, callback, port=None, addr=None, idx=1):
@@ -654,14 +911,46 @@ class P2PDataStore(P2PInterface):
         # store of blocks. key is block hash, value is a CBlock object
         self.block_store = {}
         self.last_block_hash = ''
+        # the chain of block hashes ending in last_block_hash, oldest first,
+        # and the position of each of those hashes in it. Updated lazily by
+        # _update_chain().
+        self._chain = []
+        self._chain_pos = {}
         # store of txs. key is txid, value is a CTransaction object
         self.tx_store = {}
-        self.getdata_requests = []
+        # number of times each hash has been requested in a getdata message
+        self.getdata_requests = Counter()
+
+    def _update_chain(self):
+        """Make _chain end in last_block_hash, walking back only as far as the fork point."""
+        if self._chain and self._chain[-1] == self.last_block_hash:
+            root_parent = self.block_store[self._chain[0]].hashPrevBlock
+            if root_parent not in self.block_store:
+                return
+            # The parent of our oldest block has been added since, rebuild.
+            self._chain = []
+            self._chain_pos = {}
+
+        new_blocks = []
+        block_hash = self.last_block_hash
+        while block_hash in self.block_store and block_hash not in self._chain_pos:
+            new_blocks.append(block_hash)
+            block_hash = self.block_store[block_hash].hashPrevBlock
+        if block_hash in self._chain_pos:
+            fork_pos = self._chain_pos[block_hash] + 1
+        else:
+            fork_pos = 0
+        for stale_hash in self._chain[fork_pos:]:
+            del self._chain_pos[stale_hash]
+        del self._chain[fork_pos:]
+        for block_hash in reversed(new_blocks):
+            self._chain_pos[block_hash] = len(self._chain)
+            self._chain.append(block_hash)
 
     def on_getdata(self, message):
         """Check for the tx/block in our stores and if found, reply with an inv message."""
         for inv in message.inv:
-            self.getdata_requests.append(inv.hash)
+            self.getdata_requests[inv.hash] += 1
             if (inv.type & MSG_TYPE_MASK) == MSG_TX and inv.hash in self.tx_store.keys():
                 self.send_message(msg_tx(self.tx_store[inv.hash]))
             elif (inv.type & MSG_TYPE_MASK) == MSG_BLOCK and inv.hash in self.block_store.keys():
@@ -678,23 +967,20 @@ class P2PDataStore(P2PInterface):
         if not self.block_store:
             return
 
-        headers_list = [self.block_store[self.last_block_hash]]
-        while headers_list[-1].sha256 not in locator.vHave:
-            # Walk back through the block store, adding headers to headers_list
-            # as we go.
-            prev_block_hash = headers_list[-1].hashPrevBlock
-            if prev_block_hash in self.block_store:
-                prev_block_header = CBlockHeader(self.block_store[prev_block_hash])
-                headers_list.append(prev_block_header)
-                if prev_block_header.sha256 == hash_stop:
-                    # if this is the hashstop header, stop here
-                    break
-            else:
-                logger.debug('block hash {} not found in block store'.format(hex(prev_block_hash)))
-                break
+        self._update_chain()
+        tip_pos = len(self._chain) - 1
+        # Start from the most recent locator block in our chain, or from the
+        # hashstop block if that comes after it (but not at the tip).
+        start_pos = max([self._chain_pos.get(h, -1) for h in locator.vHave], default=-1)
+        stop_pos = self._chain_pos.get(hash_stop, -1)
+        if start_pos < stop_pos < tip_pos:
+            start_pos = stop_pos
+        if start_pos < 0:
+            logger.debug('block hash {} not found in block store'.format(hex(self.block_store[self._chain[0]].hashPrevBlock)))
+            start_pos = 0
 
         # Truncate the list if there are too many headers
-        headers_list = headers_list[:-MAX_HEADERS_RESULTS - 1:-1]
+        headers_list = [CBlockHeader(self.block_store[h]) for h in self._chain[start_pos:start_pos + MAX_HEADERS_RESULTS]]
         response = msg_headers(headers_list)
 
         if response is not None:
@@ -712,7 +998,7 @@ class P2PDataStore(P2PInterface):
          - if success is False: assert that the node's tip doesn't advance
          - if reject_reason is set: assert that the correct reject message is logged"""
 
-        with p2p_lock:
+        with self.p2p_lock:
             for block in blocks:
                 self.block_store[block.sha256] = block
                 self.last_block_hash = block.sha256
@@ -749,7 +1035,7 @@ class P2PDataStore(P2PInterface):
          - if expect_disconnect is True: Skip the sync with ping
          - if reject_reason is set: assert that the correct reject message is logged."""
 
-        with p2p_lock:
+        with self.p2p_lock:
             for tx in txs:
                 self.tx_store[tx.sha256] = tx
 
@@ -788,7 +1074,7 @@ class P2PTxInvStore(P2PInterface):
                 self.tx_invs_received[i.hash] += 1
 
     def get_invs(self):
-        with p2p_lock:
+        with self.p2p_lock:
             return list(self.tx_invs_received.keys())
 
     def wait_for_broadcast(self, txns, timeout=60):
@@ -799,3 +1085,225 @@ class P2PTxInvStore(P2PInterface):
         self.wait_until(lambda: set(self.tx_invs_received.keys()) == set([int(tx, 16) for tx in txns]), timeout=timeout)
         # Flush messages and wait for the getdatas to be processed
         self.sync_with_ping()
+
+
+class TestFrameworkP2P(unittest.TestCase):
+    def test_frame_decoder(self):
+        """Messages are decoded identically regardless of how the stream is chunked."""
+        class Collector(P2PConnection):
+            def on_message(self, message):
+                self.received.append(message)
+
+        msgs = [msg_ping(nonce=i) for i in range(5)] + [msg_headers([CBlockHeader() for _ in range(20)]), msg_verack()]
+        conn = Collector()
+        conn.peer_connect_helper('0', 0, 'regtest', 1)
+        stream = b"".join(conn.build_message(m) for m in msgs)
+        for chunk_size in [1, 7, 24, 25, len(stream)]:
+            conn.received = []
+            for i in range(0, len(stream), chunk_size):
+                conn.data_received(stream[i:i + chunk_size])
+            self.assertEqual([m.serialize() for m in conn.received], [m.serialize() for m in msgs])
+            self.assertEqual(len(conn.recvbuf), 0)
+
+    def test_lazy_messages(self):
+        class Collector(P2PConnection):
+            def on_message(self, message):
+                self.received.append(message)
+
+            def _log_message(self, direction, msg):
+                self.logged.append(repr(msg))
+
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(1, 0)))
+        tx.vout.append(CTxOut(1, b"\x51"))
+        block = CBlock()
+        block.vtx = [tx]
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        msgs = [msg_block(block), msg_headers([CBlockHeader(block)]), msg_ping(nonce=1)]
+        conn = Collector(lazy_messages=True)
+        conn.peer_connect_helper('0', 0, 'regtest', 1)
+        conn.received = []
+        conn.logged = []
+        conn.data_received(b"".join(conn.build_message(m) for m in msgs))
+        received_block, received_headers, ping = conn.received
+        self.assertIn("not decoded yet", conn.logged[0])
+        self.assertIsInstance(received_headers, msg_headers)
+        self.assertIsInstance(ping, msg_ping)
+        # The header is decoded right away, the transactions on first access.
+        self.assertEqual(received_block.block.rehash(), block.sha256)
+        self.assertIsNotNone(received_block.block._payload)
+        self.assertEqual(received_block.block, block)
+        self.assertIsNone(received_block.block._payload)
+        self.assertEqual(received_block.serialize(), msgs[0].serialize())
+        self.assertEqual(received_headers.headers[0].sha256, block.sha256)
+        # Fields assigned before decoding are kept.
+        lazy = LAZY_MESSAGEMAP[b"block"](block.serialize()).block
+        lazy.vtx = []
+        self.assertIsNone(lazy.mweb_block)
+        self.assertEqual(lazy.vtx, [])
+        # A malformed payload raises on every read, not only the first one.
+        truncated = LAZY_MESSAGEMAP[b"headers"](msg_headers([CBlockHeader(block)] * 2).serialize()[:-10])
+        for _ in range(2):
+            with self.assertRaises(struct.error):
+                truncated.headers
+        self.assertIsNotNone(truncated._payload)
+
+    def test_frame_decoder_bad_checksum(self):
+        conn = P2PConnection()
+        conn.peer_connect_helper('0', 0, 'regtest', 1)
+        data = bytearray(conn.build_message(msg_ping(nonce=1)))
+        data[MSG_HEADER_SIZE - 1] ^= 1
+        with self.assertRaisesRegex(ValueError, "bad checksum"):
+            conn.data_received(bytes(data))
+
+    def test_wait_until_wakes_on_message(self):
+        peer = P2PInterface()
+        peer.peer_connect_helper('0', 0, 'regtest', 1)
+        peer._transport = object()
+        deliver = threading.Timer(0.1, lambda: peer.on_message(msg_verack()))
+        deliver.start()
+        peer.wait_until(lambda: peer.message_count['verack'] == 1, timeout=5)
+        deliver.join()
+        self.assertEqual(peer.message_count['verack'], 1)
+
+    def test_send_messages_backpressure(self):
+        """send_messages() blocks while the peer does not read and delivers every frame in order."""
+        listener = socket.create_server(("127.0.0.1", 0))
+        received = bytearray()
+        reading = threading.Event()
+
+        def read_all(total):
+            sock, _ = listener.accept()
+            reading.wait()
+            with sock:
+                while len(received) < total:
+                    received.extend(sock.recv(1 << 16))
+
+        messages = [msg_generic(b"filler", bytes([i]) * 100000) for i in range(200)]
+        class Sender(P2PConnection):
+            def on_open(self):
+                pass
+
+            def on_close(self):
+                pass
+
+        conn = Sender()
+        conn.peer_connect_helper('0', 0, 'regtest', 1)
+        frames = [conn.build_message(m) for m in messages]
+        total = sum(map(len, frames))
+        network_thread = NetworkThread()
+        network_thread.start()
+        reader = threading.Thread(target=read_all, args=(total,), daemon=True)
+        reader.start()
+        try:
+            with mock.patch(__name__ + ".MAX_SEND_QUEUE_BYTES", 1 << 18):
+                conn.peer_connect('127.0.0.1', listener.getsockname()[1], net='regtest', timeout_factor=1)()
+                wait_until_helper(lambda: conn.is_connected, timeout=10)
+                sender = threading.Thread(target=lambda: [conn.send_messages(messages[i:i + 10]) for i in range(0, len(messages), 10)])
+                sender.start()
+                wait_until_helper(lambda: conn._writing_paused, timeout=10)
+                sender.join(0.2)
+                self.assertTrue(sender.is_alive())
+                self.assertLess(conn.send_stats()["bytes"], total)
+                reading.set()
+                sender.join(30)
+                reader.join(30)
+            self.assertEqual(bytes(received), b"".join(frames))
+            stats = conn.send_stats()
+            self.assertEqual((stats["messages"], stats["bytes"]), (len(messages), total))
+            self.assertGreater(stats["bytes_per_second"], 0)
+            conn.reset_send_stats()
+            self.assertEqual(conn.send_stats()["messages"], 0)
+        finally:
+            reading.set()
+            conn.peer_disconnect()
+            wait_until_helper(lambda: not conn.is_connected, timeout=10)
+            network_thread.close()
+            listener.close()
+
+    def test_sharded_network_thread(self):
+        """Connections are spread over the event loops and each has its own lock."""
+        listener = socket.create_server(("127.0.0.1", 0))
+        accepted = []
+
+        def serve(count, ping):
+            # Send every connection a ping and collect the replies.
+            for _ in range(count):
+                sock, _ = listener.accept()
+                sock.sendall(ping)
+                accepted.append(sock)
+
+        network_thread = NetworkThread(num_loops=3)
+        network_thread.start()
+        peers = [P2PInterface() for _ in range(6)]
+        try:
+            connects = [peer.peer_connect('127.0.0.1', listener.getsockname()[1], net='regtest', timeout_factor=1, send_version=False) for peer in peers]
+            server = threading.Thread(target=serve, args=(len(peers), peers[0].build_message(msg_ping(nonce=7))), daemon=True)
+            server.start()
+            for connect in connects:
+                connect()
+            for peer in peers:
+                peer.wait_for_connect(timeout=10)
+                peer.wait_until(lambda: peer.message_count['ping'] == 1, timeout=10)
+            server.join(10)
+            pong = peers[0].build_message(msg_pong(nonce=7))
+            for sock in accepted:
+                self.assertEqual(sock.recv(len(pong), socket.MSG_WAITALL), pong)
+            self.assertEqual(len({id(peer._loop) for peer in peers}), 3)
+            self.assertEqual(len({id(peer.p2p_lock) for peer in peers}), len(peers))
+            self.assertIsNot(peers[0].p2p_lock, p2p_lock)
+        finally:
+            for peer in peers:
+                peer.peer_disconnect()
+            for peer in peers:
+                peer.wait_for_disconnect(timeout=10)
+            network_thread.close()
+            for sock in accepted:
+                sock.close()
+            listener.close()
+        self.assertEqual(NetworkThread.network_event_loops, [])
+
+    def test_data_store_getheaders(self):
+        class Store(P2PDataStore):
+            def send_message(self, message):
+                self.sent.append(message)
+
+        def make_block(prev):
+            block = CBlock()
+            block.hashPrevBlock = prev
+            block.nNonce = len(blocks)
+            block.rehash()
+            blocks.append(block.sha256)
+            store.block_store[block.sha256] = block
+            store.last_block_hash = block.sha256
+            return block.sha256
+
+        def getheaders(have, stop=0):
+            request = msg_getheaders()
+            request.locator.vHave = have
+            request.hashstop = stop
+            store.sent = []
+            store.on_getheaders(request)
+            return [header.sha256 for header in store.sent[0].headers]
+
+        store = Store()
+        blocks = []
+        tip = 0x1234
+        for _ in range(MAX_HEADERS_RESULTS + 10):
+            tip = make_block(tip)
+        self.assertEqual(getheaders([]), blocks[:MAX_HEADERS_RESULTS])
+        self.assertEqual(getheaders([blocks[5], blocks[2]]), blocks[5:MAX_HEADERS_RESULTS + 5])
+        self.assertEqual(getheaders([blocks[-3]]), blocks[-3:])
+        self.assertEqual(getheaders([blocks[-3]], stop=blocks[-2]), blocks[-2:])
+
+        # Reorg onto a fork of the block at height 100.
+        fork = blocks[100]
+        for _ in range(3):
+            fork = make_block(fork)
+        self.assertEqual(getheaders([blocks[MAX_HEADERS_RESULTS], blocks[99]]), blocks[99:101] + blocks[-3:])
+        self.assertEqual(store._chain_pos[fork], 103)
+
+        getdata = msg_getdata([CInv(MSG_BLOCK, fork)] * 2)
+        store.on_getdata(getdata)
+        self.assertEqual(store.getdata_requests[fork], 2)
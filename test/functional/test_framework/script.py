@@ -16,9 +16,12 @@ from typing import List, Dict
 from .key import TaggedHash, tweak_add_pubkey
 
 from .messages import (
+    COutPoint,
     CTransaction,
+    CTxIn,
     CTxOut,
     hash256,
+    ser_compact_size,
     ser_string,
     ser_uint256,
     sha256,
@@ -632,7 +635,45 @@ def FindAndDelete(script, sig):
         r += script[last_sop_idx:]
     return CScript(r)
 
-def LegacySignatureHash(script, txTo, inIdx, hashtype):
+class PrecomputedTransactionData:
+    """Signature hash data that is shared by all inputs of a transaction.
+
+    Mirrors PrecomputedTransactionData in src/script/interpreter.h: build it
+    once per transaction and pass it as txdata to LegacySignatureHash,
+    SegwitV0SignatureHash and TaprootSignatureHash, so that signing all
+    inputs of a transaction is linear instead of quadratic in its size.
+
+    Only the parts of the transaction that signatures commit to are used, so
+    scriptSigs and witnesses may still change afterwards, but inputs, outputs,
+    nSequence values and spent_utxos must not."""
+
+    def __init__(self, txTo, spent_utxos=None):
+        prevouts = [i.prevout.serialize() for i in txTo.vin]
+        sequences = [struct.pack("<I", i.nSequence) for i in txTo.vin]
+        self.outputs = [o.serialize() for o in txTo.vout]
+
+        # Legacy: every input with an empty scriptSig, and with nSequence
+        # zeroed for SIGHASH_NONE and SIGHASH_SINGLE.
+        self.legacy_prevouts = prevouts
+        self.legacy_inputs = [p + b"\x00" + n for p, n in zip(prevouts, sequences)]
+        self.legacy_inputs_no_sequence = [p + b"\x00\x00\x00\x00\x00" for p in prevouts]
+
+        # BIP341 single SHA256 midstates, and BIP143 double SHA256 midstates.
+        self.prevouts_single_hash = sha256(b"".join(prevouts))
+        self.sequences_single_hash = sha256(b"".join(sequences))
+        self.outputs_single_hash = sha256(b"".join(self.outputs))
+        self.hashPrevouts = sha256(self.prevouts_single_hash)
+        self.hashSequence = sha256(self.sequences_single_hash)
+        self.hashOutputs = sha256(self.outputs_single_hash)
+
+        self.spent_amounts_single_hash = None
+        self.spent_scripts_single_hash = None
+        if spent_utxos is not None:
+            assert len(spent_utxos) == len(txTo.vin)
+            self.spent_amounts_single_hash = sha256(b"".join(struct.pack("<q", u.nValue) for u in spent_utxos))
+            self.spent_scripts_single_hash = sha256(b"".join(ser_string(u.scriptPubKey) for u in spent_utxos))
+
+def LegacySignatureHash(script, txTo, inIdx, hashtype, txdata=None):
     """Consensus-correct SignatureHash
 
     Returns (hash, err) to precisely match the consensus-critical behavior of
@@ -642,6 +683,8 @@ def LegacySignatureHash(script, txTo, inIdx, hashtype):
 
     if inIdx >= len(txTo.vin):
         return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
+    if txdata is not None:
+        return _LegacySignatureHashPrecomputed(script, txTo, inIdx, hashtype, txdata)
     txtmp = CTransaction(txTo)
 
     for txin in txtmp.vin:
@@ -682,33 +725,77 @@ def LegacySignatureHash(script, txTo, inIdx, hashtype):
 
     return (hash, None)
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
+def _LegacySignatureHashPrecomputed(script, txTo, inIdx, hashtype, txdata):
+    """LegacySignatureHash, serializing the modified transaction directly from
+    txdata instead of copying and modifying txTo."""
+    HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+    base_type = hashtype & 0x1f
+    if base_type == SIGHASH_SINGLE and inIdx >= len(txTo.vout):
+        return (HASH_ONE, "outIdx %d out of range (%d)" % (inIdx, len(txTo.vout)))
+
+    signed_input = txdata.legacy_prevouts[inIdx] + ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR]))) + struct.pack("<I", txTo.vin[inIdx].nSequence)
+    if hashtype & SIGHASH_ANYONECANPAY:
+        inputs = [signed_input]
+    else:
+        if base_type == SIGHASH_NONE or base_type == SIGHASH_SINGLE:
+            inputs = txdata.legacy_inputs_no_sequence[:]
+        else:
+            inputs = txdata.legacy_inputs[:]
+        inputs[inIdx] = signed_input
+
+    if base_type == SIGHASH_NONE:
+        outputs = []
+    elif base_type == SIGHASH_SINGLE:
+        outputs = [CTxOut(-1).serialize()] * inIdx + [txdata.outputs[inIdx]]
+    else:
+        outputs = txdata.outputs
+
+    s = b"".join([
+        struct.pack("<i", txTo.nVersion),
+        ser_compact_size(len(inputs)),
+        *inputs,
+        ser_compact_size(len(outputs)),
+        *outputs,
+        struct.pack("<I", txTo.nLockTime),
+        struct.pack(b"<I", hashtype),
+    ])
+    return (hash256(s), None)
+
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
 # for version 0 witnesses.
-def SegwitV0SignatureHash(script, txTo, inIdx, hashtype, amount):
+def SegwitV0SignatureHash(script, txTo, inIdx, hashtype, amount, txdata=None):
 
     hashPrevouts = 0
     hashSequence = 0
     hashOutputs = 0
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
+        if txdata is not None:
+            hashPrevouts = uint256_from_str(txdata.hashPrevouts)
+        else:
+            serialize_prevouts = bytes()
+            for i in txTo.vin:
+                serialize_prevouts += i.prevout.serialize()
+            hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
 
     if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
+        if txdata is not None:
+            hashSequence = uint256_from_str(txdata.hashSequence)
+        else:
+            serialize_sequence = bytes()
+            for i in txTo.vin:
+                serialize_sequence += struct.pack("<I", i.nSequence)
+            hashSequence = uint256_from_str(hash256(serialize_sequence))
 
     if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
+        if txdata is not None:
+            hashOutputs = uint256_from_str(txdata.hashOutputs)
+        else:
+            serialize_outputs = bytes()
+            for o in txTo.vout:
+                serialize_outputs += o.serialize()
+            hashOutputs = uint256_from_str(hash256(serialize_outputs))
     elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
         serialize_outputs = txTo.vout[inIdx].serialize()
         hashOutputs = uint256_from_str(hash256(serialize_outputs))
@@ -755,7 +842,26 @@ class TestFrameworkScript(unittest.TestCase):
         for value in values:
             self.assertEqual(CScriptNum.decode(CScriptNum.encode(CScriptNum(value))), value)
 
-def TaprootSignatureHash(txTo, spent_utxos, hash_type, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT):
+    def test_precomputed_sighash(self):
+        tx = CTransaction()
+        tx.nVersion = 2
+        tx.nLockTime = 17
+        for i in range(3):
+            tx.vin.append(CTxIn(COutPoint(i * 0x1111, i), b"", 0xfffffffe - i))
+        tx.vout = [CTxOut(1000 + i, CScript([OP_TRUE] * (i + 1))) for i in range(2)]
+        spent_utxos = [CTxOut(5000 * (i + 1), CScript([OP_1, bytes([i]) * 32])) for i in range(3)]
+        script = CScript([OP_TRUE, OP_CODESEPARATOR, OP_TRUE])
+        txdata = PrecomputedTransactionData(tx, spent_utxos)
+        for idx in range(3):
+            for hashtype in [SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE]:
+                for hashtype in [hashtype, hashtype | SIGHASH_ANYONECANPAY]:
+                    self.assertEqual(LegacySignatureHash(script, tx, idx, hashtype), LegacySignatureHash(script, tx, idx, hashtype, txdata))
+                    self.assertEqual(SegwitV0SignatureHash(script, tx, idx, hashtype, 5000), SegwitV0SignatureHash(script, tx, idx, hashtype, 5000, txdata))
+                    self.assertEqual(TaprootSignatureHash(tx, spent_utxos, hashtype, idx), TaprootSignatureHash(tx, spent_utxos, hashtype, idx, txdata=txdata))
+            self.assertEqual(TaprootSignatureHash(tx, spent_utxos, SIGHASH_DEFAULT, idx, scriptpath=True, script=script, annex=bytes([ANNEX_TAG])),
+                             TaprootSignatureHash(tx, spent_utxos, SIGHASH_DEFAULT, idx, scriptpath=True, script=script, annex=bytes([ANNEX_TAG]), txdata=txdata))
+
+def TaprootSignatureHash(txTo, spent_utxos, hash_type, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT, txdata = None):
     assert (len(txTo.vin) == len(spent_utxos))
     assert (input_index < len(txTo.vin))
     out_type = SIGHASH_ALL if hash_type == 0 else hash_type & 3
@@ -765,12 +871,22 @@ def TaprootSignatureHash(txTo, spent_utxos, hash_type, input_index = 0, scriptpa
     ss += struct.pack("<i", txTo.nVersion)
     ss += struct.pack("<I", txTo.nLockTime)
     if in_type != SIGHASH_ANYONECANPAY:
-        ss += sha256(b"".join(i.prevout.serialize() for i in txTo.vin))
-        ss += sha256(b"".join(struct.pack("<q", u.nValue) for u in spent_utxos))
-        ss += sha256(b"".join(ser_string(u.scriptPubKey) for u in spent_utxos))
-        ss += sha256(b"".join(struct.pack("<I", i.nSequence) for i in txTo.vin))
+        if txdata is not None:
+            assert txdata.spent_amounts_single_hash is not None, "txdata was built without spent_utxos"
+            ss += txdata.prevouts_single_hash
+            ss += txdata.spent_amounts_single_hash
+            ss += txdata.spent_scripts_single_hash
+            ss += txdata.sequences_single_hash
+        else:
+            ss += sha256(b"".join(i.prevout.serialize() for i in txTo.vin))
+            ss += sha256(b"".join(struct.pack("<q", u.nValue) for u in spent_utxos))
+            ss += sha256(b"".join(ser_string(u.scriptPubKey) for u in spent_utxos))
+            ss += sha256(b"".join(struct.pack("<I", i.nSequence) for i in txTo.vin))
     if out_type == SIGHASH_ALL:
-        ss += sha256(b"".join(o.serialize() for o in txTo.vout))
+        if txdata is not None:
+            ss += txdata.outputs_single_hash
+        else:
+            ss += sha256(b"".join(o.serialize() for o in txTo.vout))
     spend_type = 0
     if annex is not None:
         spend_type |= 1
@@ -788,7 +904,7 @@ def TaprootSignatureHash(txTo, spent_utxos, hash_type, input_index = 0, scriptpa
         ss += sha256(ser_string(annex))
     if out_type == SIGHASH_SINGLE:
         if input_index < len(txTo.vout):
-            ss += sha256(txTo.vout[input_index].serialize())
+            ss += sha256(txdata.outputs[input_index] if txdata is not None else txTo.vout[input_index].serialize())
         else:
             ss += bytes(0 for _ in range(32))
     if (scriptpath):
@@ -4,9 +4,12 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Base class for RPC testing."""
 
+import concurrent.futures
 import configparser
 from enum import Enum
 import argparse
+import hashlib
+import json
 import logging
 import os
 import pathlib
@@ -28,6 +31,7 @@ from .util import (
     PortSeed,
     assert_equal,
     check_json_precision,
+    clone_datadir,
     get_datadir_path,
     initialize_datadir,
     p2p_port,
@@ -57,6 +61,10 @@ TEST_EXIT_FAILED = 1
 TEST_EXIT_SKIPPED = 77
 
 TMPDIR_PREFIX = "litecoin_func_test_"
+# Bump when _initialize_chain changes the contents of the cached chain.
+CHAIN_CACHE_VERSION = 1
+# Number of cached chains (e.g. for different litecoind builds) to keep.
+MAX_CHAIN_CACHES = 4
 VALIDITY_MIGRATION_PROFILE_FLAGS = [
     "-validityallowmigrationprofiles=1",
 ]
@@ -114,6 +122,10 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.setup_clean_chain = False
         self.nodes = []
         self.network_thread = None
+        # Number of event loop threads to spread P2P connections over, see
+        # NetworkThread. Tests that raise this must take peer.p2p_lock instead
+        # of the module-level p2p_lock.
+        self.num_network_threads = 1
         self.rpc_timeout = 60  # Wait for up to 60 seconds for the RPC server to respond
         self.supports_cli = True
         self.bind_to_localhost_only = True
@@ -267,7 +279,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.log.debug("PRNG seed is: {}".format(seed))
 
         self.log.debug('Setting up network thread')
-        self.network_thread = NetworkThread()
+        self.network_thread = NetworkThread(num_loops=self.num_network_threads)
         self.network_thread.start()
 
         if self.options.usecli:
@@ -549,8 +561,10 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         try:
             for i, node in enumerate(self.nodes):
                 node.start(extra_args[i], *args, **kwargs)
-            for node in self.nodes:
-                node.wait_for_rpc_connection()
+            # The nodes start up in parallel, so wait for all of them at once
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.nodes))) as executor:
+                for future in [executor.submit(node.wait_for_rpc_connection) for node in self.nodes]:
+                    future.result()
         except:
             # If one node failed to start, stop the others
             self.stop_nodes()
@@ -732,76 +746,153 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         Afterward, create num_nodes copies from the cache."""
 
         CACHE_NODE_ID = 0  # Use node 0 to create the cache for all other nodes
-        cache_node_dir = get_datadir_path(self.options.cachedir, CACHE_NODE_ID)
+        cache_dir = os.path.join(self.options.cachedir, self._chain_cache_key())
+        cache_node_dir = get_datadir_path(cache_dir, CACHE_NODE_ID)
         assert self.num_nodes <= MAX_NODES
 
-        if not os.path.isdir(cache_node_dir):
+        if os.path.isdir(cache_node_dir):
+            # Mark as recently used, see _prune_chain_caches()
+            os.utime(cache_dir)
+        else:
+            # Build the cache under a temporary name and move it into place
+            # when complete, so that concurrent test runs never see (or both
+            # write to) a partial cache.
+            build_dir = tempfile.mkdtemp(prefix="build_", dir=self.options.cachedir)
+            build_node_dir = get_datadir_path(build_dir, CACHE_NODE_ID)
             self.log.debug("Creating cache directory {}".format(cache_node_dir))
 
-            initialize_datadir(self.options.cachedir, CACHE_NODE_ID, self.chain)
-            self.nodes.append(
-                TestNode(
-                    CACHE_NODE_ID,
-                    cache_node_dir,
-                    chain=self.chain,
-                    extra_conf=["bind=127.0.0.1"],
-                    extra_args=['-disablewallet'],
-                    rpchost=None,
-                    timewait=self.rpc_timeout,
-                    timeout_factor=self.options.timeout_factor,
-                    bitcoind=self.options.bitcoind,
-                    bitcoin_cli=self.options.bitcoincli,
-                    coverage_dir=None,
-                    cwd=self.options.tmpdir,
-                    descriptors=self.options.descriptors,
-                ))
-            self.start_node(CACHE_NODE_ID)
-            cache_node = self.nodes[CACHE_NODE_ID]
-
-            # Wait for RPC connections to be ready
-            cache_node.wait_for_rpc_connection()
-
-            # Set a time in the past, so that blocks don't end up in the future
-            cache_node.setmocktime(cache_node.getblockheader(cache_node.getbestblockhash())['time'])
-
-            # Create a 199-block-long chain; each of the 4 first nodes
-            # gets 25 mature blocks and 25 immature.
-            # The 4th node gets only 24 immature blocks so that the very last
-            # block in the cache does not age too much (have an old tip age).
-            # This is needed so that we are out of IBD when the test starts,
-            # see the tip age check in IsInitialBlockDownload().
-            for i in range(8):
-                cache_node.generatetoaddress(
-                    nblocks=25 if i != 7 else 24,
-                    address=TestNode.PRIV_KEYS[i % 4].address,
-                )
-
-            assert_equal(cache_node.getblockchaininfo()["blocks"], 199)
-
-            # Shut it down, and clean up cache directories:
-            self.stop_nodes()
-            self.nodes = []
-
-            def cache_path(*paths):
-                return os.path.join(cache_node_dir, self.chain, *paths)
-
-            os.rmdir(cache_path('wallets'))  # Remove empty wallets dir
-            for entry in os.listdir(cache_path()):
-                # Keep the persistent chain data directories. Remove everything
-                # else, regardless of whether it is a file or directory.
-                if entry not in ['chainstate', 'blocks', 'indexes']:
-                    path = cache_path(entry)
-                    if os.path.isdir(path):
-                        shutil.rmtree(path)
-                    else:
-                        os.remove(path)
+            try:
+                initialize_datadir(build_dir, CACHE_NODE_ID, self.chain)
+                self.nodes.append(
+                    TestNode(
+                        CACHE_NODE_ID,
+                        build_node_dir,
+                        chain=self.chain,
+                        extra_conf=["bind=127.0.0.1"],
+                        extra_args=['-disablewallet'],
+                        rpchost=None,
+                        timewait=self.rpc_timeout,
+                        timeout_factor=self.options.timeout_factor,
+                        bitcoind=self.options.bitcoind,
+                        bitcoin_cli=self.options.bitcoincli,
+                        coverage_dir=None,
+                        cwd=self.options.tmpdir,
+                        descriptors=self.options.descriptors,
+                    ))
+                self.start_node(CACHE_NODE_ID)
+                cache_node = self.nodes[CACHE_NODE_ID]
+
+                # Wait for RPC connections to be ready
+                cache_node.wait_for_rpc_connection()
+
+                # Set a time in the past, so that blocks don't end up in the future
+                cache_node.setmocktime(cache_node.getblockheader(cache_node.getbestblockhash())['time'])
+
+                # Create a 199-block-long chain; each of the 4 first nodes
+                # gets 25 mature blocks and 25 immature.
+                # The 4th node gets only 24 immature blocks so that the very last
+                # block in the cache does not age too much (have an old tip age).
+                # This is needed so that we are out of IBD when the test starts,
+                # see the tip age check in IsInitialBlockDownload().
+                for i in range(8):
+                    cache_node.generatetoaddress(
+                        nblocks=25 if i != 7 else 24,
+                        address=TestNode.PRIV_KEYS[i % 4].address,
+                    )
+
+                assert_equal(cache_node.getblockchaininfo()["blocks"], 199)
+
+                # Shut it down, and clean up cache directories:
+                self.stop_nodes()
+                self.nodes = []
+
+                def cache_path(*paths):
+                    return os.path.join(build_node_dir, self.chain, *paths)
+
+                os.rmdir(cache_path('wallets'))  # Remove empty wallets dir
+                for entry in os.listdir(cache_path()):
+                    # Keep the persistent chain data directories. Remove everything
+                    # else, regardless of whether it is a file or directory.
+                    if entry not in ['chainstate', 'blocks', 'indexes']:
+                        path = cache_path(entry)
+                        if os.path.isdir(path):
+                            shutil.rmtree(path)
+                        else:
+                            os.remove(path)
+            except BaseException:
+                # Do not leave the partial cache behind when building it fails
+                # or the run is interrupted.
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+
+            try:
+                os.rename(build_dir, cache_dir)
+            except OSError:
+                # Another test created the same cache in the meantime
+                assert os.path.isdir(cache_node_dir)
+                shutil.rmtree(build_dir)
+            self._prune_chain_caches()
 
         for i in range(self.num_nodes):
             self.log.debug("Copy cache directory {} to node {}".format(cache_node_dir, i))
             to_dir = get_datadir_path(self.options.tmpdir, i)
-            shutil.copytree(cache_node_dir, to_dir)
+            clone_datadir(cache_node_dir, to_dir)
             initialize_datadir(self.options.tmpdir, i, self.chain)  # Overwrite port/rpcport in bitcoin.conf
 
+    def _chain_cache_key(self):
+        """Return the name of the cached chain for this litecoind binary and chain.
+
+        The cache is keyed by everything that determines its contents, so it
+        can be reused across test runs and is never used with a different
+        build."""
+        os.makedirs(self.options.cachedir, exist_ok=True)
+        key = hashlib.sha256()
+        key.update(self._bitcoind_digest().encode())
+        key.update(json.dumps([
+            CHAIN_CACHE_VERSION,
+            self.chain,
+            [priv_key.address for priv_key in TestNode.PRIV_KEYS],
+        ]).encode())
+        return key.hexdigest()
+
+    def _bitcoind_digest(self):
+        """Return the SHA256 of the litecoind binary.
+
+        Digests are remembered by path, size and modification time, so the
+        binary is only read once per build."""
+        path = os.path.abspath(shutil.which(self.options.bitcoind) or self.options.bitcoind)
+        stat = os.stat(path)
+        stamp = "{}:{}:{}".format(path, stat.st_size, stat.st_mtime_ns)
+        digests_file = os.path.join(self.options.cachedir, "binary_digests.json")
+        try:
+            with open(digests_file, encoding="utf8") as f:
+                digests = json.load(f)
+        except (OSError, ValueError):
+            digests = {}
+        if stamp not in digests:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            digests[stamp] = digest.hexdigest()
+            tmp_file = "{}.{}.tmp".format(digests_file, os.getpid())
+            with open(tmp_file, 'w', encoding="utf8") as f:
+                json.dump(digests, f)
+            os.replace(tmp_file, digests_file)
+        return digests[stamp]
+
+    def _prune_chain_caches(self):
+        """Remove the least recently used cached chains beyond MAX_CHAIN_CACHES."""
+        caches = []
+        for entry in os.listdir(self.options.cachedir):
+            path = os.path.join(self.options.cachedir, entry)
+            if re.fullmatch("[0-9a-f]{64}", entry) and os.path.isdir(path):
+                caches.append((os.stat(path).st_mtime, path))
+        caches.sort(reverse=True)
+        for _, path in caches[MAX_CHAIN_CACHES:]:
+            self.log.debug("Removing unused cache directory {}".format(path))
+            shutil.rmtree(path, ignore_errors=True)
+
     def _initialize_chain_clean(self):
         """Initialize empty blockchain for use by the test.
 
@@ -34,9 +34,14 @@ from .util import (
     wait_until_helper,
     p2p_port,
     EncodeDecimal,
+    LogWatcher,
+    SubstringScanner,
 )
 
 BITCOIND_PROC_WAIT_TIMEOUT = 60
+# Intervals for polling litecoind while it starts up
+STARTUP_POLL_MIN_INTERVAL = 0.01
+STARTUP_POLL_MAX_INTERVAL = 0.25
 
 
 class FailedToStartError(Exception):
@@ -211,12 +216,24 @@ class TestNode():
         if self.start_perf:
             self._start_perf()
 
+    def _sleep_unless_exited(self, delay):
+        """Sleep for delay seconds, but return as soon as the litecoind process exits."""
+        if self.process is None:
+            time.sleep(delay)
+            return
+        try:
+            self.process.wait(timeout=delay)
+        except subprocess.TimeoutExpired:
+            pass
+
     def wait_for_rpc_connection(self):
         """Sets up an RPC connection to the litecoind process. Returns False if unable to connect."""
-        # Poll at a rate of four times per second
-        poll_per_s = 4
+        # Poll quickly at first and back off to four times per second. A
+        # process exit is noticed immediately.
+        poll_interval = STARTUP_POLL_MIN_INTERVAL
+        time_end = time.time() + self.rpc_timeout
         rpc = None
-        for _ in range(poll_per_s * self.rpc_timeout):
+        while time.time() < time_end:
             if self.process.poll() is not None:
                 raise FailedToStartError(self._node_msg(
                     'litecoind exited with status {} during initialization'.format(self.process.returncode)))
@@ -284,22 +301,25 @@ class TestNode():
             except ValueError as e:  # cookie file not found and no rpcuser or rpcpassword; bitcoind is still starting
                 if "No RPC credentials" not in str(e):
                     raise
-            time.sleep(1.0 / poll_per_s)
+            self._sleep_unless_exited(poll_interval)
+            poll_interval = min(2 * poll_interval, STARTUP_POLL_MAX_INTERVAL)
         self._raise_assertion_error("Unable to connect to litecoind after {}s".format(self.rpc_timeout))
 
     def wait_for_cookie_credentials(self):
         """Ensures auth cookie credentials can be read, e.g. for testing CLI with -rpcwait before RPC connection is up."""
         self.log.debug("Waiting for cookie credentials")
-        # Poll at a rate of four times per second.
-        poll_per_s = 4
-        for _ in range(poll_per_s * self.rpc_timeout):
+        # Poll quickly at first and back off to four times per second.
+        poll_interval = STARTUP_POLL_MIN_INTERVAL
+        time_end = time.time() + self.rpc_timeout
+        while time.time() < time_end:
             try:
                 get_auth_cookie(self.datadir, self.chain)
                 self.log.debug("Cookie credentials successfully retrieved")
                 return
             except ValueError:  # cookie file not found and no rpcuser or rpcpassword; bitcoind is still starting
                 pass            # so we continue polling until RPC credentials are retrieved
-            time.sleep(1.0 / poll_per_s)
+            time.sleep(poll_interval)
+            poll_interval = min(2 * poll_interval, STARTUP_POLL_MAX_INTERVAL)
         self._raise_assertion_error("Unable to retrieve cookie credentials after {}s".format(self.rpc_timeout))
 
     def generate(self, nblocks, maxtries=1000000):
@@ -368,6 +388,13 @@ class TestNode():
         return True
 
     def wait_until_stopped(self, timeout=BITCOIND_PROC_WAIT_TIMEOUT):
+        if self.running:
+            # Block on the process exit instead of polling for it
+            try:
+                self.process.wait(timeout=timeout * self.timeout_factor)
+            except subprocess.TimeoutExpired:
+                pass
+        # Returns right away once the node has stopped
         wait_until_helper(self.is_node_stopped, timeout=timeout, timeout_factor=self.timeout_factor)
 
     @contextlib.contextmanager
@@ -376,31 +403,33 @@ class TestNode():
             unexpected_msgs = []
         time_end = time.time() + timeout * self.timeout_factor
         debug_log = os.path.join(self.datadir, self.chain, 'debug.log')
-        with open(debug_log, encoding='utf-8') as dl:
-            dl.seek(0, 2)
-            prev_size = dl.tell()
-
-        yield
-
-        while True:
-            found = True
-            with open(debug_log, encoding='utf-8') as dl:
-                dl.seek(prev_size)
-                log = dl.read()
-            print_log = " - " + "\n - ".join(log.splitlines())
-            for unexpected_msg in unexpected_msgs:
-                if re.search(re.escape(unexpected_msg), log, flags=re.MULTILINE):
-                    self._raise_assertion_error('Unexpected message "{}" partially matches log:\n\n{}\n\n'.format(unexpected_msg, print_log))
-            for expected_msg in expected_msgs:
-                if re.search(re.escape(expected_msg), log, flags=re.MULTILINE) is None:
-                    found = False
-            if found:
-                return
-            if time.time() >= time_end:
-                break
-            time.sleep(0.05)
+        expected = SubstringScanner(expected_msgs)
+        unexpected = SubstringScanner(unexpected_msgs)
+        with LogWatcher(debug_log) as watcher:
+            yield
+
+            # Only scan the text appended since the last round, and wake up as
+            # soon as the node writes to the log.
+            while True:
+                log = watcher.read()
+                expected.feed(log)
+                unexpected.feed(log)
+                if unexpected.found:
+                    unexpected_msg = next(msg for msg in unexpected_msgs if msg in unexpected.found)
+                    self._raise_assertion_error('Unexpected message "{}" partially matches log:\n\n{}\n\n'.format(unexpected_msg, self._format_log(watcher.text())))
+                if not expected.pending:
+                    return
+                remaining = time_end - time.time()
+                if remaining <= 0:
+                    break
+                watcher.wait(remaining)
+            print_log = self._format_log(watcher.text())
         self._raise_assertion_error('Expected messages "{}" does not partially match log:\n\n{}\n\n'.format(str(expected_msgs), print_log))
 
+    @staticmethod
+    def _format_log(log):
+        return " - " + "\n - ".join(log.splitlines())
+
     @contextlib.contextmanager
     def profile_with_perf(self, profile_name):
         """
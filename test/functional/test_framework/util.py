@@ -8,12 +8,18 @@ from base64 import b64encode
 from binascii import unhexlify
 from decimal import Decimal, ROUND_DOWN
 from subprocess import CalledProcessError
+import ctypes
 import hashlib
 import inspect
 import json
 import logging
 import os
 import re
+import select
+import shutil
+import sys
+import tempfile
+import threading
 import time
 import unittest
 
@@ -21,6 +27,11 @@ from . import coverage
 from .authproxy import AuthServiceProxy, JSONRPCException
 from io import BytesIO
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 logger = logging.getLogger("TestFramework.utils")
 
 # Assert functions
@@ -229,6 +240,9 @@ def satoshi_round(amount):
 def wait_until_helper(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=None, timeout_factor=1.0):
     """Sleep until the predicate resolves to be True.
 
+    If lock is a threading.Condition, the predicate is re-evaluated as soon as
+    the condition is notified, instead of only every 50 ms.
+
     Warning: Note that this method is not recommended to be used in tests as it is
     not aware of the context of the test framework. Using the `wait_until()` members
     from `BitcoinTestFramework` or `P2PInterface` class ensures the timeout is
@@ -246,10 +260,16 @@ def wait_until_helper(predicate, *, attempts=float('inf'), timeout=float('inf'),
             with lock:
                 if predicate():
                     return
+                attempt += 1
+                if isinstance(lock, threading.Condition):
+                    # Still wake up periodically, in case the predicate
+                    # depends on state the condition is not notified about.
+                    lock.wait(timeout=max(0, min(0.05, time_end - time.time())))
+                    continue
         else:
             if predicate():
                 return
-        attempt += 1
+            attempt += 1
         time.sleep(0.05)
 
     # Print the cause of the timeout
@@ -372,6 +392,148 @@ def get_datadir_path(dirname, n):
     return os.path.join(dirname, "node" + str(n))
 
 
+class SubstringScanner:
+    """Track which of a set of substrings occur in text that is fed in chunks.
+
+    Each chunk is searched once, together with the end of the previous chunk
+    so that matches spanning two chunks are found."""
+
+    def __init__(self, patterns):
+        self.pending = set(patterns)
+        self.found = set()
+        if "" in self.pending:
+            self.pending.discard("")
+            self.found.add("")
+        self._overlap = max(map(len, self.pending), default=1) - 1
+        self._tail = ""
+
+    def feed(self, text):
+        if not text or not self.pending:
+            return
+        window = self._tail + text
+        for pattern in list(self.pending):
+            if pattern in window:
+                self.pending.discard(pattern)
+                self.found.add(pattern)
+        self._tail = window[-self._overlap:] if self._overlap else ""
+
+
+class _InotifyWaiter:
+    """Wait for modifications of a file with inotify (Linux only)."""
+    IN_MODIFY = 0x2
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_MODIFY) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogWatcher:
+    """Follow the text appended to a file, such as a node's debug.log, after
+    the watcher was created.
+
+    read() only returns text that has not been returned before, and wait()
+    returns as soon as the file is modified where inotify is available."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, encoding='utf-8')
+        self._file.seek(0, 2)
+        self.start_offset = self._file.tell()
+        self._waiter = None
+        if sys.platform.startswith('linux'):
+            try:
+                self._waiter = _InotifyWaiter(path)
+            except (OSError, AttributeError):
+                pass
+
+    def read(self):
+        """Return the text appended since the last call."""
+        return self._file.read()
+
+    def text(self):
+        """Return all text appended since the watcher was created."""
+        with open(self.path, encoding='utf-8') as f:
+            f.seek(self.start_offset)
+            return f.read()
+
+    def wait(self, timeout):
+        """Wait until the file may have been appended to, for at most timeout seconds."""
+        if self._waiter:
+            # Still wake up regularly, in case an event was missed
+            self._waiter.wait(min(timeout, 0.5))
+        else:
+            time.sleep(min(timeout, 0.05))
+
+    def close(self):
+        self._file.close()
+        if self._waiter:
+            self._waiter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ioctl to share the data blocks of one file with another (reflink), on
+# filesystems that support it (btrfs, XFS, ...). _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """Try to make dst a copy-on-write clone of src. Return whether it worked."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def _clone_file(src, dst):
+    if _reflink(src, dst):
+        return dst
+    # LevelDB never modifies a table file once it has been written, so the
+    # copy can share it with the cache. Block and undo files are appended to.
+    if src.endswith('.ldb'):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def clone_datadir(src, dst):
+    """Copy the datadir src to dst, without duplicating file data on disk where possible.
+
+    Files are reflinked if the filesystem supports it. Otherwise immutable
+    LevelDB tables are hardlinked and all other files are copied."""
+    shutil.copytree(src, dst, copy_function=_clone_file)
+
+
 def append_config(datadir, options):
     with open(os.path.join(datadir, "litecoin.conf"), 'a', encoding='utf8') as f:
         for option in options:
@@ -556,6 +718,55 @@ def modinv(a, n):
     return t1
 
 class TestFrameworkUtil(unittest.TestCase):
+    def test_substring_scanner(self):
+        scanner = SubstringScanner(["abc", "xyz", ""])
+        self.assertEqual(scanner.found, {""})
+        for chunk in ["--a", "b", "c--x", "y"]:
+            scanner.feed(chunk)
+        self.assertEqual(scanner.found, {"", "abc"})
+        self.assertEqual(scanner.pending, {"xyz"})
+        scanner.feed("z")
+        self.assertEqual(scanner.pending, set())
+
+    def test_log_watcher(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'debug.log')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("old line\n")
+            with LogWatcher(path) as watcher, open(path, 'a', encoding='utf-8') as log:
+                self.assertEqual(watcher.read(), "")
+                log.write("first\n")
+                log.flush()
+                threading.Timer(0.2, lambda: (log.write("second\n"), log.flush())).start()
+                self.assertEqual(watcher.read(), "first\n")
+                start = time.time()
+                while not watcher.read() and time.time() - start < 5:
+                    watcher.wait(5)
+                self.assertEqual(watcher.text(), "first\nsecond\n")
+
+    def test_clone_datadir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'node0')
+            os.makedirs(os.path.join(src, 'regtest', 'chainstate'))
+            files = {
+                os.path.join('regtest', 'chainstate', '000003.ldb'): b'table',
+                os.path.join('regtest', 'chainstate', 'MANIFEST-000002'): b'manifest',
+                'litecoin.conf': b'regtest=1\n',
+            }
+            for name, data in files.items():
+                with open(os.path.join(src, name), 'wb') as f:
+                    f.write(data)
+            dst = os.path.join(tmpdir, 'node1')
+            clone_datadir(src, dst)
+            for name, data in files.items():
+                with open(os.path.join(dst, name), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            # Writing to a mutable file in the clone must not affect the source.
+            with open(os.path.join(dst, 'regtest', 'chainstate', 'MANIFEST-000002'), 'ab') as f:
+                f.write(b'more')
+            with open(os.path.join(src, 'regtest', 'chainstate', 'MANIFEST-000002'), 'rb') as f:
+                self.assertEqual(f.read(), b'manifest')
+
     def test_modinv(self):
         test_vectors = [
             [7, 11],
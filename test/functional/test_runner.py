@@ -16,13 +16,16 @@ import argparse
 from collections import deque
 import configparser
 import datetime
+import json
 import os
 import pathlib
+import queue
 import time
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import re
 import logging
 import unittest
@@ -69,9 +72,12 @@ TEST_EXIT_SKIPPED = 77
 
 TEST_FRAMEWORK_MODULES = [
     "address",
+    "authproxy",
     "blocktools",
     "muhash",
     "key",
+    "messages",
+    "p2p",
     "script",
     "segwit_addr",
     "util",
@@ -366,11 +372,13 @@ def main():
     parser.add_argument('--extended', action='store_true', help='run the extended test suite in addition to the basic tests')
     parser.add_argument('--help', '-h', '-?', action='store_true', help='print help text and exit')
     parser.add_argument('--jobs', '-j', type=int, default=4, help='how many test scripts to run in parallel. Default=4.')
-    parser.add_argument('--keepcache', '-k', action='store_true', help='the default behavior is to flush the cache directory on startup. --keepcache retains the cache from the previous testrun.')
+    parser.add_argument('--flushcache', action='store_true', help='delete the cache directory on startup. By default, the cached chain is reused as long as litecoind has not changed.')
+    parser.add_argument('--keepcache', '-k', action='store_true', help='deprecated: the cache is kept by default now.')
     parser.add_argument('--quiet', '-q', action='store_true', help='only print dots, results summary and failure logs')
     parser.add_argument('--tmpdirprefix', '-t', default=tempfile.gettempdir(), help="Root directory for datadirs")
     parser.add_argument('--failfast', action='store_true', help='stop execution after the first test failure')
     parser.add_argument('--filter', help='filter scripts to run by regular expression')
+    parser.add_argument('--timingfile', help='file to read and record test durations, used to start the longest tests first. Default=<builddir>/test/timing.json.')
 
     args, unknown_args = parser.parse_known_args()
     if not args.ansi:
@@ -469,7 +477,7 @@ def main():
     check_script_list(src_dir=config["environment"]["SRCDIR"], fail_on_warn=args.ci)
     check_script_prefixes()
 
-    if not args.keepcache:
+    if args.flushcache:
         shutil.rmtree("%s/test/cache" % config["environment"]["BUILDDIR"], ignore_errors=True)
 
     run_tests(
@@ -483,10 +491,12 @@ def main():
         combined_logs_len=args.combinedlogslen,
         failfast=args.failfast,
         use_term_control=args.ansi,
+        timing_file=args.timingfile,
     )
 
-def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, use_term_control):
+def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, use_term_control, timing_file=None):
     args = args or []
+    timings = Timings(timing_file or os.path.join(build_dir, 'test', 'timing.json'))
 
     # Warn if bitcoind is already running
     try:
@@ -497,16 +507,14 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
         # pgrep not supported
         pass
 
-    # Warn if there is a cache directory
     cache_dir = "%s/test/cache" % build_dir
-    if os.path.isdir(cache_dir):
-        print("%sWARNING!%s There is a cache directory here: %s. If tests fail unexpectedly, try deleting the cache directory." % (BOLD[1], BOLD[0], cache_dir))
 
     # Test Framework Tests
     print("Running Unit Tests for Test Framework Modules")
     test_framework_tests = unittest.TestSuite()
     for module in TEST_FRAMEWORK_MODULES:
         test_framework_tests.addTest(unittest.TestLoader().loadTestsFromName("test_framework.{}".format(module)))
+    test_framework_tests.addTest(unittest.TestLoader().loadTestsFromName("combine_logs"))
     result = unittest.TextTestRunner(verbosity=1, failfast=True).run(test_framework_tests)
     if not result.wasSuccessful():
         logging.debug("Early exiting after failure in TestFramework unit tests")
@@ -536,7 +544,7 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
         num_tests_parallel=jobs,
         tests_dir=tests_dir,
         tmpdir=tmpdir,
-        test_list=test_list,
+        test_list=timings.schedule(test_list),
         flags=flags,
         use_term_control=use_term_control,
     )
@@ -574,6 +582,7 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
                 break
 
     print_results(test_results, max_len_name, (int(time.time() - start_time)))
+    timings.save_timings(test_results)
 
     if coverage:
         coverage_passed = coverage.report_rpc_coverage()
@@ -631,6 +640,8 @@ class TestHandler:
         self.flags = flags
         self.num_running = 0
         self.jobs = []
+        # Jobs are put here by their waiter thread as soon as they exit
+        self.finished_jobs = queue.Queue()
         self.use_term_control = use_term_control
 
     def get_next(self):
@@ -645,15 +656,17 @@ class TestHandler:
             test_argv = test.split()
             testdir = "{}/{}_{}".format(self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
             tmpdir_arg = ["--tmpdir={}".format(testdir)]
-            self.jobs.append((test,
-                              time.time(),
-                              subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
-                                               universal_newlines=True,
-                                               stdout=log_stdout,
-                                               stderr=log_stderr),
-                              testdir,
-                              log_stdout,
-                              log_stderr))
+            job = (test,
+                   time.time(),
+                   subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
+                                    universal_newlines=True,
+                                    stdout=log_stdout,
+                                    stderr=log_stderr),
+                   testdir,
+                   log_stdout,
+                   log_stderr)
+            self.jobs.append(job)
+            threading.Thread(target=self._wait_for_exit, args=(job,), daemon=True).start()
         if not self.jobs:
             raise IndexError('pop from empty list')
 
@@ -664,29 +677,34 @@ class TestHandler:
         dot_count = 0
         while True:
             # Return first proc that finishes
-            time.sleep(.5)
-            for job in self.jobs:
-                (name, start_time, proc, testdir, log_out, log_err) = job
-                if proc.poll() is not None:
-                    log_out.seek(0), log_err.seek(0)
-                    [stdout, stderr] = [log_file.read().decode('utf-8') for log_file in (log_out, log_err)]
-                    log_out.close(), log_err.close()
-                    if proc.returncode == TEST_EXIT_PASSED and stderr == "":
-                        status = "Passed"
-                    elif proc.returncode == TEST_EXIT_SKIPPED:
-                        status = "Skipped"
-                    else:
-                        status = "Failed"
-                    self.num_running -= 1
-                    self.jobs.remove(job)
-                    if self.use_term_control:
-                        clearline = '\r' + (' ' * dot_count) + '\r'
-                        print(clearline, end='', flush=True)
-                    dot_count = 0
-                    return TestResult(name, status, int(time.time() - start_time)), testdir, stdout, stderr
+            try:
+                job = self.finished_jobs.get(timeout=.5)
+            except queue.Empty:
+                if self.use_term_control:
+                    print('.', end='', flush=True)
+                dot_count += 1
+                continue
+            (name, start_time, proc, testdir, log_out, log_err) = job
+            log_out.seek(0), log_err.seek(0)
+            [stdout, stderr] = [log_file.read().decode('utf-8') for log_file in (log_out, log_err)]
+            log_out.close(), log_err.close()
+            if proc.returncode == TEST_EXIT_PASSED and stderr == "":
+                status = "Passed"
+            elif proc.returncode == TEST_EXIT_SKIPPED:
+                status = "Skipped"
+            else:
+                status = "Failed"
+            self.num_running -= 1
+            self.jobs.remove(job)
             if self.use_term_control:
-                print('.', end='', flush=True)
-            dot_count += 1
+                clearline = '\r' + (' ' * dot_count) + '\r'
+                print(clearline, end='', flush=True)
+            return TestResult(name, status, int(time.time() - start_time)), testdir, stdout, stderr
+
+    def _wait_for_exit(self, job):
+        """Block until the job's process exits and hand the job to get_next()."""
+        job[2].wait()
+        self.finished_jobs.put(job)
 
     def kill_and_join(self):
         """Send SIGKILL to all jobs and block until all have ended."""
@@ -699,6 +717,52 @@ class TestHandler:
             proc.wait()
 
 
+class Timings():
+    """
+    Durations of the test scripts in previous runs, keyed by the test name
+    including its arguments, so that every variant is tracked separately.
+    """
+
+    def __init__(self, timing_file):
+        self.timing_file = timing_file
+        self.existing_timings = self.load_timings()
+
+    def load_timings(self):
+        try:
+            with open(self.timing_file, encoding="utf8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def schedule(self, test_list):
+        """Return the tests in the order they should be started.
+
+        TestHandler starts the next test whenever a job slot frees up, so
+        handing out the longest tests first is longest-processing-time-first
+        scheduling. Tests without a recorded duration are started first, in
+        the order of the test lists, which are roughly sorted by duration."""
+        unknown = [test for test in test_list if test not in self.existing_timings]
+        known = [test for test in test_list if test in self.existing_timings]
+        known.sort(key=lambda test: self.existing_timings[test], reverse=True)
+        return unknown + known
+
+    def save_timings(self, test_results):
+        # Merge with the file's current contents, in case another test run
+        # has updated it in the meantime.
+        timings = self.load_timings()
+        for test_result in test_results:
+            if test_result.status == "Passed":
+                timings[test_result.name] = test_result.time
+        try:
+            os.makedirs(os.path.dirname(self.timing_file) or '.', exist_ok=True)
+            tmp_file = "{}.{}.tmp".format(self.timing_file, os.getpid())
+            with open(tmp_file, 'w', encoding="utf8") as f:
+                json.dump(timings, f, indent=0, sort_keys=True)
+            os.replace(tmp_file, self.timing_file)
+        except OSError as e:
+            logging.debug("Could not save test durations to %s: %s" % (self.timing_file, e))
+
+
 class TestResult():
     def __init__(self, name, status, time):
         self.name = name